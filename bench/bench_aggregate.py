@@ -0,0 +1,88 @@
+"""非流式聚合基准: 字符串 += 与 ContentBuffer 对比 (耗时与峰值内存)
+
+用法: python bench/bench_aggregate.py
+"""
+import time
+import tracemalloc
+
+from common import use_variant, synthetic_tokens, upstream_event, fake_response, bench
+
+use_variant('linux')
+import app  # noqa: E402
+
+
+def concat(tokens):
+    """原实现: full_content += content"""
+    full_content = ""
+    for token in tokens:
+        content = token.decode('utf-8')
+        if content:
+            full_content += content
+    return full_content
+
+
+def concat_shared(tokens):
+    """+= 在字符串被其他地方引用时 (如调试/日志保留预览) 退化为每次复制"""
+    full_content = ""
+    for token in tokens:
+        content = token.decode('utf-8')
+        if content:
+            preview = full_content  # noqa: F841 保留一个引用
+            full_content += content
+    return full_content
+
+
+def buffered(tokens, max_bytes=0):
+    buffer = app.ContentBuffer(max_bytes)
+    for token in tokens:
+        content = token.decode('utf-8')
+        if content and not buffer.append(content):
+            break
+    return buffer.getvalue()
+
+
+def upstream_response(pieces):
+    """带有 make_request_with_retry 设置的属性的上游响应"""
+    response = fake_response(pieces)
+    response.metric_labels = ("bench", "bench")
+    response.started = time.monotonic()
+    response.trace = app.NULL_TRACE
+    response.target = None
+    return response
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    for count in (10000, 100000):
+        # 每个 token 在循环中解码为新的 str 对象, 与真实路径一致
+        words = synthetic_tokens(count)
+        tokens = [t.encode('utf-8') for t in words]
+        assert concat(tokens) == buffered(tokens) == "".join(words)
+        print(f"{count} tokens")
+        cases = [("+=", lambda: concat(tokens)), ("ContentBuffer", lambda: buffered(tokens))]
+        if count <= 10000:
+            cases.insert(1, ("+= (被引用)", lambda: concat_shared(tokens)))
+        for name, fn in cases:
+            print(f"  {name:<14} {bench(fn) * 1e3:8.2f} ms  峰值 {peak_memory(fn) / 1024:8.0f} KiB")
+
+        pieces = [upstream_event(t) for t in words] + [b"data: [DONE]\n\n"]
+        elapsed = bench(lambda: app.process_non_stream_response(upstream_response(pieces), "bench"), repeat=3)
+        peak = peak_memory(lambda: app.process_non_stream_response(upstream_response(pieces), "bench"))
+        print(f"  {'完整非流式路径':<14} {elapsed * 1e3:8.2f} ms  峰值 {peak / 1024:8.0f} KiB")
+
+        capped = app.ContentBuffer(16 * 1024)
+        for t in words:
+            if not capped.append(t):
+                break
+        print(f"  16 KiB 上限: {capped.size} 字节, finish_reason={capped.finish_reason}")
+
+
+if __name__ == '__main__':
+    main()
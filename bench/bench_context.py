@@ -0,0 +1,103 @@
+"""上下文裁剪基准: 100 / 1000 轮对话的裁剪耗时
+
+- 全量估算: 每次请求估算所有消息再裁剪
+- 从新到旧: 只估算放得下的消息 (ContextTrimmer)
+- 从新到旧 + 摘要缓存: 对照组, 按消息内容的 SHA-1 摘要缓存估算结果;
+  摘要与编码的开销比估算本身还大, 所以 ContextTrimmer 不缓存
+
+用法: python bench/bench_context.py
+"""
+import hashlib
+import random
+import threading
+from collections import OrderedDict
+
+from common import use_variant, synthetic_tokens, bench
+
+use_variant('linux')
+from context import MESSAGE_OVERHEAD, ContextTrimmer, estimate_tokens, message_text  # noqa: E402
+
+
+def conversation(turns, seed=0):
+    """system + turns 轮 user/assistant, 消息从 JSON 解析而来, 每次请求都是新的 str 对象"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": "".join(synthetic_tokens(rng.randint(10, 60), seed + turn))})
+        messages.append({"role": "assistant", "content": "".join(synthetic_tokens(rng.randint(50, 400), seed - turn))})
+    messages.append({"role": "user", "content": "继续"})
+    return messages
+
+
+def fresh_copy(messages):
+    """模拟每次请求重新解析 JSON: 内容相同但不是同一个对象"""
+    return [{"role": m["role"], "content": (m["content"] + " ")[:-1]} for m in messages]
+
+
+def trim_all(messages, budget):
+    """对照组: 先估算全部消息, 再从新到旧保留"""
+    counts = [estimate_tokens(message_text(m["content"])) + MESSAGE_OVERHEAD for m in messages]
+    used = counts[-1] + sum(c for c, m in zip(counts, messages) if m["role"] == "system")
+    first = len(messages) - 1
+    for index in range(len(messages) - 2, -1, -1):
+        if messages[index]["role"] == "system":
+            continue
+        if used + counts[index] > budget:
+            break
+        used += counts[index]
+        first = index
+    return [m for m in messages[:first] if m["role"] == "system"] + messages[first:]
+
+
+class DigestTrimmer(ContextTrimmer):
+    """对照组: 估算结果按内容摘要缓存 (LRU)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, message):
+        text = message_text(message.get("content"))
+        key = hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest()
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                return tokens
+        tokens = estimate_tokens(text) + MESSAGE_OVERHEAD
+        with self._lock:
+            self._cache[key] = tokens
+        return tokens
+
+
+def main():
+    budget = 32000
+    for turns in (100, 1000):
+        messages = conversation(turns)
+        copies = [fresh_copy(messages) for _ in range(5)]
+        total = sum(ContextTrimmer(0).count(m) for m in messages)
+        trimmer = ContextTrimmer(budget)
+        digest = DigestTrimmer(budget)
+        digest.trim(copies[0], budget)
+
+        def full():
+            trim_all(copies[0], budget)
+
+        def newest_first():
+            for copy in copies[1:]:
+                trimmer.trim(copy, budget)
+
+        def cached():
+            for copy in copies[1:]:
+                digest.trim(copy, budget)
+
+        kept, dropped = trimmer.trim(copies[1], budget)
+        print(f"{turns} 轮 ({len(messages)} 条消息, 约 {total} tokens, 预算 {budget}): 保留 {len(kept)} 条, 省略 {dropped} 条")
+        print(f"  全量估算              {bench(full) * 1e3:8.3f} ms / 请求")
+        print(f"  从新到旧              {bench(newest_first) / (len(copies) - 1) * 1e3:8.3f} ms / 请求")
+        print(f"  从新到旧 + 摘要缓存   {bench(cached) / (len(copies) - 1) * 1e3:8.3f} ms / 请求 (缓存全部命中)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""SSE 输出编码基准: 每个 token 构造 dict + json.dumps 与 ChunkEncoder 对比
+
+另外比较从上游事件到下游帧的完整路径: 取出内容后用 ChunkEncoder 重新编码, 与透传模式的 FrameRewriter
+(内容仍然取出用于计量, 帧按字节转发; 请求的模型名与上游不同时每帧多一次 bytes.replace)。
+
+用法: python bench/bench_encode.py [token 数]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import importlib
+
+from common import use_variant, synthetic_tokens, upstream_event, bench
+
+use_variant('linux')
+import codec  # noqa: E402
+import sse  # noqa: E402
+
+
+def old_encode(tokens, model):
+    """原实现: 每个 token 生成 uuid/时间戳并完整序列化"""
+    out = []
+    for content in tokens:
+        response_chunk = {
+            "id": str(uuid.uuid4()),
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "delta": {
+                    "content": content
+                },
+                "index": 0,
+                "finish_reason": None
+            }]
+        }
+        out.append(f"data: {json.dumps(response_chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+    return out
+
+
+def new_encode(module, tokens, model):
+    encoder = module.ChunkEncoder(model)
+    return [encoder.encode(content) for content in tokens]
+
+
+def reencode(module, payloads, model):
+    encoder = module.ChunkEncoder(model)
+    out = []
+    for payload in payloads:
+        content = sse.extract_content(payload)
+        if content:
+            out.append(encoder.encode(content))
+    return out
+
+
+def passthrough(module, payloads, model):
+    rewriter = module.FrameRewriter(model)
+    out = []
+    for payload in payloads:
+        sse.extract_content(payload)
+        out.append(rewriter.frame(payload))
+    return out
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    tokens = synthetic_tokens(count)
+    model = "deepseek-ai/DeepSeek-R1"
+
+    old = bench(lambda: old_encode(tokens, model))
+    print(f"{count} tokens")
+    print(f"  dict + json.dumps + uuid4:  {old / count * 1e9:7.0f} ns/token")
+
+    backends = ['json'] + (['orjson'] if codec.orjson is not None else [])
+    for backend in backends:
+        os.environ['JSON_BACKEND'] = backend
+        module = importlib.reload(codec)
+        frames = new_encode(module, tokens, model)
+        assert [json.loads(f[6:])["choices"][0]["delta"]["content"] for f in frames] == tokens
+        new = bench(lambda: new_encode(module, tokens, model))
+        print(f"  ChunkEncoder ({backend:<6}):     {new / count * 1e9:7.0f} ns/token  ({old / new:.1f}x)")
+
+    payloads = [upstream_event(content)[6:-2] for content in tokens]
+    print("上游事件 -> 下游帧 (含取出内容):")
+    base = bench(lambda: reencode(module, payloads, model))
+    print(f"  取出内容 + ChunkEncoder:     {base / count * 1e9:7.0f} ns/token")
+    frames = passthrough(module, payloads, "alias")
+    assert [json.loads(f[6:])["model"] for f in frames[:3]] == ["alias"] * 3
+    for name, target in (("透传", model), ("透传 + 替换 model", "alias")):
+        elapsed = bench(lambda: passthrough(module, payloads, target))
+        print(f"  {name:<22}   {elapsed / count * 1e9:7.0f} ns/token  ({base / elapsed:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""上游传输基准: HTTP/1.1 (每个并发流一个连接) 与 HTTP/2 多路复用 (H2Pool) 对比
+
+本地启动模拟上游 (mock_chutes.py, 同时支持 HTTP/1.1 与 h2c, 子进程), 客户端用 N 个线程并发读取流式响应,
+在所有流都进行中时统计本进程的 socket 数、线程数与内存 (RSS 与 Python 堆), 换算为每个流的开销。
+
+用法: python bench/bench_h2.py [并发数 ...]
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from common import use_variant
+from mock_chutes import MockChutes, serve as serve_mock
+
+use_variant('linux')
+
+TOKENS = 60
+INTERVAL = 0.05
+
+
+def serve(port):
+    """模拟上游: 同时支持 HTTP/1.1 与 h2c, 每个流 TOKENS 个 token"""
+    serve_mock(MockChutes(tokens=TOKENS, rate=1 / INTERVAL), port)
+
+
+# 客户端
+
+def count_sockets():
+    count = 0
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def rss_bytes():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def run(concurrency, url, open_stream, sockets_before=0):
+    """concurrency 个线程同时读取流, 返回 (耗时, socket 数, 线程数, RSS 增量, Python 堆增量)"""
+    started = threading.Barrier(concurrency + 1)
+    errors = []
+
+    def worker():
+        try:
+            response = open_stream(url)
+            started.wait()
+            for _ in response.iter_content(chunk_size=None):
+                pass
+            response.close()
+        except Exception as e:
+            errors.append(e)
+            started.abort()
+
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    heap_before = tracemalloc.get_traced_memory()[0]
+    begin = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    # 所有流都已收到响应头, 读取进行到一半时采样
+    time.sleep(TOKENS * INTERVAL / 2)
+    sockets = count_sockets() - sockets_before
+    thread_count = threading.active_count()
+    rss = rss_bytes() - rss_before
+    heap = tracemalloc.get_traced_memory()[0] - heap_before
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+    tracemalloc.stop()
+    if errors:
+        raise errors[0]
+    return elapsed, sockets, thread_count, rss, heap
+
+
+def measure(transport, concurrency, port):
+    """在独立进程中运行一种传输, 避免前一次运行留下的内存影响 RSS"""
+    import requests
+    from h2pool import H2Pool
+
+    url = f"http://127.0.0.1:{port}/app/api/chat"
+    body = b'{"messages": [{"role": "user", "content": "hi"}]}'
+    # 上游连接数包括预热时建立的连接
+    sockets_before = count_sockets()
+    if transport == "http2":
+        pool = H2Pool(max_connections=4)
+
+        def open_stream(url):
+            return pool.post(url, data=body)
+    else:
+        def open_stream(url):
+            # 与会话池一致: 每个并发流占用一个会话及其连接
+            session = requests.Session()
+            response = session.post(url, data=body, stream=True)
+            close = response.close
+            response.close = lambda: (close(), session.close())
+            return response
+
+    # 预热: 建立一次连接, 导入与首次请求的开销不计入
+    open_stream(url).close()
+    elapsed, sockets, thread_count, rss, heap = run(concurrency, url, open_stream, sockets_before)
+    name = "HTTP/2" if transport == "http2" else "HTTP/1.1"
+    print(f"  {name:9s} 耗时 {elapsed:5.2f} s  socket {sockets:4d}  线程 {thread_count:4d}  "
+          f"RSS {rss / concurrency / 1024:7.1f} KiB/流  Python 堆 {heap / concurrency / 1024:6.1f} KiB/流", flush=True)
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--serve":
+        return serve(int(sys.argv[2]))
+    if len(sys.argv) > 4 and sys.argv[1] == "--client":
+        return measure(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    levels = [int(arg) for arg in sys.argv[1:]] or [100, 400]
+    port = 18990
+    script = os.path.abspath(__file__)
+    server = subprocess.Popen([sys.executable, script, "--serve", str(port)])
+    time.sleep(1)
+    try:
+        for concurrency in levels:
+            print(f"{concurrency} 个并发流, 每个 {TOKENS} 个 token, 间隔 {INTERVAL * 1000:g} ms:", flush=True)
+            for transport in ("http1", "http2"):
+                subprocess.run([sys.executable, script, "--client", transport, str(concurrency), str(port)], check=True)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
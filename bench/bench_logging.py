@@ -0,0 +1,127 @@
+"""日志基准: 请求线程中每个请求的日志开销
+
+每个模拟请求写 3 条 INFO (收到请求、尝试第 N 次、状态码), 与聊天接口的热路径一致。
+- 同步: 原来的 basicConfig 配置, f-string 格式化, StreamHandler 在调用线程中加锁写出
+- 异步文本 / 异步 JSON: logs.AsyncLogging, 调用线程只入队, 格式化与写出在后台线程
+- 异步 JSON + 采样: LOG_SAMPLE=info=0.1, 按请求 id 丢弃 90% 请求的 INFO 日志
+输出分别写入 /dev/null 与模拟的慢速输出 (每次写入 50 µs, 类似经过管道与容器日志驱动的 stderr),
+统计调用线程中每个请求花在日志上的时间, 以及 32 个线程并发时的结果 (同步写出时线程在处理器锁上排队)。
+
+用法: python bench/bench_logging.py
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+
+from common import use_variant
+
+use_variant('linux')
+import logs  # noqa: E402
+
+REQUESTS = 2000
+
+
+class SlowStream:
+    """每次 write 额外耗时 delay 秒"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sink = open(os.devnull, "w")
+
+    def write(self, text):
+        deadline = time.perf_counter() + self.delay
+        self.sink.write(text)
+        while time.perf_counter() < deadline:
+            pass
+
+    def flush(self):
+        pass
+
+
+LOGGING_DEFAULTS = {name: getattr(logging, name) for name in (
+    "_srcfile", "logThreads", "logProcesses", "logMultiprocessing", "logAsyncioTasks") if hasattr(logging, name)}
+
+
+def sync_logger(stream):
+    # 原来的配置采集 LogRecord 的全部字段
+    for name, value in LOGGING_DEFAULTS.items():
+        setattr(logging, name, value)
+    logger = logging.Logger("bench-sync")
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger, None
+
+
+def async_logger(stream, fmt, sample=None):
+    logs.lean_records()
+    active = logs.AsyncLogging(stream=stream, fmt=fmt, sample=sample, queue_size=1000000)
+    logger = logging.Logger("bench-" + fmt)
+    logger.addHandler(active.handler)
+    logger.setLevel(logging.INFO)
+    active.start()
+    return logger, active
+
+
+def request_eager(logger, request_id, attempt):
+    logger.info(f"收到新的聊天请求 {request_id}")
+    logger.info(f"尝试第 {attempt + 1} 次请求: chutes-deepseek-ai-deepseek-r1")
+    logger.info(f"请求状态码: {200}")
+
+
+def request_deferred(logger, request_id, attempt):
+    logs.bind(request_id)
+    logger.info("收到新的聊天请求")
+    logger.info("尝试第 %d 次请求: %s", attempt + 1, "chutes-deepseek-ai-deepseek-r1")
+    logger.info("请求状态码: %d", 200)
+
+
+def run(make, request, threads):
+    """返回 (调用线程中每个请求的平均日志耗时, 写完全部日志的墙钟时间)"""
+    logger, active = make()
+    per_thread = REQUESTS // threads
+    spent = [0.0] * threads
+    ids = [uuid.uuid4().hex for _ in range(per_thread)]
+
+    def worker(index):
+        total = 0.0
+        for n in range(per_thread):
+            start = time.perf_counter()
+            request(logger, ids[n], 0)
+            total += time.perf_counter() - start
+        spent[index] = total
+
+    begin = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if active is not None:
+        active.stop(timeout=60)
+    wall = time.perf_counter() - begin
+    return sum(spent) / (per_thread * threads), wall
+
+
+def main():
+    configs = [
+        ("同步 (f-string)", lambda s: sync_logger(s), request_eager),
+        ("异步文本", lambda s: async_logger(s, "text"), request_deferred),
+        ("异步 JSON", lambda s: async_logger(s, "json"), request_deferred),
+        ("异步 JSON + 采样 10%", lambda s: async_logger(s, "json", {logging.INFO: 0.1}), request_deferred),
+    ]
+    sinks = [("/dev/null", lambda: open(os.devnull, "w")), ("慢速输出 50 µs/次", lambda: SlowStream(50e-6))]
+    for sink_name, make_sink in sinks:
+        for threads in (1, 32):
+            print(f"{sink_name}, {threads} 个线程, {REQUESTS} 个请求 (每个 3 条日志):")
+            for name, make, request in configs:
+                stream = make_sink()
+                per_request, wall = run(lambda: make(stream), request, threads)
+                print(f"  {name:22s} 调用线程 {per_request * 1e6:8.1f} µs/请求   全部写出 {wall * 1e3:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""上游 SSE 解析微基准: iter_lines + json.loads 与增量字节解析对比
+
+用法: python bench/bench_sse.py [token 数]
+"""
+import sys
+import json
+
+from common import use_variant, synthetic_tokens, upstream_event, upstream_stream, split_reads, fake_response, bench
+
+use_variant('linux')
+from sse import DONE, iter_response_events, extract_content  # noqa: E402
+
+
+def process_chunk(chunk):
+    try:
+        if "choices" in chunk and chunk["choices"][0]["delta"].get("content"):
+            return chunk["choices"][0]["delta"]["content"]
+        return None
+    except Exception:
+        return None
+
+
+def old_path(pieces):
+    """原实现: iter_lines + decode + startswith + json.loads"""
+    out = []
+    for line in fake_response(pieces).iter_lines():
+        if line:
+            line = line.decode('utf-8')
+            if line.startswith("data: "):
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                try:
+                    content = process_chunk(json.loads(data))
+                    if content:
+                        out.append(content)
+                except json.JSONDecodeError:
+                    continue
+    return out
+
+
+def new_path(pieces):
+    """增量字节解析 + 快速提取 content"""
+    out = []
+    for payload in iter_response_events(fake_response(pieces)):
+        if payload == DONE:
+            break
+        content = extract_content(payload, process_chunk)
+        if content:
+            out.append(content)
+    return out
+
+
+def report(title, pieces, count):
+    old = bench(lambda: old_path(pieces))
+    new = bench(lambda: new_path(pieces))
+    print(f"[{title}] {count} 个数据块, {len(pieces)} 次读取")
+    print(f"  iter_lines + json.loads: {old / count * 1e9:8.0f} ns/块")
+    print(f"  增量字节解析:            {new / count * 1e9:8.0f} ns/块  ({old / new:.1f}x)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tokens = synthetic_tokens(count)
+    aligned = [upstream_event(t) for t in tokens] + [b"data: [DONE]\n\n"]
+    split = split_reads(upstream_stream(tokens))
+    for pieces in (aligned, split):
+        assert old_path(pieces) == new_path(pieces) == tokens
+
+    report("每次读取一个事件", aligned, count)
+    report("随机切分读取", split, count)
+
+    payloads = [event[6:-2] for event in aligned[:-1]]
+    parse = bench(lambda: [process_chunk(json.loads(p)) for p in payloads])
+    extract = bench(lambda: [extract_content(p, process_chunk) for p in payloads])
+    print(f"[仅内容提取] json.loads: {parse / count * 1e9:.0f} ns/块, extract_content: {extract / count * 1e9:.0f} ns/块 ({parse / extract:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""抓取真实上游响应, 供 mock_chutes.py --replay 回放
+
+通过 linux 版本的上游请求流程 (会话池、cf_clearance、重试) 发送一次流式请求, 按到达顺序记录原始数据块
+与相对请求开始的时间, 每行一个 JSON: {"t": 秒数, "chunk": base64}; 第一行为请求的元信息。
+环境变量与运行代理时相同 (AUTH_TOKEN、CF_CLEARANCE、CHUTES_BASE_URL 等)。
+
+用法: python bench/capture.py -o captures/r1.jsonl [--model deepseek-ai/DeepSeek-R1] [--prompt "..."] [--count 3]
+--count 大于 1 时输出到目录, 每个响应一个文件。
+"""
+import argparse
+import base64
+import json
+import os
+import time
+
+from common import use_variant
+
+use_variant('linux')
+
+
+def capture(core, openai_request):
+    """返回 [(相对秒数, 原始数据块), ...]; 上游失败时抛出 RuntimeError"""
+    start = time.monotonic()
+    response = core.make_request_with_retry(openai_request)
+    if getattr(response, "status_code", 0) != 200 or not hasattr(response, "iter_content"):
+        raise RuntimeError(f"上游请求失败: {response.get_data(as_text=True)}")
+    chunks = []
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            if chunk:
+                chunks.append((time.monotonic() - start, chunk))
+    finally:
+        core.release_response(response)
+    return chunks
+
+
+def write_capture(path, meta, chunks):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(meta, ensure_ascii=False) + "\n")
+        for offset, chunk in chunks:
+            f.write(json.dumps({"t": round(offset, 6), "chunk": base64.b64encode(chunk).decode()}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="抓取上游 SSE 响应")
+    parser.add_argument("-o", "--output", required=True, help="输出文件; --count 大于 1 时为目录")
+    parser.add_argument("--model", default="deepseek-ai/DeepSeek-R1")
+    parser.add_argument("--prompt", default="用三段话介绍一下 HTTP/2 的多路复用。")
+    parser.add_argument("--count", type=int, default=1)
+    args = parser.parse_args()
+
+    import app as core
+
+    openai_request = {"model": args.model, "stream": True, "messages": [{"role": "user", "content": args.prompt}]}
+    if args.count > 1:
+        os.makedirs(args.output, exist_ok=True)
+    for index in range(args.count):
+        chunks = capture(core, openai_request)
+        path = os.path.join(args.output, f"{index:03d}.jsonl") if args.count > 1 else args.output
+        meta = {"model": args.model, "upstream": core.CHUTES_CHAT_URL,
+                "captured": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "chunks": len(chunks)}
+        write_capture(path, meta, chunks)
+        size = sum(len(chunk) for _, chunk in chunks)
+        print(f"{path}: {len(chunks)} 个数据块, {size} 字节, 首块 {chunks[0][0] * 1000:.0f} ms, "
+              f"总计 {chunks[-1][0]:.2f} s" if chunks else f"{path}: 空响应")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""基准测试公共工具"""
+import os
+import sys
+import json
+import time
+import random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ["好的", "，", "我们", "来", "分析", "一下", " the", " model", " is", " thinking", "\n", "😀", " \"quoted\"", "\\"]
+
+
+def use_variant(variant='linux'):
+    """把 linux/ 或 win/ 目录加入 sys.path, 以便直接 import app 中的模块"""
+    path = os.path.join(ROOT, variant)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def synthetic_tokens(count, seed=0):
+    """生成 count 个模拟 token"""
+    rng = random.Random(seed)
+    return [rng.choice(WORDS) for _ in range(count)]
+
+
+def upstream_event(token, index=0):
+    """构造一个与 Chutes 上游格式一致的 SSE 数据块"""
+    chunk = {
+        "id": "chatcmpl-8d2f2b3c9a1e4f5a",
+        "object": "chat.completion.chunk",
+        "created": 1737000000,
+        "model": "deepseek-ai/DeepSeek-R1",
+        "choices": [{"index": index, "delta": {"content": token}, "logprobs": None, "finish_reason": None}]
+    }
+    return b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+def upstream_stream(tokens):
+    """完整的上游 SSE 字节流"""
+    return b"".join(upstream_event(t) for t in tokens) + b"data: [DONE]\n\n"
+
+
+def split_reads(raw, avg_size=96, seed=0):
+    """按随机大小切分字节流, 模拟网络读取 (会切断 UTF-8 多字节字符)"""
+    rng = random.Random(seed)
+    pieces = []
+    pos = 0
+    while pos < len(raw):
+        size = rng.randint(1, avg_size * 2)
+        pieces.append(raw[pos:pos + size])
+        pos += size
+    return pieces
+
+
+class FakeRaw:
+    """模拟 urllib3 响应, 按给定的块返回数据"""
+
+    chunked = True
+
+    def __init__(self, pieces):
+        self._pieces = pieces
+
+    def stream(self, chunk_size=None, decode_content=True):
+        yield from self._pieces
+
+    def close(self):
+        pass
+
+
+def fake_response(pieces):
+    """构造一个流式 requests.Response"""
+    import requests
+
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = FakeRaw(pieces)
+    return response
+
+
+def bench(fn, repeat=5):
+    """多次运行取最快一次, 返回秒数"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
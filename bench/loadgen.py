@@ -0,0 +1,320 @@
+"""压测: 本地模拟上游 + 代理 (linux / win 版本), 统计吞吐、附加首字延迟、每个流的内存与每个 token 的 CPU
+
+1. 启动 mock_chutes.py (子进程), 先直接压测模拟上游得到基准首字延迟
+2. 启动代理 (子进程, CHUTES_BASE_URL 指向模拟上游), 以相同的并发与请求数压测
+3. 代理的进程树 (含 gunicorn/uvicorn worker) 的 RSS 与 CPU 时间从 /proc 读取:
+   - 每个流的内存 = (压测中 RSS 峰值 - 空闲 RSS) / 并发数
+   - 每个 token 的 CPU = 压测期间的 CPU 时间 / 模拟上游发送的 token 数
+
+用法:
+  python bench/loadgen.py --variant linux --server gunicorn -c 50 -n 500
+  python bench/loadgen.py --variant win --server dev -c 20 -n 200 --no-stream
+  python bench/loadgen.py --server asgi --replay captures/ --speed 2
+  python bench/loadgen.py --env STREAM_COALESCE_MS=20 --env UPSTREAM_TRANSPORT=http2 --forbidden-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from common import ROOT
+from mock_chutes import add_arguments, mock_argv
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTENT = re.compile(rb'"content":\s*"[^"]')
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+# 进程树统计
+
+def process_tree(pid):
+    """pid 及其所有子孙进程"""
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, ()))
+    return tree
+
+
+def tree_usage(pid):
+    """(RSS 字节数, 用户态 + 内核态 CPU 秒数), 包含所有子孙进程"""
+    rss = 0
+    cpu = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{member}/statm") as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+        # utime, stime 为 stat 的第 14、15 个字段
+        cpu += int(fields[11]) + int(fields[12])
+    return rss, cpu / CLOCK_TICKS
+
+
+class Sampler(threading.Thread):
+    """压测期间定时采样进程树的 RSS, 记录峰值"""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, tree_usage(self.pid)[0])
+            if self._stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+# 客户端
+
+async def one_request(client, url, body, stream):
+    """返回 (是否成功, 首字延迟, 总耗时, 收到的事件数)"""
+    start = time.perf_counter()
+    first = None
+    events = 0
+    try:
+        if not stream:
+            response = await client.post(url, content=body)
+            elapsed = time.perf_counter() - start
+            return response.status_code == 200, elapsed, elapsed, 1
+        async with client.stream("POST", url, content=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return False, None, time.perf_counter() - start, 0
+            tail = b""
+            async for chunk in response.aiter_raw():
+                if first is None and CONTENT.search(chunk):
+                    first = time.perf_counter() - start
+                events += chunk.count(b"data:")
+                tail = (tail + chunk)[-16:]
+            # 只有收到结束标记的流才算成功, 上游中途断开时代理应当让客户端看到不完整的流
+            ok = first is not None and b"[DONE]" in tail
+    except Exception:
+        return False, None, time.perf_counter() - start, events
+    return ok, first, time.perf_counter() - start, events
+
+
+async def drive(url, body, concurrency, total, stream):
+    """concurrency 个协程共同完成 total 个请求, 返回 (结果列表, 墙钟秒数)"""
+    import httpx
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(300.0, connect=30.0)
+    results = []
+    remaining = [total]
+
+    headers = {"Content-Type": "application/json"}
+    async with httpx.AsyncClient(limits=limits, timeout=timeout, headers=headers) as client:
+        async def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                results.append(await one_request(client, url, body, stream))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r[0]]
+    ttfts = sorted(r[1] for r in ok if r[1] is not None)
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "failed": len(results) - len(ok),
+        "seconds": elapsed,
+        "rps": len(ok) / elapsed if elapsed else 0.0,
+        "ttft_p50": statistics.median(ttfts) if ttfts else None,
+        "ttft_p95": ttfts[int(len(ttfts) * 0.95) - 1] if ttfts else None,
+        "events": sum(r[3] for r in results),
+    }
+
+
+def mock_stats(port):
+    import httpx
+
+    return httpx.get(f"http://127.0.0.1:{port}/stats", timeout=10).json()
+
+
+def wait_ready(url, process, timeout=60):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{url} 对应的进程已退出 (退出码 {process.returncode})")
+        try:
+            httpx.get(url, timeout=2)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise SystemExit(f"等待 {url} 就绪超时")
+
+
+# 代理进程
+
+def proxy_command(variant, server, workers):
+    """(命令行, 工作目录, 额外环境变量)"""
+    cwd = os.path.join(ROOT, variant)
+    if server == "asgi":
+        if variant != "linux":
+            raise SystemExit("只有 linux 版本提供 ASGI 入口")
+        return [sys.executable, "asgi_app.py"], cwd, {"ASGI_WORKERS": str(workers)}
+    if server == "gunicorn":
+        env = {"WEB_WORKERS": str(workers), "MAX_REQUESTS": "0"}
+        if variant == "linux":
+            return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"], cwd, env
+        return [sys.executable, "app.py"], cwd, env
+    return [sys.executable, "app.py"], cwd, {"DEV_SERVER": "1"}
+
+
+def start(command, cwd, env, log):
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+def stop(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def fmt_ms(value):
+    return f"{value * 1000:8.1f} ms" if value is not None else "       - ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="代理压测 (本地模拟上游)")
+    parser.add_argument("--variant", choices=("linux", "win"), default="linux")
+    parser.add_argument("--server", choices=("dev", "gunicorn", "asgi"), default="dev",
+                        help="dev: Flask 开发服务器; gunicorn: 生产配置; asgi: linux/asgi_app.py")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn / uvicorn worker 数")
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--model", default="deepseek-ai/DeepSeek-R1")
+    parser.add_argument("--mock-port", type=int, default=18800)
+    parser.add_argument("--port", type=int, default=18805, help="代理监听端口")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给代理的环境变量")
+    parser.add_argument("--log", default=os.devnull, help="代理与模拟上游的输出写入的文件")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    body = json.dumps({"model": args.model, "stream": args.stream,
+                       "messages": [{"role": "user", "content": "hi"}]}).encode()
+    log = open(args.log, "ab")
+    mock = start([sys.executable, os.path.join(BENCH_DIR, "mock_chutes.py"), "--port", str(args.mock_port)]
+                 + mock_argv(args), BENCH_DIR, os.environ.copy(), log)
+    proxy = None
+    try:
+        mock_url = f"http://127.0.0.1:{args.mock_port}"
+        wait_ready(mock_url + "/stats", mock)
+
+        # 基准: 直接请求模拟上游
+        results, elapsed = asyncio.run(drive(
+            mock_url + "/app/api/chat", body, args.concurrency, args.requests, args.stream))
+        direct = summarize(results, elapsed)
+
+        command, cwd, extra = proxy_command(args.variant, args.server, args.workers)
+        env = dict(os.environ, PORT=str(args.port), CHUTES_BASE_URL=mock_url, **extra)
+        env.pop("AUTH_TOKEN", None)
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        proxy = start(command, cwd, env, log)
+        proxy_url = f"http://127.0.0.1:{args.port}"
+        wait_ready(proxy_url + "/", proxy)
+        # 预热: 建立上游连接、完成首次导入
+        asyncio.run(drive(proxy_url + "/v1/chat/completions", body, min(args.concurrency, 4), 8, args.stream))
+
+        time.sleep(0.5)
+        idle_rss, cpu_before = tree_usage(proxy.pid)
+        upstream_before = mock_stats(args.mock_port)
+        sampler = Sampler(proxy.pid)
+        sampler.start()
+        results, elapsed = asyncio.run(drive(
+            proxy_url + "/v1/chat/completions", body, args.concurrency, args.requests, args.stream))
+        sampler.stop()
+        _, cpu_after = tree_usage(proxy.pid)
+        upstream_after = mock_stats(args.mock_port)
+        proxied = summarize(results, elapsed)
+    finally:
+        if proxy is not None:
+            stop(proxy)
+        stop(mock)
+        log.close()
+
+    upstream = {key: upstream_after[key] - upstream_before[key] for key in upstream_before if key != "active"}
+    tokens = upstream["tokens"]
+    cpu = cpu_after - cpu_before
+    report = {
+        "variant": args.variant,
+        "server": args.server,
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "direct": direct,
+        "proxy": proxied,
+        "upstream": upstream,
+        "ttft_overhead_p50": (proxied["ttft_p50"] - direct["ttft_p50"])
+        if proxied["ttft_p50"] is not None and direct["ttft_p50"] is not None else None,
+        "ttft_overhead_p95": (proxied["ttft_p95"] - direct["ttft_p95"])
+        if proxied["ttft_p95"] is not None and direct["ttft_p95"] is not None else None,
+        "idle_rss": idle_rss,
+        "peak_rss": sampler.peak,
+        "rss_per_stream": max(sampler.peak - idle_rss, 0) / args.concurrency,
+        "cpu_seconds": cpu,
+        "cpu_per_token_us": cpu / tokens * 1e6 if tokens else None,
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    mode = "流式" if args.stream else "非流式"
+    print(f"{args.variant} / {args.server} (worker {args.workers}), {mode}, 并发 {args.concurrency}, "
+          f"请求 {args.requests}")
+    print(f"  直连模拟上游  {direct['rps']:8.1f} req/s  首字 p50 {fmt_ms(direct['ttft_p50'])}  "
+          f"p95 {fmt_ms(direct['ttft_p95'])}  失败 {direct['failed']}")
+    print(f"  经过代理      {proxied['rps']:8.1f} req/s  首字 p50 {fmt_ms(proxied['ttft_p50'])}  "
+          f"p95 {fmt_ms(proxied['ttft_p95'])}  失败 {proxied['failed']}")
+    print(f"  附加首字延迟  p50 {fmt_ms(report['ttft_overhead_p50'])}  p95 {fmt_ms(report['ttft_overhead_p95'])}")
+    print(f"  内存          空闲 {idle_rss / 2**20:.1f} MiB, 峰值 {sampler.peak / 2**20:.1f} MiB, "
+          f"{report['rss_per_stream'] / 1024:.1f} KiB/流")
+    per_token = report["cpu_per_token_us"]
+    print(f"  CPU           {cpu:.2f} s, {per_token:.1f} µs/token ({tokens} 个上游 token)" if per_token is not None
+          else f"  CPU           {cpu:.2f} s")
+    print(f"  上游          请求 {upstream['requests']}, 403 {upstream['forbidden']}, 500 {upstream['errors']}, "
+          f"中途断开 {upstream['aborted']}, 客户端取消 {upstream['cancelled']}")
+
+
+if __name__ == '__main__':
+    main()
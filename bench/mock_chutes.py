@@ -0,0 +1,363 @@
+"""模拟 Chutes 上游: 本地 SSE 服务, 用于压测与基准
+
+- POST /app/api/chat: 按配置的 token 数、速率、大小与抖动输出 SSE 流, 同时支持 HTTP/1.1 (chunked) 与 h2c
+- 按比例注入 500、403 (代理会刷新 cf_clearance 后重试) 与流中途断开
+- GET /: 设置 cf_clearance cookie, 供代理的 403 刷新流程使用
+- GET /stats: 请求数、各类注入次数与已发送的 token 数 (JSON)
+- --replay: 回放 bench/capture.py 抓取的真实上游响应, 保留原始分块与时间间隔
+
+用法: python bench/mock_chutes.py [--port 18800] [--tokens 200] [--rate 50] [--ttft 0.2] ...
+代理指向模拟服务: CHUTES_BASE_URL=http://127.0.0.1:18800
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import uuid
+
+from common import WORDS, synthetic_tokens, upstream_event
+
+DONE_EVENT = b"data: [DONE]\n\n"
+
+
+class Abort(Exception):
+    """注入的流中途断开"""
+
+
+def make_tokens(count, chars=0, seed=0):
+    """count 个模拟 token; chars > 0 时每个 token 由随机词拼接到固定的字符数"""
+    tokens = synthetic_tokens(count, seed)
+    if chars <= 0:
+        return tokens
+    rng = random.Random(seed)
+    sized = []
+    for token in tokens:
+        while len(token) < chars:
+            token += rng.choice(WORDS)
+        sized.append(token[:chars])
+    return sized
+
+
+def load_captures(path):
+    """读取抓取文件 (或目录下所有 .jsonl), 每个响应为 [(相对请求开始的秒数, 原始数据块), ...]"""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl"))
+    else:
+        files = [path]
+    captures = []
+    for name in files:
+        chunks = []
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if "chunk" in record:
+                    chunks.append((float(record["t"]), base64.b64decode(record["chunk"])))
+        if chunks:
+            captures.append(chunks)
+    if not captures:
+        raise SystemExit(f"{path} 中没有可回放的响应")
+    return captures
+
+
+class MockChutes:
+    """模拟上游的行为配置与统计"""
+
+    def __init__(self, tokens=200, rate=50.0, token_chars=0, ttft=0.0, jitter=0.0, error_rate=0.0,
+                 forbidden_rate=0.0, abort_rate=0.0, replay=None, speed=1.0, seed=0):
+        self.tokens = make_tokens(tokens, token_chars, seed)
+        # 0 表示不限速
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.ttft = ttft
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.forbidden_rate = forbidden_rate
+        self.abort_rate = abort_rate
+        self.captures = load_captures(replay) if replay else None
+        self.speed = speed
+        self.rng = random.Random(seed)
+        self.replayed = 0
+        self.stats = {"requests": 0, "streams": 0, "active": 0, "errors": 0, "forbidden": 0,
+                      "aborted": 0, "cancelled": 0, "tokens": 0, "bytes": 0}
+
+    def respond(self, method, path):
+        """返回 (状态码, 响应头, 响应体); 响应体为 None 时调用 stream 输出 SSE"""
+        if method == "GET" and path == "/stats":
+            return 200, [("content-type", "application/json")], json.dumps(self.stats).encode()
+        if method == "GET":
+            # cf_clearance 刷新
+            cookie = f"cf_clearance={uuid.uuid4().hex}; Path=/; HttpOnly"
+            return 200, [("content-type", "text/html"), ("set-cookie", cookie)], b"<html>mock chutes</html>"
+        self.stats["requests"] += 1
+        roll = self.rng.random()
+        if roll < self.forbidden_rate:
+            self.stats["forbidden"] += 1
+            return 403, [("content-type", "text/plain")], b"Forbidden: cf_clearance expired"
+        if roll < self.forbidden_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return 500, [("content-type", "text/plain")], b"Internal Server Error"
+        return 200, [("content-type", "text/event-stream"), ("cache-control", "no-cache")], None
+
+    async def stream(self, write):
+        """输出一个 SSE 响应; 注入断开时在中途抛出 Abort"""
+        stats = self.stats
+        stats["streams"] += 1
+        stats["active"] += 1
+        try:
+            if self.captures is not None:
+                await self._replay(write)
+            else:
+                await self._synthetic(write)
+        except (asyncio.CancelledError, ConnectionError):
+            # 客户端 (代理) 中途断开
+            stats["cancelled"] += 1
+            raise
+        finally:
+            stats["active"] -= 1
+
+    async def _synthetic(self, write):
+        stats = self.stats
+        abort_at = len(self.tokens) // 2 if self.rng.random() < self.abort_rate else -1
+        if self.ttft > 0:
+            await asyncio.sleep(self.ttft)
+        for index, token in enumerate(self.tokens):
+            if index == abort_at:
+                stats["aborted"] += 1
+                raise Abort()
+            if index and self.interval:
+                delay = self.interval
+                if self.jitter:
+                    delay *= 1 + self.rng.uniform(-self.jitter, self.jitter)
+                await asyncio.sleep(max(delay, 0.0))
+            data = upstream_event(token)
+            await write(data)
+            stats["tokens"] += 1
+            stats["bytes"] += len(data)
+        await write(DONE_EVENT)
+
+    async def _replay(self, write):
+        stats = self.stats
+        chunks = self.captures[self.replayed % len(self.captures)]
+        self.replayed += 1
+        abort_at = len(chunks) // 2 if self.rng.random() < self.abort_rate else -1
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for index, (offset, data) in enumerate(chunks):
+            if index == abort_at:
+                stats["aborted"] += 1
+                raise Abort()
+            if self.speed > 0:
+                delay = start + offset / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await write(data)
+            stats["tokens"] += data.count(b"data:") - data.count(b"[DONE]")
+            stats["bytes"] += len(data)
+
+
+# HTTP/1.1 与 h2c
+
+_REQUEST_LINE = re.compile(rb"^([A-Z]+) (\S+)")
+
+
+async def _serve_http1(mock, reader, writer, head):
+    while True:
+        while b"\r\n\r\n" not in head:
+            data = await reader.read(65536)
+            if not data:
+                return
+            head += data
+        header, _, rest = head.partition(b"\r\n\r\n")
+        lines = header.split(b"\r\n")
+        match = _REQUEST_LINE.match(lines[0])
+        method, path = (match.group(1).decode(), match.group(2).decode()) if match else ("GET", "/")
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+        while len(rest) < length:
+            data = await reader.read(65536)
+            if not data:
+                return
+            rest += data
+        head = rest[length:]
+
+        status, headers, body = mock.respond(method, path.split("?")[0])
+        reason = {200: "OK", 403: "Forbidden", 500: "Internal Server Error"}.get(status, "")
+        lines = [f"HTTP/1.1 {status} {reason}"] + [f"{name}: {value}" for name, value in headers]
+        if body is not None:
+            lines.append(f"content-length: {len(body)}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+            continue
+        lines.append("transfer-encoding: chunked")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+        async def write(data):
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+            await writer.drain()
+
+        try:
+            await mock.stream(write)
+        except Abort:
+            # 不发送结束块直接断开, 客户端看到不完整的 chunked 响应
+            return
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def _serve_h2(mock, reader, writer, head):
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.settings
+
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding=None))
+    conn.local_settings = h2.settings.Settings(client=False, initial_values={
+        h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 256
+    })
+    conn.initiate_connection()
+    windows = {}
+    tasks = {}
+    requests = {}
+
+    async def flush():
+        data = conn.data_to_send()
+        if data:
+            writer.write(data)
+            await writer.drain()
+
+    async def respond(stream_id, method, path):
+        status, headers, body = mock.respond(method, path)
+        response_headers = [(b":status", str(status).encode())] + [
+            (name.encode(), value.encode()) for name, value in headers]
+        if body is not None:
+            conn.send_headers(stream_id, response_headers + [(b"content-length", str(len(body)).encode())])
+            conn.send_data(stream_id, body, end_stream=True)
+            await flush()
+            return
+        conn.send_headers(stream_id, response_headers)
+        await flush()
+
+        async def write(data):
+            # 遵守客户端的流量控制窗口
+            while data:
+                window = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+                if window <= 0:
+                    windows[stream_id].clear()
+                    await windows[stream_id].wait()
+                    continue
+                conn.send_data(stream_id, data[:window])
+                data = data[window:]
+            await flush()
+
+        try:
+            await mock.stream(write)
+        except Abort:
+            conn.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+        else:
+            conn.end_stream(stream_id)
+        await flush()
+        windows.pop(stream_id, None)
+        tasks.pop(stream_id, None)
+
+    data = head
+    while data:
+        for event in conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                fields = dict(event.headers)
+                requests[event.stream_id] = (fields.get(b":method", b"GET").decode(),
+                                             fields.get(b":path", b"/").decode().split("?")[0])
+            elif isinstance(event, h2.events.DataReceived):
+                conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                method, path = requests.pop(event.stream_id, ("GET", "/"))
+                windows[event.stream_id] = asyncio.Event()
+                tasks[event.stream_id] = asyncio.ensure_future(respond(event.stream_id, method, path))
+            elif isinstance(event, h2.events.StreamReset):
+                task = tasks.pop(event.stream_id, None)
+                if task is not None:
+                    task.cancel()
+            elif isinstance(event, h2.events.WindowUpdated):
+                for stream_id, window in windows.items():
+                    if event.stream_id in (0, stream_id):
+                        window.set()
+        await flush()
+        data = await reader.read(65536)
+    for task in tasks.values():
+        task.cancel()
+
+
+async def _handle(mock, reader, writer):
+    try:
+        head = await reader.readexactly(24)
+        if head == b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n":
+            await _serve_h2(mock, reader, writer, head)
+        else:
+            await _serve_http1(mock, reader, writer, head)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def serve(mock, port, host="127.0.0.1"):
+    async def main():
+        server = await asyncio.start_server(
+            lambda reader, writer: _handle(mock, reader, writer), host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def add_arguments(parser):
+    """模拟服务的命令行参数, loadgen 复用同一组参数"""
+    group = parser.add_argument_group("模拟上游")
+    group.add_argument("--tokens", type=int, default=200, help="每个响应的 token 数")
+    group.add_argument("--rate", type=float, default=50.0, help="每个流每秒输出的 token 数, 0 表示不限速")
+    group.add_argument("--token-chars", type=int, default=0, help="每个 token 的字符数, 0 表示随机词")
+    group.add_argument("--ttft", type=float, default=0.2, help="首个 token 前的等待秒数")
+    group.add_argument("--jitter", type=float, default=0.0, help="token 间隔的随机抖动比例 (0-1)")
+    group.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    group.add_argument("--forbidden-rate", type=float, default=0.0, help="返回 403 的比例")
+    group.add_argument("--abort-rate", type=float, default=0.0, help="流输出一半时断开的比例")
+    group.add_argument("--replay", help="回放 capture.py 抓取的文件或目录, 代替合成的 token 流")
+    group.add_argument("--speed", type=float, default=1.0, help="回放速度倍数, 0 表示不等待")
+    group.add_argument("--seed", type=int, default=0)
+    return group
+
+
+MOCK_OPTIONS = ("tokens", "rate", "token_chars", "ttft", "jitter", "error_rate", "forbidden_rate",
+                "abort_rate", "replay", "speed", "seed")
+
+
+def mock_argv(args):
+    """把解析后的参数还原为命令行, 用于启动模拟服务子进程"""
+    argv = []
+    for name in MOCK_OPTIONS:
+        value = getattr(args, name)
+        if value is not None:
+            argv += ["--" + name.replace("_", "-"), str(value)]
+    return argv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟 Chutes 上游 SSE 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18800)
+    add_arguments(parser)
+    args = parser.parse_args()
+    mock = MockChutes(**{name: getattr(args, name) for name in MOCK_OPTIONS})
+    serve(mock, args.port, args.host)
+
+
+if __name__ == '__main__':
+    main()
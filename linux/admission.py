@@ -0,0 +1,228 @@
+"""按模型 (chuteName) 的准入控制
+
+- 每个 chute 有最大并发数, 超出后进入有界等待队列, 队列中按 API key 的优先级出队, 同优先级先到先得
+- 队列已满立即返回 429, 等待超过期限返回 503, 两者都带按平均占用时长估算的 Retry-After
+- 同步 (线程) 与异步 (asyncio) 调用方共用同一套状态, 释放名额时直接交给下一个等待者
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+class Rejected(Exception):
+    """请求未被准入"""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """占用的并发名额, release() 可重复调用"""
+
+    __slots__ = ('_controller', '_state', '_acquired', 'waited', 'released')
+
+    def __init__(self, controller, state, waited):
+        self._controller = controller
+        self._state = state
+        self._acquired = time.monotonic()
+        self.waited = waited
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._controller._release(self._state, time.monotonic() - self._acquired)
+
+
+class _Waiter:
+    __slots__ = ('granted', 'cancelled', '_event', '_loop', '_future')
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.cancelled = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+            self._future = None
+        else:
+            self._event = None
+            self._future = loop.create_future()
+
+    def wake(self):
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._set_result)
+
+    def _set_result(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+
+class _ChuteState:
+    __slots__ = ('name', 'limit', 'active', 'waiters', 'avg_hold', 'stats')
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        # 名额平均占用时长 (秒), 用于估算 Retry-After
+        self.avg_hold = 1.0
+        self.stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+
+class AdmissionController:
+    """按 chute 限制并发的准入控制器"""
+
+    def __init__(self, max_concurrency, max_queue=64, queue_timeout=30.0, limits=None, priorities=None,
+                 observer=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.limits = dict(limits or {})
+        self.priorities = dict(priorities or {})
+        # observer(event, chute, value): queued / dequeued / admitted / rejected 事件回调, 用于指标
+        self.observer = observer
+        self._states = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def priority(self, api_key):
+        return self.priorities.get(api_key, 0)
+
+    def acquire(self, chute, api_key=None, timeout=None):
+        """同步获取名额, 失败时抛出 Rejected"""
+        state, ticket, waiter, entry = self._enter(chute, api_key, None)
+        if ticket is not None:
+            return ticket
+        started = time.monotonic()
+        waiter._event.wait(self.queue_timeout if timeout is None else timeout)
+        return self._leave(state, waiter, entry, started)
+
+    async def acquire_async(self, chute, api_key=None, timeout=None):
+        """异步获取名额, 失败时抛出 Rejected"""
+        state, ticket, waiter, entry = self._enter(chute, api_key, asyncio.get_running_loop())
+        if ticket is not None:
+            return ticket
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter._future), self.queue_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # 客户端断开: 已拿到的名额立即归还
+            ticket = self._leave(state, waiter, entry, started, raise_on_timeout=False)
+            if ticket is not None:
+                ticket.release()
+            raise
+        return self._leave(state, waiter, entry, started)
+
+    def set_limits(self, limits):
+        """替换单独设置的并发数 (模型目录重新加载时), 已有的 chute 立即生效; 调高后排队中的请求按新上限出队"""
+        with self._lock:
+            self.limits = dict(limits)
+            for state in self._states.values():
+                state.limit = self.limits.get(state.name, self.max_concurrency)
+                while state.waiters and state.active < state.limit:
+                    _, _, waiter = heapq.heappop(state.waiters)
+                    self._notify("dequeued", state.name, None)
+                    waiter.granted = True
+                    waiter.wake()
+                    state.active += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: dict(state.stats, limit=state.limit, active=state.active, queued_now=len(state.waiters),
+                           avg_hold=round(state.avg_hold, 3))
+                for name, state in self._states.items()
+            }
+
+    def _state(self, chute):
+        state = self._states.get(chute)
+        if state is None:
+            state = self._states[chute] = _ChuteState(chute, self.limits.get(chute, self.max_concurrency))
+        return state
+
+    def _enter(self, chute, api_key, loop):
+        with self._lock:
+            state = self._state(chute)
+            if state.active < state.limit and not state.waiters:
+                state.active += 1
+                state.stats["admitted"] += 1
+                ticket = Ticket(self, state, 0.0)
+                self._notify("admitted", chute, 0.0)
+                return state, ticket, None, None
+            if len(state.waiters) >= self.max_queue:
+                state.stats["rejected_full"] += 1
+                retry_after = self._retry_after(state)
+                self._notify("rejected", chute, "queue_full")
+                raise Rejected(429, f"模型 {chute} 繁忙, 等待队列已满", retry_after)
+            waiter = _Waiter(loop)
+            entry = (-self.priority(api_key), next(self._seq), waiter)
+            heapq.heappush(state.waiters, entry)
+            state.stats["queued"] += 1
+            self._notify("queued", chute, None)
+            return state, None, waiter, entry
+
+    def _leave(self, state, waiter, entry, started, raise_on_timeout=True):
+        waited = time.monotonic() - started
+        with self._lock:
+            if not waiter.granted:
+                waiter.cancelled = True
+                state.waiters.remove(entry)
+                heapq.heapify(state.waiters)
+                state.stats["rejected_timeout"] += 1
+                retry_after = self._retry_after(state)
+                self._notify("dequeued", state.name, None)
+                self._notify("rejected", state.name, "timeout")
+                if not raise_on_timeout:
+                    return None
+                raise Rejected(503, f"模型 {state.name} 繁忙, 排队超时", retry_after)
+            state.stats["admitted"] += 1
+        self._notify("admitted", state.name, waited)
+        return Ticket(self, state, waited)
+
+    def _release(self, state, held):
+        with self._lock:
+            state.avg_hold += (held - state.avg_hold) * 0.2
+            while state.waiters:
+                _, _, waiter = heapq.heappop(state.waiters)
+                self._notify("dequeued", state.name, None)
+                # 名额直接转交给下一个等待者, active 不变
+                waiter.granted = True
+                waiter.wake()
+                return
+            state.active -= 1
+
+    def _retry_after(self, state):
+        """按平均占用时长与排队人数估算的重试等待秒数"""
+        estimate = state.avg_hold * (len(state.waiters) + 1) / max(state.limit, 1)
+        return max(1, min(60, math.ceil(estimate)))
+
+    def _notify(self, event, chute, value):
+        if self.observer is not None:
+            self.observer(event, chute, value)
+
+
+def parse_mapping(raw, cast=str):
+    """解析 "a=1,b=2" 或 "a:1,b:2" 格式的配置"""
+    result = {}
+    for item in (raw or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        for sep in ("=", ":"):
+            if sep in item:
+                name, value = item.rsplit(sep, 1)
+                result[name.strip()] = cast(value.strip())
+                break
+    return result
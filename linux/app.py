@@ -1,53 +1,263 @@
-from flask import Flask, request, Response, stream_with_context, jsonify
+from flask import Flask, request, Response, stream_with_context, jsonify, g, has_request_context
 import cloudscraper
-import json
 import uuid
 from datetime import datetime, timezone
 import time
 import os
+import tempfile
 import logging
+import threading
+import queue
+import contextvars
+from session_pool import SessionPool
+from sse import DONE, USAGE_KEY, iter_response_events, extract_content, extract_usage, usage_only
+from codec import DONE_FRAME, ChunkEncoder, FrameRewriter, TokenCoalescer, dumps
+from buffer import ContentBuffer
+from cache import ResponseCache, is_cacheable, cache_key
+from singleflight import SingleFlight
+import metrics as prom
+import tracing
+import profiler
+import logs
+from tracing import NULL_TRACE, Trace
+from admission import AdmissionController, Rejected, parse_mapping
+from breaker import BreakerRegistry, CircuitOpen, RetryBudget, backoff_delay
+import backends
+from backends import Backend, BackendRegistry, Route, Target
+from hedge import HedgePolicy, abort, prefetch, race
+from batch import BatchError, BatchRunner, BatchStore
+from context import ContextTrimmer
+from h2pool import H2Pool
+from usage import UsageLedger, UsageMeter, merge_usage, parse_price
+from catalog import etag_matches, load_catalog, models_response
+from fanout import Fanout, LegFailed
+from watchdog import CLIENT_DISCONNECT, StreamAbandoned, StreamWatchdog
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# 配置日志: 后台线程写出, 请求线程只入队 (见 logs.py)
+logs.setup()
 
 app = Flask(__name__)
 
-# 模型映射字典
-MODEL_MAPPING = {
-   "nvidia/Llama-3.1-405B-Instruct-FP8": "chutes-nvidia-llama-3-1-405b-instruct-fp8",
-   "deepseek-ai/DeepSeek-R1": "chutes-deepseek-ai-deepseek-r1",
-   "Qwen/Qwen2.5-72B-Instruct": "chutes-qwen-qwen2-5-72b-instruct", 
-   "Qwen/Qwen2.5-Coder-32B-Instruc": "chutes-qwen-qwen2-5-coder-32b-instruct",
-   "bytedance-research/UI-TARS-72B-DPO": "chutes-bytedance-research-ui-tars-72b-dpo",
-   "OpenGVLab/InternVL2_5-78B": "chutes-opengvlab-internvl2-5-78b",
-   "hugging-quants/Meta-Llama-3.1-70B-Instruct-AWQ-INT4": "chutes-hugging-quants-meta-llama-3-1-70b-instruct-awq-int4",
-   "NousResearch/Hermes-3-Llama-3.1-8B": "cxmplexbb-nousresearch-hermes-3-llama-3-1-8b",
-   "Qwen/QVQ-72B-Preview": "chutes-qwen-qvq-72b-preview",
-   "deepseek-ai/DeepSeek-R1-Distill-Qwen-32B": "chutes-deepseek-ai-deepseek-r1-distill-qwen-32b",
-   "jondurbin/bagel-8b-v1.0": "chutes-jondurbin-bagel-8b-v1-0",
-   "unsloth/QwQ-32B-Preview": "cxmplexbb-unsloth-qwq-32b-preview",
-   "Qwen/QwQ-32B-Preview": "chutes-qwq-32b-preview",
-   "jondurbin/airoboros-34b-3.3": "chutes-jondurbin-airoboros-34b-3-3",
-   "NovaSky-AI/Sky-T1-32B-Preview": "chutes-novasky-ai-sky-t1-32b-preview",
-   "driaforall/Dria-Agent-a-3B": "chutes-driaforall-dria-agent-a-3b",
-   "NousResearch/Nous-Hermes-Llama2-13b": "cxmplexbb-nousresearch-nous-hermes-llama2-13b",
-   "unsloth/Llama-3.2-1B-Instruct": "chutes-unsloth-llama-3-2-1b-instruct"
-}
+# 模型目录: 对外的模型名 (与别名) 到 chuteName 的映射及每个模型的设置, 来自 MODELS_FILE (默认同目录下的 models.json)
+# 或 MODELS_JSON; 文件修改后 MODELS_RELOAD_INTERVAL 秒内生效, 不需要重启 (见 catalog.py)
+model_catalog = load_catalog(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models.json'),
+    interval=float(os.getenv('MODELS_RELOAD_INTERVAL', 5))
+)
+
+def model_limits(mapping, field=None, catalog=None):
+    """环境变量中按模型名或 chuteName 设置的限制换算为 {chuteName: 值}; 目录中各模型的 field 设置优先"""
+    catalog = catalog or model_catalog.current()
+    limits = {}
+    for name, limit in mapping.items():
+        entry = catalog.lookup(name)
+        limits[entry.chute if entry is not None else name] = limit
+    if field is not None:
+        limits.update(catalog.setting(field))
+    return limits
+
+# 上游地址; 压测时可指向本地模拟服务 (bench/mock_chutes.py)
+CHUTES_BASE_URL = os.getenv('CHUTES_BASE_URL', 'https://chutes.ai').rstrip('/')
+# 上游聊天接口
+CHUTES_CHAT_URL = f"{CHUTES_BASE_URL}/app/api/chat"
+
+# 非流式响应的最大字节数, 超出后截断并返回 finish_reason=length (0 表示不限制)
+MAX_RESPONSE_BYTES = int(os.getenv('MAX_RESPONSE_BYTES', 8 * 1024 * 1024))
+
+# 流式响应合并窗口(毫秒)与合并字节数, 0 表示默认不合并; 可由请求的 stream_options 覆盖
+STREAM_COALESCE_MS = float(os.getenv('STREAM_COALESCE_MS', 0))
+STREAM_COALESCE_BYTES = int(os.getenv('STREAM_COALESCE_BYTES', 1024))
+# 透传模式: 流式响应原样转发上游的 data 帧, 只替换 id / model; 可由请求的 stream_options.passthrough 覆盖
+STREAM_PASSTHROUGH = os.getenv('STREAM_PASSTHROUGH', '0') == '1'
+
+# n > 1 时并发发起 n 路上游请求; 单个请求的 n 上限
+MAX_CHOICES = int(os.getenv('MAX_CHOICES', 8))
+
+# 响应缓存 (默认关闭): 只缓存 temperature=0 或声明 "cache": true 的请求
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '0') == '1'
+response_cache = ResponseCache(
+    max_bytes=int(os.getenv('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024)),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', 3600)),
+    disk_dir=os.getenv('RESPONSE_CACHE_DIR') or None,
+    disk_max_bytes=int(os.getenv('RESPONSE_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+) if RESPONSE_CACHE else None
+# 缓存回放时每帧的字符数
+CACHE_REPLAY_CHARS = 64
+
+# 相同请求单飞合并: off 关闭, deterministic 只合并可缓存的请求, all 合并所有相同请求
+SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', 'off')
+flights = SingleFlight() if SINGLE_FLIGHT in ('deterministic', 'all') else None
+
+# 指标: 多进程部署时各 worker 的快照写入 METRICS_DIR, 由 /metrics 合并
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'chutes2api_metrics'))
+METRICS_EXPORT_INTERVAL = float(os.getenv('METRICS_EXPORT_INTERVAL', 5))
+metrics = prom.Registry()
+_METRIC_LABELS = ('model', 'chute')
+catalog_reloads_total = metrics.counter(
+    'chutes_model_catalog_reloads_total', '模型目录重新加载次数: ok 成功, error 文件无效或无法读取 (继续使用原目录)',
+    ('result',))
+model_catalog.on_reload = lambda result: catalog_reloads_total.inc((result,))
+upstream_connect_seconds = metrics.histogram(
+    'chutes_upstream_connect_seconds', '发出上游请求到收到响应头的耗时', _METRIC_LABELS,
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+time_to_first_token_seconds = metrics.histogram(
+    'chutes_time_to_first_token_seconds', '收到请求到第一个内容增量的耗时 (含重试)', _METRIC_LABELS,
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+stream_duration_seconds = metrics.histogram(
+    'chutes_stream_duration_seconds', '收到请求到上游流结束的总耗时', _METRIC_LABELS,
+    (1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+tokens_per_second = metrics.histogram(
+    'chutes_tokens_per_second', '首个增量之后的输出速度 (按上游增量块计数)', _METRIC_LABELS,
+    (1, 5, 10, 20, 50, 100, 200, 500))
+upstream_attempts_total = metrics.counter(
+    'chutes_upstream_attempts_total', '按第几次尝试统计的上游请求数', _METRIC_LABELS + ('attempt',))
+upstream_responses_total = metrics.counter(
+    'chutes_upstream_responses_total', '按状态码统计的上游响应数, 连接异常记为 error', _METRIC_LABELS + ('status',))
+active_streams = metrics.gauge(
+    'chutes_active_streams', '正在读取的上游流', _METRIC_LABELS)
+abandoned_streams_total = metrics.counter(
+    'chutes_abandoned_streams_total', '中途放弃的上游流: client_disconnect 客户端断开, '
+    'first_byte_timeout / idle_timeout 上游超时', _METRIC_LABELS + ('reason',))
+
+# 上游超时 (秒, 0 为不限制): 建立连接; 发出请求到第一个 SSE 事件; 两个 SSE 事件之间 (心跳注释不算)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 10))
+UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.getenv('UPSTREAM_FIRST_BYTE_TIMEOUT', 120))
+UPSTREAM_IDLE_TIMEOUT = float(os.getenv('UPSTREAM_IDLE_TIMEOUT', 60))
+# socket 读超时只作兜底, 按事件计时的超时与客户端断开由看门狗每 STREAM_WATCHDOG_INTERVAL 秒检查一次
+UPSTREAM_READ_TIMEOUT = max(UPSTREAM_FIRST_BYTE_TIMEOUT, UPSTREAM_IDLE_TIMEOUT) or None
+stream_watchdog = StreamWatchdog(
+    UPSTREAM_FIRST_BYTE_TIMEOUT,
+    UPSTREAM_IDLE_TIMEOUT,
+    float(os.getenv('STREAM_WATCHDOG_INTERVAL', 1)),
+    on_abandon=lambda labels, reason: abandoned_streams_total.inc(labels + (reason,))
+)
+
+# 准入控制: 每个 chute 的最大并发数 (0 关闭), 超出后排队, 队列满返回 429, 排队超时返回 503
+ADMISSION_MAX_CONCURRENCY = int(os.getenv('ADMISSION_MAX_CONCURRENCY', 0))
+ADMISSION_MODEL_LIMITS = parse_mapping(os.getenv('ADMISSION_MODEL_LIMITS'), int)
+admission_queue_depth = metrics.gauge(
+    'chutes_admission_queue_depth', '准入控制等待队列长度', ('chute',))
+admission_wait_seconds = metrics.histogram(
+    'chutes_admission_wait_seconds', '获得并发名额前的排队时间', ('chute',),
+    (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30))
+admission_rejected_total = metrics.counter(
+    'chutes_admission_rejected_total', '未被准入的请求数', ('chute', 'reason'))
+
+def observe_admission(event, chute, value):
+    """准入控制事件写入指标"""
+    labels = (chute,)
+    if event == "queued":
+        admission_queue_depth.inc(labels)
+    elif event == "dequeued":
+        admission_queue_depth.dec(labels)
+    elif event == "admitted":
+        admission_wait_seconds.observe(labels, value)
+    elif event == "rejected":
+        admission_rejected_total.inc((chute, value))
+
+admission = AdmissionController(
+    ADMISSION_MAX_CONCURRENCY,
+    max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', 64)),
+    queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 30)),
+    # 单独设置的并发数, 可以用模型名或 chuteName: "nvidia/Llama-3.1-405B-Instruct-FP8=4,...";
+    # 模型目录中的 max_concurrency 优先
+    limits=model_limits(ADMISSION_MODEL_LIMITS, 'max_concurrency'),
+    # API key 优先级, 越大越先出队: "key1=10,key2=5"
+    priorities=parse_mapping(os.getenv('ADMISSION_PRIORITIES'), int),
+    observer=observe_admission
+) if ADMISSION_MAX_CONCURRENCY > 0 else None
+
+# 每个 chute 的熔断器: 最近 BREAKER_WINDOW 次调用中错误率或慢调用比例超过阈值后打开 BREAKER_OPEN_SECONDS 秒
+circuit_transitions_total = metrics.counter(
+    'chutes_circuit_transitions_total', '熔断器状态切换次数', ('chute', 'state'))
+retry_budget_exhausted_total = metrics.counter(
+    'chutes_retry_budget_exhausted_total', '因重试预算用完而放弃的重试', ('chute',))
+breakers = BreakerRegistry(
+    window=int(os.getenv('BREAKER_WINDOW', 20)),
+    min_calls=int(os.getenv('BREAKER_MIN_CALLS', 10)),
+    error_rate=float(os.getenv('BREAKER_ERROR_RATE', 0.5)),
+    slow_seconds=float(os.getenv('BREAKER_SLOW_SECONDS', 30)),
+    slow_rate=float(os.getenv('BREAKER_SLOW_RATE', 0.8)),
+    open_seconds=float(os.getenv('BREAKER_OPEN_SECONDS', 30)),
+    on_transition=lambda chute, state: circuit_transitions_total.inc((chute, state))
+) if os.getenv('CIRCUIT_BREAKER', '1') == '1' else None
+# 所有请求共享的重试预算: 每个请求存入 RETRY_BUDGET_RATIO 次重试, 另外每秒补充 RETRY_BUDGET_MIN_PER_SECOND 次
+retry_budget = RetryBudget(
+    ratio=float(os.getenv('RETRY_BUDGET_RATIO', 0.2)),
+    min_per_second=float(os.getenv('RETRY_BUDGET_MIN_PER_SECOND', 1)),
+    max_tokens=float(os.getenv('RETRY_BUDGET_MAX', 10))
+)
+# 重试退避: 第 n 次重试前等待 [0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2^n)] 内的随机时长
+RETRY_BACKOFF_BASE = float(os.getenv('RETRY_BACKOFF_BASE', 0.5))
+RETRY_BACKOFF_CAP = float(os.getenv('RETRY_BACKOFF_CAP', 4))
+
+# 上下文裁剪: 转发完整的对话历史, 超过 CONTEXT_MAX_TOKENS (减去 max_tokens 或 CONTEXT_RESERVE_TOKENS) 时省略较早的消息
+context_trimmed_total = metrics.counter(
+    'chutes_context_trimmed_messages_total', '超出上下文预算而省略的消息数', ('chute',))
+CONTEXT_MODEL_LIMITS = parse_mapping(os.getenv('CONTEXT_MODEL_LIMITS'), int)
+context_trimmer = ContextTrimmer(
+    int(os.getenv('CONTEXT_MAX_TOKENS', 60000)),
+    # 单独设置的上下文长度, 可以用模型名或 chuteName; 模型目录中的 context_tokens 优先
+    limits=model_limits(CONTEXT_MODEL_LIMITS, 'context_tokens'),
+    reserve_tokens=int(os.getenv('CONTEXT_RESERVE_TOKENS', 4096))
+)
+
+# 用量统计: 按租户 (API key) 与模型累计; USAGE_PRICES 为每百万 token 的 "输入价格:输出价格", USAGE_TENANTS 为 API key 到租户名的映射
+# 模型名与其他指标一致 (别名计入对应的模型, 未知模型为 other); 未命名的 key 超过 USAGE_MAX_TENANTS 个之后计入 other
+usage_ledger = UsageLedger(
+    metrics,
+    prices=parse_mapping(os.getenv('USAGE_PRICES'), parse_price),
+    tenants=parse_mapping(os.getenv('USAGE_TENANTS')),
+    model_label=lambda model: metric_labels(model, None)[0],
+    max_tenants=int(os.getenv('USAGE_MAX_TENANTS', 1000))
+)
+
+# 对冲请求: HEDGE_DELAY_MS 毫秒 (或 "p95" 这样按最近首字节延迟估算) 内没有收到首个数据块时再发一次请求,
+# 对冲次数不超过请求数的 HEDGE_BUDGET_RATIO; 为空时关闭
+HEDGE_DELAY_MS = os.getenv('HEDGE_DELAY_MS', '')
+hedges_total = metrics.counter(
+    'chutes_hedges_total', '对冲请求数: started 发起, won 对冲请求胜出, lost 原请求胜出, budget_exhausted 预算不足未发起',
+    ('chute', 'result'))
+hedging = HedgePolicy(
+    HEDGE_DELAY_MS if HEDGE_DELAY_MS.lower().startswith('p') else float(HEDGE_DELAY_MS) / 1000,
+    RetryBudget(
+        ratio=float(os.getenv('HEDGE_BUDGET_RATIO', 0.05)),
+        min_per_second=0,
+        max_tokens=float(os.getenv('HEDGE_BUDGET_MAX', 10))
+    ),
+    min_delay=float(os.getenv('HEDGE_MIN_DELAY_MS', 50)) / 1000
+) if HEDGE_DELAY_MS else None
+
+# 管理接口 (/admin/*) 的 key, 为空时管理接口关闭
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))
 
 # 存储当前的 cf_clearance 和 key
 current_cf_clearance = None
 auth_token = os.getenv('AUTH_TOKEN', '')  # 从环境变量获取 AUTH_TOKEN
 
-def check_auth():
-    """检查认证"""
-    request_token = request.headers.get('Authorization', '')
+def check_auth_header(request_token):
+    """校验 Authorization 头"""
     if not auth_token:
         return True
     return request_token == f"Bearer {auth_token}"
 
+def check_admin_header(request_token):
+    """校验管理接口的 Authorization 头"""
+    return bool(ADMIN_TOKEN) and request_token == f"Bearer {ADMIN_TOKEN}"
+
+def request_api_key(authorization):
+    """从 Authorization 头取出 API key"""
+    return authorization[7:] if authorization.startswith("Bearer ") else authorization
+
+def rejected_response(rejected):
+    """准入失败的快速响应"""
+    return Response(rejected.reason, status=rejected.status, headers={"Retry-After": str(rejected.retry_after)})
+
+def check_auth():
+    """检查认证"""
+    return check_auth_header(request.headers.get('Authorization', ''))
+
 def get_new_cf_clearance():
     """动态获取新的 cf_clearance"""
     try:
@@ -77,22 +287,40 @@ def get_new_cf_clearance():
             })
             
         logging.info("尝试获取新的 cf_clearance")
-        response = temp_scraper.get('https://chutes.ai')
+        response = temp_scraper.get(CHUTES_BASE_URL)
         
         if 'cf_clearance' in temp_scraper.cookies:
             new_cf = temp_scraper.cookies['cf_clearance']
-            logging.info(f"成功获取新的 cf_clearance: {new_cf[:10]}...")
+            logging.info("成功获取新的 cf_clearance: %s...", new_cf[:10])
             return new_cf
         logging.warning("未能获取 cf_clearance")
         return None
     except Exception as e:
-        logging.error(f"获取新的 cf_clearance 失败: {str(e)}")
+        logging.error("获取新的 cf_clearance 失败: %s", e)
         return None
 
-def create_scraper(cf_clearance=None):
-    """创建配置好的 scraper"""
-    global current_cf_clearance
-    
+# 上游基础请求头
+UPSTREAM_HEADERS = {
+    "Accept": "text/event-stream",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Cache-Control": "no-cache",
+    "Content-Type": "application/json",
+    "Origin": "https://chutes.ai",
+    "Pragma": "no-cache",
+    "Referer": "https://chutes.ai/",
+    "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Microsoft Edge";v="122"',
+    "Sec-Ch-Ua-Mobile": "?0",
+    "Sec-Ch-Ua-Platform": '"Windows"',
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
+    "X-Requested-With": "XMLHttpRequest"
+}
+
+def build_scraper():
+    """创建带基础请求头的 scraper (不含认证信息)"""
     scraper = cloudscraper.create_scraper(
         browser={
             'browser': 'firefox',
@@ -105,64 +333,460 @@ def create_scraper(cf_clearance=None):
     )
     
     # 基础请求头配置
-    scraper.headers.update({
-        "Accept": "text/event-stream",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Cache-Control": "no-cache",
-        "Content-Type": "application/json",
-        "Origin": "https://chutes.ai",
-        "Pragma": "no-cache",
-        "Referer": "https://chutes.ai/",
-        "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Microsoft Edge";v="122"',
-        "Sec-Ch-Ua-Mobile": "?0",
-        "Sec-Ch-Ua-Platform": '"Windows"',
-        "Sec-Fetch-Dest": "empty",
-        "Sec-Fetch-Mode": "cors",
-        "Sec-Fetch-Site": "same-origin",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0",
-        "X-Requested-With": "XMLHttpRequest"
-    })
+    scraper.headers.update(UPSTREAM_HEADERS)
     
+    return scraper
+
+def build_auth_header(cf_value):
+    """构造上游 Authorization 头"""
+    if auth_token:
+        return f"Bearer {auth_token}|||{cf_value}"
+    # 如果没有 auth_token，只使用 cf_clearance
+    return f"Bearer {cf_value}"
+
+def apply_auth(scraper, cf_clearance=None):
+    """将当前的 cf_clearance 和认证信息应用到 scraper 上"""
     # 使用提供的或当前的 cf_clearance
     cf_value = cf_clearance or current_cf_clearance
     if cf_value:
         scraper.cookies.update({
             "cf_clearance": cf_value
         })
-        # 构造 Authorization 头
-        if auth_token:
-            scraper.headers.update({
-                "Authorization": f"Bearer {auth_token}|||{cf_value}"
-            })
-        else:
-            # 如果没有 auth_token，只使用 cf_clearance
-            scraper.headers.update({
-                "Authorization": f"Bearer {cf_value}"
-            })
+        scraper.headers.update({
+            "Authorization": build_auth_header(cf_value)
+        })
+    else:
+        scraper.headers.pop("Authorization", None)
     
     return scraper
 
-def create_chutes_request(openai_request):
-    """将OpenAI格式请求转换为Chutes格式"""
-    messages = openai_request['messages']
-    message_id = str(uuid.uuid4())
-    current_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-    
+def create_scraper(cf_clearance=None):
+    """创建配置好的 scraper"""
+    return apply_auth(build_scraper(), cf_clearance)
+
+def create_session_pool():
+    """创建上游会话池: 复用 scraper 及其 keep-alive 连接, cf_clearance 变化时原地重新配置"""
+    return SessionPool(
+        build_scraper,
+        configure=apply_auth,
+        max_size=int(os.getenv('SESSION_POOL_SIZE', 16)),
+        idle_timeout=float(os.getenv('SESSION_IDLE_TIMEOUT', 300)),
+        max_age=float(os.getenv('SESSION_MAX_AGE', 1800))
+    )
+
+session_pool = create_session_pool()
+
+# 上游传输: http1 (默认) 使用 cloudscraper 会话池, 每个并发流占用一个连接;
+# http2 经 httpx 在最多 H2_MAX_CONNECTIONS 个 HTTP/2 连接上多路复用 (需要 h2), 遇到 Cloudflare 质询时改走会话池
+UPSTREAM_TRANSPORT = os.getenv('UPSTREAM_TRANSPORT', 'http1')
+# httpx 默认不解 br, 去掉该编码
+H2_UPSTREAM_HEADERS = dict(UPSTREAM_HEADERS, **{"Accept-Encoding": "gzip, deflate"})
+_h2_pool = None
+_h2_pool_lock = threading.Lock()
+
+def get_h2_pool():
+    """当前进程的 HTTP/2 连接池, 首次使用时创建 (预加载时主进程不建立连接)"""
+    global _h2_pool
+    if _h2_pool is None:
+        with _h2_pool_lock:
+            if _h2_pool is None:
+                _h2_pool = H2Pool(
+                    headers=H2_UPSTREAM_HEADERS,
+                    max_connections=int(os.getenv('H2_MAX_CONNECTIONS', 4)),
+                    acquire_timeout=float(os.getenv('H2_ACQUIRE_TIMEOUT', 30)),
+                    connect_timeout=UPSTREAM_CONNECT_TIMEOUT or None,
+                    response_timeout=UPSTREAM_READ_TIMEOUT
+                )
+    return _h2_pool
+
+def cloudflare_challenge(response):
+    """响应是否为 Cloudflare 质询页 (需要 cloudscraper 处理)"""
+    return response.status_code in (403, 429, 503) and response.headers.get('cf-mitigated') == 'challenge'
+
+def upstream_auth():
+    """按当前 cf_clearance 构造上游认证用的 (请求头, cookies)"""
+    headers = {}
+    cookies = {}
+    cf_value = current_cf_clearance
+    if cf_value:
+        headers["Authorization"] = build_auth_header(cf_value)
+        cookies["cf_clearance"] = cf_value
+    return headers, cookies
+
+# 多进程部署时 cf_clearance 通过文件在 worker 之间共享
+CF_STATE_FILE = os.getenv('CF_STATE_FILE', os.path.join(tempfile.gettempdir(), 'chutes2api_cf_clearance'))
+_cf_state_mtime = None
+_cf_state_checked = 0.0
+
+def set_cf_clearance(value):
+    """更新 cf_clearance 并同步给其他 worker"""
+    global current_cf_clearance, _cf_state_mtime
+    current_cf_clearance = value
+    session_pool.refresh()
+    try:
+        tmp_path = f"{CF_STATE_FILE}.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            f.write(value)
+        os.replace(tmp_path, CF_STATE_FILE)
+        _cf_state_mtime = os.stat(CF_STATE_FILE).st_mtime_ns
+    except OSError as e:
+        logging.warning("写入共享 cf_clearance 失败: %s", e)
+
+def sync_cf_clearance():
+    """读取其他 worker 更新的 cf_clearance (每秒最多检查一次)"""
+    global current_cf_clearance, _cf_state_mtime, _cf_state_checked
+    now = time.monotonic()
+    if now - _cf_state_checked < 1:
+        return
+    _cf_state_checked = now
+    try:
+        mtime = os.stat(CF_STATE_FILE).st_mtime_ns
+        if mtime == _cf_state_mtime:
+            return
+        with open(CF_STATE_FILE) as f:
+            value = f.read().strip()
+    except OSError:
+        return
+    _cf_state_mtime = mtime
+    if value and value != current_cf_clearance:
+        current_cf_clearance = value
+        session_pool.refresh()
+        logging.info("已同步其他 worker 更新的 cf_clearance")
+
+def reset_after_fork():
+    """worker fork 之后重置进程内状态, 不与主进程共享连接"""
+    global session_pool, _h2_pool, _cf_state_checked
+    session_pool = create_session_pool()
+    # 继承的连接与 I/O 线程在子进程中不可用, 直接丢弃
+    _h2_pool = None
+    backend_registry.reset()
+    _cf_state_checked = 0.0
+    sync_cf_clearance()
+    metrics.reset()
+    metrics.start_exporter(METRICS_DIR, METRICS_EXPORT_INTERVAL)
+    tracing.reset_after_fork()
+    # 每个 worker 都扫描未完成的批处理, 由文件锁决定谁来执行
+    batch_runner.reset()
+    batch_runner.start()
+
+def release_response(response, discard=False):
+    """关闭上游响应并将其会话归还所属的会话池"""
+    try:
+        response.close()
+    except Exception:
+        discard = True
+    session = getattr(response, 'pooled_session', None)
+    if session is not None:
+        response.pooled_session = None
+        getattr(response, 'session_pool', session_pool).release(session, discard=discard)
+
+def resolve_chute(model):
+    """模型对应的 chuteName, 未知模型回退到 DeepSeek-R1"""
+    return model_catalog.current().chute(model)
+
+def validate_request(openai_request):
+    """检查 messages 的格式, 不符合时抛出 ValueError; 在缓存、准入与上游请求之前调用, 无效请求直接返回 400"""
+    messages = openai_request.get('messages')
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("messages 必须是非空数组")
+    for i, message in enumerate(messages):
+        if not isinstance(message, dict) or not isinstance(message.get('role'), str):
+            raise ValueError(f"messages[{i}] 需要包含字符串 role")
+        if 'content' not in message or not isinstance(message['content'], (str, list, type(None))):
+            raise ValueError(f"messages[{i}] 需要包含 content (字符串或数组)")
+
+def trim_context(openai_request):
+    """超出上下文预算时裁剪较早的消息并计入指标, 返回裁剪后的请求 (不修改原请求)
+
+    每个请求在入口处调用一次, 缓存键、重试、对冲与 n > 1 的各路都使用裁剪后的请求; 路由中没有 chutes 目标时原样返回。
+    """
     model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
-    chute_name = MODEL_MAPPING.get(model, 'chutes-deepseek-ai-deepseek-r1')
-    
+    if not any(target.backend.kind == "chutes" for target in get_route(model).targets):
+        return openai_request
+    chute_name = resolve_chute(model)
+    messages, dropped = context_trimmer.trim(
+        openai_request['messages'],
+        context_trimmer.budget(chute_name, openai_request.get('max_tokens'))
+    )
+    if not dropped:
+        return openai_request
+    logging.info("上下文超出预算, 省略了 %d 条较早的消息", dropped)
+    context_trimmed_total.inc((chute_name,), dropped)
+    return dict(openai_request, messages=messages)
+
+def completion_key(openai_request):
+    """响应缓存与单飞使用的请求键"""
+    return cache_key(openai_request, resolve_chute(openai_request.get('model', 'deepseek-ai/DeepSeek-R1')))
+
+def create_chutes_request(openai_request, chute_name=None):
+    """将OpenAI格式请求转换为Chutes格式: 转发完整的对话历史 (上下文裁剪已在入口处完成, 见 trim_context)"""
+    model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
+    chute_name = chute_name or resolve_chute(model)
+
+    current_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
     return {
         "messages": [{
-            "role": messages[-1]['role'],
-            "content": messages[-1]['content'],
-            "id": message_id,
+            "role": message['role'],
+            "content": message['content'],
+            "id": str(uuid.uuid4()),
             "createdOn": current_time
-        }],
+        } for message in openai_request['messages']],
         "model": model,
         "chuteName": chute_name
     }
 
+class ChutesBackend(Backend):
+    """Chutes 聊天接口: 经 cloudscraper 会话池 (或 HTTP/2 连接池) 发送, 需要 cf_clearance"""
+
+    kind = "chutes"
+
+    def target_name(self, upstream_model):
+        # 与熔断器、指标中既有的 chuteName 命名保持一致
+        return upstream_model
+
+    def build(self, openai_request, upstream_model):
+        return create_chutes_request(openai_request, upstream_model)
+
+    def send(self, body, trace=NULL_TRACE):
+        if UPSTREAM_TRANSPORT == 'http2':
+            headers, cookies = upstream_auth()
+            response = get_h2_pool().post(CHUTES_CHAT_URL, data=dumps(body), headers=headers, cookies=cookies)
+            if not cloudflare_challenge(response):
+                return response
+            # 质询只有 cloudscraper 能处理, 这次请求改走会话池; 之后的 403 仍由重试流程刷新 cf_clearance
+            response.close()
+            logging.info("HTTP/2 请求遇到 Cloudflare 质询, 改用 cloudscraper 会话")
+        with trace.span("acquire_session"):
+            scraper = session_pool.acquire()
+        try:
+            response = scraper.post(
+                CHUTES_CHAT_URL,
+                json=body,
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT or None, UPSTREAM_READ_TIMEOUT)
+            )
+        except Exception:
+            session_pool.release(scraper, discard=True)
+            raise
+        # 会话在响应读取完毕后归还
+        response.pooled_session = scraper
+        response.session_pool = session_pool
+        return response
+
+    async def send_async(self, client, body):
+        headers, cookies = upstream_auth()
+        request = client.build_request(
+            "POST",
+            CHUTES_CHAT_URL,
+            json=body,
+            headers=headers,
+            cookies=cookies
+        )
+        return await client.send(request, stream=True)
+
+def create_backend_registry():
+    """后端与 BACKENDS_FILE / BACKENDS_JSON 配置的路由; 模型目录中的模型默认路由到对应的 chute (见 catalog_routes)"""
+    registry = BackendRegistry({
+        "chutes": ChutesBackend,
+        "openai": backends.OpenAIBackend,
+        "stub": backends.StubBackend
+    })
+    registry.add_backend("chutes", {"type": "chutes"})
+    registry.load(
+        backends.load_config(),
+        lambda backend, model: resolve_chute(model) if backend.kind == "chutes" else model
+    )
+    return registry
+
+backend_registry = create_backend_registry()
+# BACKENDS 配置的路由, 目录重新加载时连同目标的延迟统计一起保留
+configured_routes = dict(backend_registry.routes)
+# 每个 chute 一个路由目标, 目录重新加载后沿用, 延迟统计与进行中计数不会丢失
+_chute_targets = {}
+
+def chute_route(chute):
+    target = _chute_targets.get(chute)
+    if target is None:
+        target = _chute_targets[chute] = Target(backend_registry.backends["chutes"], chute)
+    return Route(chute, [target])
+
+def catalog_routes(catalog):
+    """目录中的每个模型路由到其 chute, BACKENDS 配置的路由优先; 准入控制按 route.name 排队, 目录中的模型沿用 chuteName"""
+    routes = {model: chute_route(entry.chute) for model, entry in catalog.models.items()}
+    for model, route in configured_routes.items():
+        entry = catalog.lookup(model)
+        routes[model] = Route(entry.chute, route.targets) if entry is not None else route
+    return routes
+
+backend_registry.routes = catalog_routes(model_catalog.current())
+# 未知模型: 发往目录的 default 模型对应的 chute
+_default_route = chute_route(model_catalog.current().chute(None))
+# /v1/models 的响应体与 ETag, 每个目录版本构造一次
+models_listing = models_response(model_catalog.current(), configured_routes)
+
+def canonical_model(model):
+    """别名换成目录中的模型名, 其他名称原样返回"""
+    entry = model_catalog.current().lookup(model)
+    return entry.id if entry is not None else model
+
+def get_route(model):
+    """模型 (或别名) 的路由"""
+    return backend_registry.route(canonical_model(model)) or _default_route
+
+def current_models_listing():
+    """(响应体, ETag); 先检查目录是否有更新"""
+    model_catalog.current()
+    return models_listing
+
+def metric_labels(model, target_name):
+    """指标标签 (model, chute); 别名计入对应的模型, 未知模型归为 other, 避免任意输入撑爆标签基数"""
+    model = canonical_model(model)
+    if backend_registry.route(model) is None:
+        return ("other", target_name)
+    return (model, target_name)
+
+def select_target(candidates, index):
+    """从 candidates[index] 开始选出熔断器允许的第一个目标, 返回 (目标, 熔断器, 下一个位置)
+
+    所有目标都处于熔断中时抛出 CircuitOpen。
+    """
+    open_error = None
+    for _ in range(len(candidates)):
+        target = candidates[index % len(candidates)]
+        index += 1
+        breaker = breakers.get(target.name) if breakers is not None else None
+        if breaker is not None:
+            try:
+                breaker.allow()
+            except CircuitOpen as e:
+                open_error = e
+                continue
+        return target, breaker, index
+    raise open_error
+
+class StreamStats:
+    """单个上游流的首 token 延迟、总耗时与吞吐, close() 时写入直方图与 trace"""
+
+    __slots__ = ('labels', 'started', 'opened', 'first', 'tokens', 'closed', 'trace', 'target')
+
+    def __init__(self, labels, started, trace=NULL_TRACE, target=None):
+        self.labels = labels
+        self.started = started
+        self.opened = time.monotonic()
+        self.first = None
+        self.tokens = 0
+        self.closed = False
+        self.trace = trace
+        self.target = target
+        active_streams.inc(labels)
+
+    def token(self):
+        self.tokens += 1
+        if self.first is None:
+            self.first = time.monotonic()
+            time_to_first_token_seconds.observe(self.labels, self.first - self.started)
+            self.trace.add("first_byte", self.opened, self.first)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        active_streams.dec(self.labels)
+        if self.target is not None:
+            self.target.end()
+        now = time.monotonic()
+        stream_duration_seconds.observe(self.labels, now - self.started)
+        self.trace.add("stream", self.first or self.opened, now, tokens=self.tokens)
+        if self.tokens > 1 and now > self.first:
+            tokens_per_second.observe(self.labels, (self.tokens - 1) / (now - self.first))
+
+def create_coalescer(openai_request):
+    """根据 stream_options.coalesce_ms / coalesce_bytes 或全局配置创建合并器, 未启用时返回 None"""
+    options = openai_request.get('stream_options')
+    if not isinstance(options, dict):
+        options = {}
+    try:
+        interval_ms = float(options.get('coalesce_ms', STREAM_COALESCE_MS))
+        max_bytes = int(options.get('coalesce_bytes', STREAM_COALESCE_BYTES))
+    except (TypeError, ValueError):
+        return None
+    if interval_ms <= 0:
+        return None
+    return TokenCoalescer(max_bytes, interval_ms / 1000)
+
+# read_ahead 读取结束的标记
+_READ_END = object()
+
+def read_ahead(contents, timeout, queue_size=64):
+    """在后台线程中读取 contents 并逐个产出增量; 等待超过 timeout() 秒 (None 为不限) 仍没有新增量时产出 None
+
+    WSGI 模式下的增量合并用它在上游停顿 (如长时间推理) 时按合并窗口发出已累积的内容;
+    队列满时读取线程等待, 背压照常传到上游。生成器关闭时中断仍在读取的上游。
+    """
+    items = queue.Queue(queue_size)
+    stopped = threading.Event()
+    state = {"error": None, "ended": False}
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for content in contents:
+                if not put(content):
+                    return
+        except Exception as e:
+            state["error"] = e
+        state["ended"] = True
+        put(_READ_END)
+
+    # 读取线程沿用当前上下文, 日志带有同一个请求 id
+    threading.Thread(target=contextvars.copy_context().run, args=(read,), daemon=True).start()
+    try:
+        while True:
+            try:
+                item = items.get(timeout=timeout())
+            except queue.Empty:
+                yield None
+                continue
+            if item is _READ_END:
+                if state["error"] is not None:
+                    raise state["error"]
+                return
+            yield item
+    finally:
+        stopped.set()
+        if not state["ended"] and isinstance(contents, UpstreamContents):
+            abort(contents.response)
+
+def stream_passthrough(openai_request, coalescer=None):
+    """流式响应是否透传上游的 data 帧; 启用合并时需要重新编码, 不透传"""
+    if coalescer is not None:
+        return False
+    options = openai_request.get('stream_options')
+    if isinstance(options, dict) and 'passthrough' in options:
+        return bool(options['passthrough'])
+    return STREAM_PASSTHROUGH
+
+def include_usage(openai_request):
+    """请求是否设置了 stream_options.include_usage"""
+    options = openai_request.get('stream_options')
+    return isinstance(options, dict) and bool(options.get('include_usage'))
+
+def usage_meter(openai_request):
+    """创建用量计量器, prompt_tokens 按裁剪后实际转发的消息估算"""
+    model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
+    return UsageMeter(context_trimmer.measure(
+        openai_request.get('messages') or [],
+        context_trimmer.budget(resolve_chute(model), openai_request.get('max_tokens'))
+    ))
+
 def process_chunk(chunk):
     """处理响应数据块"""
     try:
@@ -172,97 +796,830 @@ def process_chunk(chunk):
     except:
         return None
 
-def process_non_stream_response(response, model):
-    """处理非流式响应"""
+def completion_choice(content, finish_reason="stop", index=0):
+    return {
+        "message": {
+            "role": "assistant",
+            "content": content
+        },
+        "finish_reason": finish_reason,
+        "index": index
+    }
+
+def build_completion(model, content, finish_reason="stop", usage=None, choices=None):
+    """构造非流式 chat.completion 响应体; n > 1 时由 choices 给出全部 choice"""
+    return {
+        "id": str(uuid.uuid4()),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices or [completion_choice(content, finish_reason)],
+        "usage": usage or {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0
+        }
+    }
+
+def replay_cached(entry, model, usage=None):
+    """把缓存的补全按 SSE 流重新输出; 给定 usage 时在 [DONE] 之前输出用量块"""
+    encoder = ChunkEncoder(model, include_usage=usage is not None)
+    content = entry.content
+    for start in range(0, len(content), CACHE_REPLAY_CHARS):
+        yield encoder.encode(content[start:start + CACHE_REPLAY_CHARS])
+    if usage is not None:
+        yield encoder.encode_usage(usage)
+    yield DONE_FRAME
+
+def cached_usage(openai_request, entry):
+    """缓存命中时的用量: 按缓存内容估算"""
+    meter = usage_meter(openai_request)
+    meter.add(entry.content)
+    return meter.usage()
+
+class UpstreamContents:
+    """上游响应的增量内容迭代器, 收到 [DONE] 时 done 为 True; 上游返回的 usage 保存在 usage 中
+
+    frames() 用于透传模式, 逐个产出 (事件 data, 增量内容或 None), 只携带 usage 的事件除外。
+    """
+
+    finish_reason = "stop"
+    error = None
+    usage = None
+
+    def __init__(self, response, client=None):
+        self.response = response
+        self.done = False
+        self.stats = StreamStats(response.metric_labels, response.started, response.trace, response.target)
+        # 看门狗在超时或客户端断开时中断上游读取
+        self.watch = stream_watchdog.watch(
+            lambda: abort(response), getattr(response, 'sent', None), client, response.metric_labels)
+
+    def __iter__(self):
+        return self._iterate(False)
+
+    def frames(self):
+        return self._iterate(True)
+
+    def _iterate(self, passthrough):
+        stats = self.stats
+        watch = self.watch
+        events = iter_response_events(self.response)
+        monotonic = time.monotonic
+        waited = 0.0
+        try:
+            while True:
+                # 单独统计阻塞在上游读取上的时间, 与自身处理耗时区分
+                wait_start = monotonic()
+                # 看门狗的空闲超时只计算阻塞在这里的时间
+                watch.waiting = wait_start
+                try:
+                    payload = next(events, None)
+                except Exception:
+                    if watch.reason is not None:
+                        raise StreamAbandoned(watch.reason) from None
+                    raise
+                watch.waiting = None
+                waited += monotonic() - wait_start
+                if payload is None:
+                    if watch.reason is not None:
+                        # 被中断的 HTTP/1.1 响应可能表现为正常结束
+                        raise StreamAbandoned(watch.reason)
+                    return
+                watch.received = True
+                if payload == DONE:
+                    self.done = True
+                    return
+                if USAGE_KEY in payload:
+                    usage = extract_usage(payload)
+                    if usage is not None:
+                        self.usage = usage
+                        if passthrough and usage_only(payload):
+                            continue
+                content = extract_content(payload, process_chunk)
+                if content:
+                    stats.token()
+                    if not passthrough:
+                        yield content
+                if passthrough:
+                    yield payload, content
+        finally:
+            stats.trace.add_total("upstream_wait", waited)
+
+    def abandon(self, reason):
+        """记录在看门狗之外发现的放弃 (写客户端失败)"""
+        if not self.done and self.watch.reason is None:
+            self.watch.reason = reason
+            stream_watchdog.record(self.response.metric_labels, reason)
+
+    def close(self):
+        stream_watchdog.unwatch(self.watch)
+        self.stats.close()
+        release_response(self.response)
+
+def client_socket():
+    """当前请求的客户端连接 (gunicorn 与 werkzeug 开发服务器提供), 用于看门狗发现客户端断开"""
+    if not has_request_context():
+        return None
+    return request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+
+def log_abandoned(reason):
+    if reason == CLIENT_DISCONNECT:
+        logging.info("客户端已断开, 停止读取上游")
+    else:
+        logging.warning("上游超时 (%s), 已中断上游流", reason)
+
+def collect_completion(contents, model, meter=None, key=None):
+    """把增量内容聚合为非流式响应, 给定 meter 时同时计量用量; 给定 key 时只有收到 [DONE] 且未截断的内容写入缓存"""
     try:
-        full_content = ""
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith("data: "):
-                    data = line[6:]
-                    if data == "[DONE]":
-                        break
-                    try:
-                        chunk = json.loads(data)
-                        content = process_chunk(chunk)
-                        if content:
-                            full_content += content
-                    except json.JSONDecodeError:
-                        continue
+        buffer = ContentBuffer(MAX_RESPONSE_BYTES)
+        for content in contents:
+            if meter is not None:
+                meter.add(content)
+            if not buffer.append(content):
+                logging.warning("响应超过 %d 字节, 已截断", MAX_RESPONSE_BYTES)
+                break
 
+        full_content = buffer.getvalue()
         if not full_content:
             return Response("Empty response from server", status=500)
 
-        return {
-            "id": str(uuid.uuid4()),
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{
-                "message": {
-                    "role": "assistant",
-                    "content": full_content
-                },
-                "finish_reason": "stop",
-                "index": 0
-            }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
-        }
+        finish_reason = buffer.finish_reason if buffer.truncated else contents.finish_reason
+        if key is not None and contents.done and not buffer.truncated:
+            response_cache.put(key, full_content, finish_reason)
+        usage = None
+        if meter is not None:
+            meter.upstream = getattr(contents, 'usage', None)
+            usage = meter.usage()
+        return build_completion(model, full_content, finish_reason, usage)
+    except StreamAbandoned as e:
+        log_abandoned(e.reason)
+        return Response(f"Upstream stream abandoned: {e.reason}", status=504)
     except Exception as e:
-        logging.error(f"处理非流式响应时出错: {str(e)}")
+        logging.error("处理非流式响应时出错: %s", e)
         return Response("Failed to process response", status=500)
 
-def make_request_with_retry(openai_request, max_retries=3):
-    """带重试机制的请求函数"""
-    global current_cf_clearance
-    
-    chutes_request = create_chutes_request(openai_request)
+def process_non_stream_response(response, model):
+    """处理非流式响应"""
+    return collect_completion(UpstreamContents(response), model)
+
+def single_flight_eligible(openai_request):
+    """判断请求是否可以与相同的进行中请求合并"""
+    return SINGLE_FLIGHT == 'all' or is_cacheable(openai_request)
+
+def run_flight(flight, openai_request, key=None):
+    """单飞发起者: 请求上游并把增量广播给所有订阅者; 给定 key 时完整结束后写入缓存"""
+    response = make_request_with_retry(openai_request)
+    if isinstance(response, Response):
+        flight.finish(error=(response.status_code, response.get_data(as_text=True)))
+        return
+
+    contents = UpstreamContents(response)
+    buffer = ContentBuffer(MAX_RESPONSE_BYTES)
+    try:
+        for content in contents:
+            if flight.abandoned:
+                logging.info("所有订阅者已断开, 停止读取上游")
+                break
+            published = buffer.chars
+            if not buffer.append(content):
+                logging.warning("响应超过 %d 字节, 已截断", MAX_RESPONSE_BYTES)
+                # 上限之内的部分照常发出
+                rest = buffer.getvalue()[published:]
+                if rest:
+                    flight.publish(rest)
+                break
+            flight.publish(content)
+    finally:
+        contents.close()
+
+    # 截断是正常的结束: 订阅者照常收到 [DONE], finish_reason 为 length
+    flight.finish(done=contents.done or buffer.truncated, finish_reason=buffer.finish_reason)
+    if key is not None and contents.done and not buffer.truncated and buffer.chars:
+        response_cache.put(key, buffer.getvalue())
+
+def is_upstream_failure(status_code):
+    """计入熔断器错误率的上游状态码"""
+    return status_code >= 500 or status_code == 429
+
+def retry_allowed(chute, attempt, max_retries):
+    """本次失败之后是否还可以重试"""
+    if attempt >= max_retries - 1:
+        return False
+    if not retry_budget.withdraw():
+        logging.warning("重试预算已用完, 不再重试")
+        retry_budget_exhausted_total.inc((chute,))
+        return False
+    return True
+
+def send_to_target(target, breaker, body, labels, attempt, trace):
+    """向单个目标发送一次请求 (body 为该目标的上游请求体), 记录延迟、指标与熔断结果
+
+    返回的响应带有 target / metric_labels 属性; 只有 200 响应会继续占用目标的进行中计数, 在流结束时减少。
+    """
+    target.begin()
+    sent = time.monotonic()
+    upstream_attempts_total.inc(labels + (str(attempt + 1),))
+    try:
+        with trace.span("upstream", attempt=attempt + 1, target=target.name):
+            response = target.backend.send(body, trace)
+    except Exception:
+        upstream_responses_total.inc(labels + ("error",))
+        target.end()
+        target.observe(time.monotonic() - sent, False)
+        if breaker is not None:
+            breaker.record(False)
+        raise
+    latency = time.monotonic() - sent
+    failure = is_upstream_failure(response.status_code)
+    upstream_connect_seconds.observe(labels, latency)
+    upstream_responses_total.inc(labels + (str(response.status_code),))
+    target.observe(latency, not failure)
+    if breaker is not None:
+        breaker.record(not failure, latency)
+    if response.status_code != 200:
+        target.end()
+    response.target = target
+    response.metric_labels = labels
+    response.sent = sent
+    return response
+
+def discard_response(response):
+    """丢弃对冲中落败的一路响应"""
+    if response.status_code == 200:
+        response.target.end()
+    release_response(response, discard=True)
+
+def send_hedged(route, candidates, index, target, breaker, bodies, model, attempt, trace):
+    """发送请求并在首个数据块迟迟未到时对冲; bodies 为各候选目标的上游请求体, 返回 (响应, 候选目标的下一个位置)"""
+    state = {"index": index, "hedge_started": None}
+
+    def leg_call(target, breaker):
+        def call(leg):
+            sent = time.monotonic()
+            response = send_to_target(target, breaker, bodies[target], metric_labels(model, target.name), attempt, trace)
+            if response.status_code != 200:
+                return response
+            leg.response = response
+            if leg.cancelled:
+                # 响应头到达之前已经落败: race 看不到 leg.response, 由这一路自行中断, 不再等待首个数据块
+                abort(response)
+                return response
+            try:
+                with trace.span("first_byte", target=target.name):
+                    result = prefetch(response)
+            except Exception:
+                target.end()
+                release_response(response, discard=True)
+                raise
+            if not leg.cancelled:
+                hedging.observe(route, time.monotonic() - sent)
+            result.target = target
+            result.metric_labels = response.metric_labels
+            return result
+        return call
+
+    def start_hedge():
+        if not hedging.budget.withdraw():
+            hedges_total.inc((route, "budget_exhausted"))
+            return None
+        try:
+            hedge_target, hedge_breaker, state["index"] = select_target(candidates, state["index"])
+        except CircuitOpen:
+            return None
+        logging.info("首字节超时, 对冲请求: %s", hedge_target.name)
+        hedges_total.inc((route, "started"))
+        state["hedge_started"] = time.monotonic()
+        return leg_call(hedge_target, hedge_breaker)
+
+    response, winner, hedged = race(
+        leg_call(target, breaker),
+        start_hedge,
+        hedging.delay_for(route),
+        lambda response: response.status_code == 200,
+        discard_response
+    )
+    if state["hedge_started"] is not None and response.status_code == 200:
+        hedges_total.inc((route, "won" if winner == 1 else "lost"))
+        trace.add("hedge", state["hedge_started"], time.monotonic(), winner="hedge" if winner == 1 else "primary")
+    return response, state["index"]
+
+def make_request_with_retry(openai_request, max_retries=3, trace=NULL_TRACE):
+    """带重试与故障切换的请求函数: 按路由策略选择目标, 失败后的重试发往下一个目标
+
+    上游请求体在选择目标之前构造, 无效请求返回 400, 不计入熔断器与重试; 只有传输错误与上游状态码失败会重试。
+    """
+    sync_cf_clearance()
+    model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
+    route = get_route(model)
+    candidates = route.candidates()
+    try:
+        bodies = backends.build_bodies(candidates, openai_request)
+    except ValueError as e:
+        logging.warning("%s", e)
+        return Response(str(e), status=400)
+    started = time.monotonic()
     last_error = None
+    retry_budget.deposit()
+    if hedging is not None:
+        hedging.budget.deposit()
+    index = 0
     
     for attempt in range(max_retries):
         try:
-            scraper = create_scraper()
-            logging.info(f"尝试第 {attempt + 1} 次请求")
-            
-            response = scraper.post(
-                "https://chutes.ai/app/api/chat",
-                json=chutes_request,
-                stream=True
-            )
+            target, breaker, index = select_target(candidates, index)
+        except CircuitOpen as e:
+            logging.warning("%s", e)
+            return Response(str(e), status=503, headers={"Retry-After": str(e.retry_after)})
+        try:
+            logging.info("尝试第 %d 次请求: %s", attempt + 1, target.name)
+            if hedging is None:
+                response = send_to_target(
+                    target, breaker, bodies[target], metric_labels(model, target.name), attempt, trace)
+            else:
+                response, index = send_hedged(
+                    route.name, candidates, index, target, breaker, bodies, model, attempt, trace)
+            target = response.target
             
-            logging.info(f"请求状态码: {response.status_code}")
+            logging.info("请求状态码: %d", response.status_code)
             
-            # 如果响应成功,返回响应对象
+            # 如果响应成功,返回响应对象 (目标的进行中计数在流结束时减少)
             if response.status_code == 200:
+                response.started = started
+                response.trace = trace
                 return response
                 
-            # 如果是 403 错误,尝试获取新的 cf_clearance
-            if response.status_code == 403:
-                logging.warning(f"尝试 {attempt + 1}: 获取新的 cf_clearance")
-                new_cf_clearance = get_new_cf_clearance()
+            last_error = f"Status code: {response.status_code}, Response: {response.text}"
+            release_response(response)
+                
+            # 如果是 Chutes 的 403 错误,尝试获取新的 cf_clearance 后立即重试同一个目标
+            if response.status_code == 403 and target.backend.kind == "chutes":
+                logging.warning("尝试 %d: 获取新的 cf_clearance", attempt + 1)
+                with trace.span("cf_refresh"):
+                    new_cf_clearance = get_new_cf_clearance()
                 if new_cf_clearance:
-                    current_cf_clearance = new_cf_clearance
+                    set_cf_clearance(new_cf_clearance)
+                    index -= 1
                     continue
                     
-            last_error = f"Status code: {response.status_code}, Response: {response.text}"
-            logging.error(f"请求失败: {last_error}")
+            logging.error("请求失败: %s", last_error)
             
         except Exception as e:
             last_error = str(e)
-            logging.error(f"尝试 {attempt + 1} 失败: {last_error}", exc_info=True)
+            logging.error("尝试 %d 失败: %s", attempt + 1, last_error, exc_info=True)
         
-        # 在重试之前等待一段时间
-        if attempt < max_retries - 1:
-            time.sleep(2 ** attempt)  # 指数退避
+        # 预算允许时, 等待一段带抖动的时间后重试
+        if not retry_allowed(target.name, attempt, max_retries):
+            break
+        with trace.span("backoff"):
+            time.sleep(backoff_delay(attempt, RETRY_BACKOFF_BASE, RETRY_BACKOFF_CAP))
             
     # 所有重试都失败后返回错误
     return Response(f"请求失败,所有重试均未成功。最后的错误: {last_error}", status=500)
 
+def serve_completion(openai_request, trace, key=None, api_key=""):
+    """请求上游 (或加入进行中的相同请求) 并构造响应; 给定 key 时完整结束后写入缓存, 用量计入 api_key 所属的租户"""
+    cache_headers = {"X-Cache": "MISS"} if key is not None else None
+
+    if flights is not None and single_flight_eligible(openai_request):
+        # 与进行中的相同请求共享一次上游调用, 由发起者负责写入缓存
+        flight_key = key or completion_key(openai_request)
+        with trace.span("single_flight") as span:
+            contents, leader = flights.join(flight_key, lambda flight: run_flight(flight, openai_request, key))
+            span.tags["leader"] = leader
+            if not leader:
+                logging.info("合并到进行中的相同请求")
+            error = contents.wait_started()
+        if error:
+            contents.close()
+            return Response(error[1], status=error[0])
+        store_key = None
+    else:
+        response = make_request_with_retry(openai_request, trace=trace)
+
+        # 如果返回的是错误响应,直接返回
+        if isinstance(response, Response):
+            return response
+        contents = UpstreamContents(response, client_socket())
+        store_key = key
+
+    model = openai_request.get('model')
+    meter = usage_meter(openai_request)
+
+    # 处理非流式请求
+    if not openai_request.get('stream', False):
+        try:
+            result = collect_completion(contents, model, meter, store_key)
+        finally:
+            contents.close()
+        if not isinstance(result, dict):
+            return result
+        usage_ledger.record(api_key, model, result["usage"], meter.elapsed())
+        trace.finish()
+        headers = dict(cache_headers or {}, **{"Server-Timing": trace.server_timing()})
+        return Response(
+            dumps(result),
+            status=200,
+            content_type='application/json',
+            headers=headers
+        )
+
+    # 处理流式请求
+    def generate():
+        report_usage = include_usage(openai_request)
+        encoder = ChunkEncoder(model, include_usage=report_usage)
+        coalescer = create_coalescer(openai_request)
+        # 需要写入缓存时同时累积完整内容
+        buffer = ContentBuffer(MAX_RESPONSE_BYTES) if store_key is not None else None
+        monotonic = time.monotonic
+        written = 0.0
+        reader = None
+        try:
+            if isinstance(contents, UpstreamContents) and stream_passthrough(openai_request, coalescer):
+                # 透传上游的 data 帧, 内容只用于计量与缓存
+                rewriter = FrameRewriter(model)
+                for payload, content in contents.frames():
+                    if content:
+                        meter.add(content)
+                        if buffer is not None and not buffer.append(content):
+                            buffer = None
+                    write_start = monotonic()
+                    yield rewriter.frame(payload)
+                    written += monotonic() - write_start
+                # 用量块沿用上游的 id
+                encoder.id = rewriter.id or encoder.id
+            else:
+                # 合并时在后台线程读取上游, 上游停顿期间窗口到期的内容也能按时发出
+                reader = read_ahead(contents, coalescer.timeout) if coalescer is not None else None
+                for content in reader or contents:
+                    if content is None:
+                        content = coalescer.expired()
+                        if not content:
+                            continue
+                    else:
+                        meter.add(content)
+                        if buffer is not None and not buffer.append(content):
+                            buffer = None
+                        if coalescer is not None:
+                            content = coalescer.push(content)
+                            if not content:
+                                continue
+                    # yield 期间 WSGI 服务器在向客户端写数据
+                    write_start = monotonic()
+                    yield encoder.encode(content)
+                    written += monotonic() - write_start
+
+            if coalescer is not None:
+                rest = coalescer.flush()
+                if rest:
+                    yield encoder.encode(rest)
+            if contents.done:
+                if buffer is not None and buffer.chars:
+                    response_cache.put(store_key, buffer.getvalue())
+                if report_usage:
+                    meter.upstream = getattr(contents, 'usage', None)
+                    yield encoder.encode_usage(meter.usage())
+                if trace.emit:
+                    contents.close()
+                    trace.add_total("client_write", written)
+                    written = 0.0
+                    trace.finish()
+                    yield trace.sse_comment()
+                yield DONE_FRAME
+
+        except GeneratorExit:
+            # 写客户端失败, WSGI 服务器关闭了生成器
+            if isinstance(contents, UpstreamContents):
+                contents.abandon(CLIENT_DISCONNECT)
+            raise
+        except StreamAbandoned as e:
+            log_abandoned(e.reason)
+            return
+        except Exception as e:
+            logging.error("生成响应时出错: %s", e, exc_info=True)
+            return
+        finally:
+            if reader is not None:
+                reader.close()
+            contents.close()
+            trace.add_total("client_write", written)
+            trace.finish()
+            # 客户端中途断开时按已生成的部分计入
+            meter.upstream = getattr(contents, 'usage', None)
+            usage_ledger.record(api_key, model, meter.usage(), meter.elapsed())
+
+    return Response(
+        stream_with_context(generate()),
+        content_type='text/event-stream',
+        headers=cache_headers
+    )
+
+def choice_count(openai_request):
+    """请求的 n; 不是正整数或超过 MAX_CHOICES 时抛出 ValueError"""
+    n = openai_request.get('n')
+    if n is None:
+        return 1
+    if isinstance(n, bool) or not isinstance(n, int) or n < 1:
+        raise ValueError("n 必须是正整数")
+    if n > MAX_CHOICES:
+        raise ValueError(f"n 不能超过 {MAX_CHOICES}")
+    return n
+
+class ChoiceLeg:
+    """n > 1 时的一路上游请求: 增量迭代器与这一路占用的准入名额"""
+
+    __slots__ = ('contents', 'ticket')
+
+    def __init__(self, contents, ticket=None):
+        self.contents = contents
+        self.ticket = ticket
+
+    def close(self):
+        self.contents.close()
+        if self.ticket is not None:
+            self.ticket.release()
+
+def start_choices(openai_request, count, trace, api_key=""):
+    """并发发起 count 路上游请求 (请求体去掉 n), 返回已开始读取的 Fanout
+
+    第一路使用请求本身的准入名额, 其余各路各自申请, 与其他请求共享并发上限。
+    """
+    leg_request = {k: v for k, v in openai_request.items() if k != 'n'}
+    route_name = get_route(openai_request.get('model', 'deepseek-ai/DeepSeek-R1')).name
+    client = client_socket()
+
+    def open_leg(index):
+        ticket = None
+        if index and admission is not None:
+            try:
+                ticket = admission.acquire(route_name, api_key)
+            except Rejected as rejected:
+                raise LegFailed(rejected.status, rejected.reason)
+        try:
+            response = make_request_with_retry(leg_request, trace=trace)
+        except Exception:
+            if ticket is not None:
+                ticket.release()
+            raise
+        if isinstance(response, Response):
+            if ticket is not None:
+                ticket.release()
+            raise LegFailed(response.status_code, response.get_data(as_text=True))
+        return ChoiceLeg(UpstreamContents(response, client), ticket)
+
+    fanout = Fanout(
+        count, open_leg,
+        read=lambda leg: leg.contents,
+        close=ChoiceLeg.close,
+        abort=lambda leg: abort(leg.contents.response)
+    )
+    fanout.start()
+    return fanout
+
+def leg_error(fanout):
+    """各路读取中途的错误: 有一路被中断时返回 StreamAbandoned, 否则返回第一个错误或 None"""
+    errors = [leg.error for leg in fanout.legs if leg.error is not None]
+    for error in errors:
+        if isinstance(error, StreamAbandoned):
+            return error
+    return errors[0] if errors else None
+
+def serve_choices(openai_request, count, trace, api_key=""):
+    """n > 1: count 路上游请求并发进行, 墙钟时间与单路相近; 增量按 choice 序号合并为一个响应"""
+    with trace.span("fanout", n=count):
+        fanout = start_choices(openai_request, count, trace, api_key)
+        error = fanout.wait_started()
+    if error:
+        fanout.cancel()
+        return Response(error[1], status=error[0])
+
+    model = openai_request.get('model')
+    prompt_tokens = usage_meter(openai_request).prompt_tokens
+    meters = [UsageMeter(prompt_tokens) for _ in range(count)]
+    legs = fanout.legs
+
+    def total_usage():
+        for meter, leg in zip(meters, legs):
+            meter.upstream = leg.handle.contents.usage
+        return merge_usage([meter.usage() for meter in meters])
+
+    def record_usage():
+        usage_ledger.record(api_key, model, total_usage(), max(meter.elapsed() for meter in meters))
+
+    if not openai_request.get('stream', False):
+        buffers = [ContentBuffer(MAX_RESPONSE_BYTES) for _ in range(count)]
+        try:
+            for index, content in fanout:
+                buffer = buffers[index]
+                if buffer.truncated:
+                    continue
+                meters[index].add(content)
+                if not buffer.append(content):
+                    logging.warning("第 %d 路响应超过 %d 字节, 已截断", index + 1, MAX_RESPONSE_BYTES)
+        finally:
+            fanout.cancel()
+        error = leg_error(fanout)
+        if isinstance(error, StreamAbandoned):
+            log_abandoned(error.reason)
+            return Response(f"Upstream stream abandoned: {error.reason}", status=504)
+        if error is not None:
+            logging.error("处理非流式响应时出错: %s", error)
+            return Response("Failed to process response", status=500)
+        if not any(buffer.chars for buffer in buffers):
+            return Response("Empty response from server", status=500)
+        choices = [
+            completion_choice(buffer.getvalue(),
+                              buffer.finish_reason if buffer.truncated else leg.handle.contents.finish_reason,
+                              index)
+            for index, (buffer, leg) in enumerate(zip(buffers, legs))
+        ]
+        result = build_completion(model, None, usage=total_usage(), choices=choices)
+        record_usage()
+        trace.finish()
+        return Response(
+            dumps(result),
+            status=200,
+            content_type='application/json',
+            headers={"Server-Timing": trace.server_timing()}
+        )
+
+    def generate():
+        report_usage = include_usage(openai_request)
+        first = ChunkEncoder(model, include_usage=report_usage)
+        encoders = [first] + [ChunkEncoder(model, first.id, first.created, report_usage, index)
+                              for index in range(1, count)]
+        monotonic = time.monotonic
+        written = 0.0
+        try:
+            for index, content in fanout:
+                meters[index].add(content)
+                write_start = monotonic()
+                yield encoders[index].encode(content)
+                written += monotonic() - write_start
+
+            error = leg_error(fanout)
+            if isinstance(error, StreamAbandoned):
+                log_abandoned(error.reason)
+                return
+            if error is not None:
+                logging.error("生成响应时出错: %s", error)
+                return
+            if all(leg.handle.contents.done for leg in legs):
+                if report_usage:
+                    yield first.encode_usage(total_usage())
+                yield DONE_FRAME
+        except GeneratorExit:
+            # 写客户端失败, WSGI 服务器关闭了生成器
+            for leg in legs:
+                leg.handle.contents.abandon(CLIENT_DISCONNECT)
+            raise
+        finally:
+            fanout.cancel()
+            trace.add_total("client_write", written)
+            trace.finish()
+            record_usage()
+
+    return Response(
+        stream_with_context(generate()),
+        content_type='text/event-stream'
+    )
+
+# 批处理: 文件与状态保存在 BATCH_DIR; 所有批处理共用 BATCH_WORKERS 个线程, 每个模型最多 BATCH_MODEL_CONCURRENCY 个并发
+BATCH_DIR = os.getenv('BATCH_DIR', os.path.join(tempfile.gettempdir(), 'chutes2api_batches'))
+
+def execute_batch_request(body):
+    """执行批处理中的单个请求, 返回 (状态码, 响应体, 请求 id)"""
+    trace = Trace()
+    try:
+        validate_request(body)
+    except ValueError as e:
+        return 400, {"error": {"message": str(e)}}, trace.request_id
+    body = trim_context(body)
+    response = make_request_with_retry(body, trace=trace)
+    if isinstance(response, Response):
+        trace.finish()
+        return response.status_code, {"error": {"message": response.get_data(as_text=True)}}, trace.request_id
+    contents = UpstreamContents(response)
+    try:
+        result = collect_completion(contents, body.get('model'), usage_meter(body))
+    finally:
+        contents.close()
+        trace.finish()
+    if isinstance(result, Response):
+        return result.status_code, {"error": {"message": result.get_data(as_text=True)}}, trace.request_id
+    return 200, result, trace.request_id
+
+BATCH_MODEL_LIMITS = parse_mapping(os.getenv('BATCH_MODEL_LIMITS'), int)
+batch_store = BatchStore(BATCH_DIR)
+batch_runner = BatchRunner(
+    batch_store,
+    execute_batch_request,
+    workers=int(os.getenv('BATCH_WORKERS', 16)),
+    concurrency=int(os.getenv('BATCH_MODEL_CONCURRENCY', 8)),
+    # 单独设置的并发数, 可以用模型名或 chuteName
+    limits=model_limits(BATCH_MODEL_LIMITS),
+    model_key=lambda model: get_route(model).name,
+    scan_interval=float(os.getenv('BATCH_SCAN_INTERVAL', 30))
+)
+
+def apply_catalog(catalog):
+    """新的模型目录生效之前更新路由、/v1/models 响应与各模型的限制; 各处都是整体替换引用, 读取方不加锁"""
+    global _default_route, models_listing
+    routes = catalog_routes(catalog)
+    default_route = chute_route(catalog.chute(None))
+    listing = models_response(catalog, configured_routes)
+    if admission is not None:
+        admission.set_limits(model_limits(ADMISSION_MODEL_LIMITS, 'max_concurrency', catalog))
+    context_trimmer.limits = model_limits(CONTEXT_MODEL_LIMITS, 'context_tokens', catalog)
+    batch_runner.limits = model_limits(BATCH_MODEL_LIMITS, catalog=catalog)
+    backend_registry.routes = routes
+    _default_route = default_route
+    models_listing = listing
+
+model_catalog.on_change = apply_catalog
+
+def batch_error_response(error):
+    return Response(error.message, status=error.status)
+
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    """上传批处理输入文件 (multipart/form-data, 字段 file 与 purpose=batch)"""
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    upload = request.files.get('file')
+    if upload is None:
+        return Response("缺少 file 字段", status=400)
+    try:
+        return jsonify(batch_store.create_file(upload.filename, request.form.get('purpose'), upload.save))
+    except BatchError as e:
+        return batch_error_response(e)
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+def get_file(file_id):
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    try:
+        return jsonify(batch_store.get_file(file_id))
+    except BatchError as e:
+        return batch_error_response(e)
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+def get_file_content(file_id):
+    """文件内容; 批处理输出文件在运行期间返回已完成的部分"""
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    try:
+        batch_store.get_file(file_id)
+    except BatchError as e:
+        return batch_error_response(e)
+    return Response(batch_store.iter_file(file_id), content_type='application/jsonl')
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    params = request.get_json(silent=True) or {}
+    try:
+        batch = batch_store.create_batch(
+            params.get('input_file_id'),
+            params.get('endpoint'),
+            params.get('completion_window', '24h'),
+            params.get('metadata')
+        )
+    except BatchError as e:
+        return batch_error_response(e)
+    batch_runner.submit(batch["id"])
+    return jsonify(batch)
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 100))
+    except ValueError:
+        return Response("Invalid limit", status=400)
+    return jsonify(batch_store.list_batches(limit, request.args.get('after')))
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    try:
+        return jsonify(batch_store.get_batch(batch_id))
+    except BatchError as e:
+        return batch_error_response(e)
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """取消批处理: 不再发起新请求, 进行中的请求完成后状态变为 cancelled"""
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    try:
+        return jsonify(batch_store.cancel_batch(batch_id))
+    except BatchError as e:
+        return batch_error_response(e)
+
 @app.route('/', methods=['GET'])
 def home():
     """健康检查端点"""
@@ -270,29 +1627,81 @@ def home():
         "status": "Chutes API Service Running",
         "version": "1.0",
         "has_auth_token": bool(auth_token),
-        "has_cf_clearance": bool(current_cf_clearance)
+        "has_cf_clearance": bool(current_cf_clearance),
+        "session_pool": session_pool.stats(),
+        "upstream_transport": get_h2_pool().snapshot() if UPSTREAM_TRANSPORT == 'http2' else UPSTREAM_TRANSPORT,
+        "response_cache": response_cache.snapshot() if response_cache is not None else None,
+        "single_flight": flights.snapshot() if flights is not None else None,
+        "admission": admission.snapshot() if admission is not None else None,
+        "circuit_breakers": breakers.snapshot() if breakers is not None else None,
+        "retry_budget": retry_budget.snapshot(),
+        "context": context_trimmer.snapshot(),
+        "hedging": hedging.snapshot() if hedging is not None else None,
+        "backends": backend_registry.snapshot(),
+        "model_catalog": model_catalog.snapshot(),
+        "batches": batch_runner.snapshot(),
+        "logging": logs.snapshot(),
+        "abandoned_streams": stream_watchdog.snapshot()
     }
     return config_info
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 指标"""
+    return Response(metrics.render(), content_type=prom.CONTENT_TYPE)
+
+@app.route('/admin/profile', methods=['POST'])
+def admin_profile():
+    """采样分析当前 worker 进程 N 秒并返回报告"""
+    if not ADMIN_TOKEN:
+        return Response("Not Found", status=404)
+    if not check_admin_header(request.headers.get('Authorization', '')):
+        return Response("Unauthorized", status=401)
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), PROFILE_MAX_SECONDS)
+        interval = float(request.args.get('interval_ms', 5)) / 1000
+    except ValueError:
+        return Response("Invalid seconds or interval_ms", status=400)
+    try:
+        stacks, samples = profiler.sample(seconds, interval)
+    except profiler.ProfilerBusy:
+        return Response("Profiling already in progress", status=409)
+    if request.args.get('format') == 'collapsed':
+        return Response(profiler.collapsed(stacks), content_type='text/plain; charset=utf-8')
+    return Response(profiler.report(stacks, samples, seconds), content_type='text/plain; charset=utf-8')
+
+@app.route('/admin/usage', methods=['GET'])
+def admin_usage():
+    """按租户与模型汇总的用量 (所有 worker): token 数、输出速度与费用"""
+    if not ADMIN_TOKEN:
+        return Response("Not Found", status=404)
+    if not check_admin_header(request.headers.get('Authorization', '')):
+        return Response("Unauthorized", status=401)
+    return Response(dumps(usage_ledger.report()), content_type='application/json')
+
+@app.before_request
+def clear_log_context():
+    # 线程会被后续请求复用, 清除上一个请求绑定的日志请求 id
+    logs.bind(None)
+
+@app.after_request
+def add_request_id(response):
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers['X-Request-Id'] = trace.request_id
+    return response
+
 @app.route('/v1/models', methods=['GET'])
 def get_models():
-    """获取可用模型列表"""
+    """获取可用模型列表; 响应体按目录版本预先构造, If-None-Match 与 ETag 相同时返回 304"""
     if not check_auth():
         return Response("Unauthorized", status=401)
-        
-    models = []
-    for model_id in MODEL_MAPPING.keys():
-        models.append({
-            "id": model_id,
-            "object": "model",
-            "created": int(time.time()),
-            "owned_by": "chutes"
-        })
-    
-    return jsonify({
-        "object": "list",
-        "data": models
-    })
+
+    body, etag = current_models_listing()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers=headers)
+    return Response(body, status=200, content_type='application/json', headers=headers)
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat():
@@ -301,69 +1710,88 @@ def chat():
         if not check_auth():
             return Response("Unauthorized", status=401)
 
-        openai_request = request.json
+        openai_request = request.get_json(silent=True)
+        if not isinstance(openai_request, dict):
+            return Response("请求体必须是 JSON 对象", status=400)
+        trace = g.trace = Trace(request.headers.get('X-Request-Id'), request.headers.get('X-Trace') == '1')
+        logs.bind(trace.request_id)
         logging.info("收到新的聊天请求")
-        response = make_request_with_retry(openai_request)
-        
-        # 如果返回的是错误响应,直接返回
-        if isinstance(response, Response):
-            return response
-            
-        # 处理非流式请求
-        if not openai_request.get('stream', False):
-            result = process_non_stream_response(response, openai_request.get('model'))
-            return Response(
-                json.dumps(result, ensure_ascii=False),
-                status=200,
-                content_type='application/json'
-            ) if isinstance(result, dict) else result
-
-        # 处理流式请求
-        def generate():
+        try:
+            validate_request(openai_request)
+            count = choice_count(openai_request)
+        except ValueError as e:
+            return Response(str(e), status=400)
+        openai_request = trim_context(openai_request)
+        api_key = request_api_key(request.headers.get('Authorization', ''))
+
+        key = None
+        if count == 1 and response_cache is not None and is_cacheable(openai_request):
+            key = completion_key(openai_request)
+            cached = response_cache.get(key)
+            if cached is not None:
+                logging.info("命中响应缓存")
+                usage = cached_usage(openai_request, cached)
+                usage_ledger.record(api_key, openai_request.get('model'), usage, 0, cached=True)
+                if openai_request.get('stream', False):
+                    return Response(
+                        replay_cached(cached, openai_request.get('model'),
+                                      usage if include_usage(openai_request) else None),
+                        content_type='text/event-stream',
+                        headers={"X-Cache": "HIT"}
+                    )
+                return Response(
+                    dumps(build_completion(openai_request.get('model'), cached.content, cached.finish_reason, usage)),
+                    status=200,
+                    content_type='application/json',
+                    headers={"X-Cache": "HIT"}
+                )
+        ticket = None
+        if admission is not None:
             try:
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith("data: "):
-                            data = line[6:]
-                            if data == "[DONE]":
-                                yield "data: [DONE]\n\n"
-                                break
-                            
-                            try:
-                                chunk = json.loads(data)
-                                content = process_chunk(chunk)
-                                if content:
-                                    response_chunk = {
-                                        "id": str(uuid.uuid4()),
-                                        "object": "chat.completion.chunk",
-                                        "created": int(time.time()),
-                                        "model": openai_request.get('model'),
-                                        "choices": [{
-                                            "delta": {
-                                                "content": content
-                                            },
-                                            "index": 0,
-                                            "finish_reason": None
-                                        }]
-                                    }
-                                    yield f"data: {json.dumps(response_chunk, ensure_ascii=False)}\n\n"
-                            except json.JSONDecodeError:
-                                continue
-                            
-            except Exception as e:
-                logging.error(f"生成响应时出错: {str(e)}", exc_info=True)
-                return
+                with trace.span("admission"):
+                    ticket = admission.acquire(
+                        get_route(openai_request.get('model', 'deepseek-ai/DeepSeek-R1')).name,
+                        api_key
+                    )
+            except Rejected as rejected:
+                logging.warning("请求未被准入: %s", rejected.reason)
+                return rejected_response(rejected)
 
-        return Response(
-            stream_with_context(generate()),
-            content_type='text/event-stream'
-        )
+        try:
+            if count > 1:
+                response = serve_choices(openai_request, count, trace, api_key)
+            else:
+                response = serve_completion(openai_request, trace, key, api_key)
+        except Exception:
+            if ticket is not None:
+                ticket.release()
+            raise
+        # 响应发送完毕 (流式响应结束或客户端断开) 后归还并发名额
+        if ticket is not None:
+            response.call_on_close(ticket.release)
+        return response
 
     except Exception as e:
-        logging.error(f"聊天接口出错: {str(e)}", exc_info=True)
+        logging.error("聊天接口出错: %s", e, exc_info=True)
         return Response(f"服务器内部错误: {str(e)}", status=500)
 
+def run_production_server():
+    """使用 gunicorn 多进程启动 (配置见 gunicorn.conf.py)"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    os.execvp('gunicorn', [
+        'gunicorn',
+        '--chdir', base_dir,
+        '-c', os.path.join(base_dir, 'gunicorn.conf.py'),
+        'app:app'
+    ])
+
 if __name__ == '__main__':
    port = int(os.getenv('PORT', 8805))
+   # DEV_SERVER=1 时使用 Flask 开发服务器
+   if os.getenv('DEV_SERVER') != '1' and os.name != 'nt':
+       try:
+           run_production_server()
+       except FileNotFoundError:
+           logging.warning("未安装 gunicorn, 使用开发服务器")
+   batch_runner.start()
    app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,953 @@
+"""异步 (ASGI) 服务模式
+
+每个进程一个事件循环, 流式响应不再占用线程, 单进程即可承载大量并发 SSE 流。
+启动: python asgi_app.py  或  uvicorn asgi_app:app --workers N
+Flask 版本 (app.py) 保持不变, 可作为回退方案继续使用。
+"""
+import asyncio
+import json
+import time
+import os
+import logging
+import urllib.parse
+
+import httpx
+
+import app as core
+from sse import DONE, USAGE_KEY, SSEParser, extract_content, extract_usage, usage_only
+from codec import DONE_FRAME, ChunkEncoder, FrameRewriter, dumps
+from tracing import NULL_TRACE, Trace
+import profiler
+from admission import Rejected
+from breaker import CircuitOpen
+from hedge import prefetch_async, race_async
+from batch import BatchError, parse_multipart
+from watchdog import CLIENT_DISCONNECT, FIRST_BYTE_TIMEOUT, IDLE_TIMEOUT, StreamAbandoned
+from fanout import AsyncFanout, LegFailed
+from catalog import etag_matches
+from backends import build_bodies
+
+# 上游连接限制
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', 1000))
+
+# uvicorn worker 进程数; 多于一个时各进程的指标通过 METRICS_DIR 合并
+ASGI_WORKERS = int(os.getenv('ASGI_WORKERS', os.cpu_count() or 1))
+
+# httpx 默认不解 br, 去掉该编码
+ASYNC_UPSTREAM_HEADERS = dict(core.UPSTREAM_HEADERS, **{"Accept-Encoding": "gzip, deflate"})
+
+# httpx 每个请求都会输出 INFO 日志, 热路径上关闭
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+_client = None
+
+
+def get_client():
+    """获取当前进程共享的异步上游客户端"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers=ASYNC_UPSTREAM_HEADERS,
+            # UPSTREAM_TRANSPORT=http2 时由 httpx 在同一连接上多路复用 (需要 h2)
+            http2=core.UPSTREAM_TRANSPORT == 'http2',
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS
+            ),
+            # 读超时只作兜底, 按事件计时的首个事件 / 空闲超时见 upstream_deadline
+            timeout=httpx.Timeout(None, connect=core.UPSTREAM_CONNECT_TIMEOUT or None, read=core.UPSTREAM_READ_TIMEOUT)
+        )
+    return _client
+
+
+async def close_client():
+    """关闭异步上游客户端"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def send_to_target(target, breaker, body, labels, attempt, trace):
+    """向单个目标发送一次请求, 记录延迟、指标与熔断结果; 语义同 core.send_to_target"""
+    target.begin()
+    sent = time.monotonic()
+    core.upstream_attempts_total.inc(labels + (str(attempt + 1),))
+    try:
+        with trace.span("upstream", attempt=attempt + 1, target=target.name):
+            response = await target.backend.send_async(get_client(), body)
+    except asyncio.CancelledError:
+        # 对冲落败或客户端断开, 不计入失败
+        target.end()
+        if breaker is not None:
+            breaker.cancel()
+        raise
+    except Exception:
+        core.upstream_responses_total.inc(labels + ("error",))
+        target.end()
+        target.observe(time.monotonic() - sent, False)
+        if breaker is not None:
+            breaker.record(False)
+        raise
+    latency = time.monotonic() - sent
+    failure = core.is_upstream_failure(response.status_code)
+    core.upstream_connect_seconds.observe(labels, latency)
+    core.upstream_responses_total.inc(labels + (str(response.status_code),))
+    target.observe(latency, not failure)
+    if breaker is not None:
+        breaker.record(not failure, latency)
+    if response.status_code != 200:
+        target.end()
+    response.target = target
+    response.metric_labels = labels
+    response.sent = sent
+    response.done = False
+    return response
+
+
+async def discard_response(response):
+    """丢弃对冲中落败的一路响应"""
+    if response.status_code == 200:
+        response.target.end()
+    await response.aclose()
+
+
+async def send_hedged(route, candidates, index, target, breaker, bodies, model, attempt, trace):
+    """发送请求并在首个数据块迟迟未到时对冲, 落败的一路直接取消; 返回 (响应, 候选目标的下一个位置)"""
+    state = {"index": index, "hedge_started": None}
+
+    def leg_call(target, breaker):
+        async def call():
+            sent = time.monotonic()
+            response = await send_to_target(
+                target, breaker, bodies[target], core.metric_labels(model, target.name), attempt, trace)
+            if response.status_code != 200:
+                return response
+            try:
+                with trace.span("first_byte", target=target.name):
+                    result = await prefetch_async(response)
+            except BaseException:
+                target.end()
+                await response.aclose()
+                raise
+            core.hedging.observe(route, time.monotonic() - sent)
+            result.target = target
+            result.metric_labels = response.metric_labels
+            return result
+        return call
+
+    def start_hedge():
+        if not core.hedging.budget.withdraw():
+            core.hedges_total.inc((route, "budget_exhausted"))
+            return None
+        try:
+            hedge_target, hedge_breaker, state["index"] = core.select_target(candidates, state["index"])
+        except CircuitOpen:
+            return None
+        logging.info("首字节超时, 对冲请求: %s", hedge_target.name)
+        core.hedges_total.inc((route, "started"))
+        state["hedge_started"] = time.monotonic()
+        return leg_call(hedge_target, hedge_breaker)
+
+    response, winner, hedged = await race_async(
+        leg_call(target, breaker),
+        start_hedge,
+        core.hedging.delay_for(route),
+        lambda response: response.status_code == 200,
+        discard_response
+    )
+    if state["hedge_started"] is not None and response.status_code == 200:
+        core.hedges_total.inc((route, "won" if winner == 1 else "lost"))
+        trace.add("hedge", state["hedge_started"], time.monotonic(), winner="hedge" if winner == 1 else "primary")
+    return response, state["index"]
+
+
+async def make_request_with_retry(openai_request, max_retries=3, trace=NULL_TRACE):
+    """带重试与故障切换的异步请求函数, 返回 (响应, 错误信息)
+
+    所有目标都在熔断中时抛出 CircuitOpen; 请求无法转换为上游请求体时抛出 ValueError (400), 不计入熔断与重试。
+    """
+    core.sync_cf_clearance()
+    model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
+    route = core.get_route(model)
+    candidates = route.candidates()
+    bodies = build_bodies(candidates, openai_request)
+    started = time.monotonic()
+    last_error = None
+    loop = asyncio.get_running_loop()
+    core.retry_budget.deposit()
+    if core.hedging is not None:
+        core.hedging.budget.deposit()
+    index = 0
+
+    for attempt in range(max_retries):
+        target, breaker, index = core.select_target(candidates, index)
+        try:
+            logging.info("尝试第 %d 次请求: %s", attempt + 1, target.name)
+            if core.hedging is None:
+                response = await send_to_target(
+                    target, breaker, bodies[target], core.metric_labels(model, target.name), attempt, trace)
+            else:
+                response, index = await send_hedged(
+                    route.name, candidates, index, target, breaker, bodies, model, attempt, trace)
+            target = response.target
+            logging.info("请求状态码: %d", response.status_code)
+
+            if response.status_code == 200:
+                response.stats = core.StreamStats(response.metric_labels, started, trace, target)
+                return response, None
+
+            body = await response.aread()
+            await response.aclose()
+            last_error = f"Status code: {response.status_code}, Response: {body.decode('utf-8', 'replace')}"
+
+            # 如果是 Chutes 的 403 错误,尝试获取新的 cf_clearance (cloudscraper 为同步实现, 放到线程池执行)
+            if response.status_code == 403 and target.backend.kind == "chutes":
+                logging.warning("尝试 %d: 获取新的 cf_clearance", attempt + 1)
+                with trace.span("cf_refresh"):
+                    new_cf_clearance = await loop.run_in_executor(None, core.get_new_cf_clearance)
+                if new_cf_clearance:
+                    core.set_cf_clearance(new_cf_clearance)
+                    index -= 1
+                    continue
+
+            logging.error("请求失败: %s", last_error)
+
+        except Exception as e:
+            last_error = str(e)
+            logging.error("尝试 %d 失败: %s", attempt + 1, last_error, exc_info=True)
+
+        # 预算允许时, 等待一段带抖动的时间后重试
+        if not core.retry_allowed(target.name, attempt, max_retries):
+            break
+        with trace.span("backoff"):
+            await asyncio.sleep(core.backoff_delay(attempt, core.RETRY_BACKOFF_BASE, core.RETRY_BACKOFF_CAP))
+
+    return None, f"请求失败,所有重试均未成功。最后的错误: {last_error}"
+
+
+def upstream_deadline(response, waiting_since):
+    """从 waiting_since 开始等待上游下一个 SSE 事件的截止时间 (monotonic) 与超时原因; 不限制时为 (None, None)
+
+    空闲只计算等待上游的时间, 等待写客户端 (背压) 不计入。
+    """
+    if getattr(response, 'last_event', None) is None:
+        if core.UPSTREAM_FIRST_BYTE_TIMEOUT:
+            return response.sent + core.UPSTREAM_FIRST_BYTE_TIMEOUT, FIRST_BYTE_TIMEOUT
+    elif core.UPSTREAM_IDLE_TIMEOUT:
+        return waiting_since + core.UPSTREAM_IDLE_TIMEOUT, IDLE_TIMEOUT
+    return None, None
+
+
+async def iter_contents(response, passthrough=False):
+    """增量解析上游 SSE 字节流, 逐个产出增量内容; 上游返回的 usage 保存在 response.usage 中, 收到 [DONE] 时 response.done 为 True
+
+    passthrough 时逐个产出 (事件 data, 增量内容或 None), 只携带 usage 的事件除外。
+
+    收到 SSE 事件的时间记在 response.last_event, 首个事件 / 空闲超时由调用方按 upstream_deadline 检查。
+    """
+    parser = SSEParser()
+    stats = response.stats
+    chunks = response.aiter_bytes().__aiter__()
+    monotonic = time.monotonic
+    waited = 0.0
+    try:
+        while True:
+            # 单独统计等待上游数据的时间, 与自身处理耗时区分
+            wait_start = monotonic()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                now = monotonic()
+                waited += now - wait_start
+            for payload in parser.feed(chunk):
+                response.last_event = now
+                if payload == DONE:
+                    response.done = True
+                    return
+                if USAGE_KEY in payload:
+                    usage = extract_usage(payload)
+                    if usage is not None:
+                        response.usage = usage
+                        if passthrough and usage_only(payload):
+                            continue
+                content = extract_content(payload, core.process_chunk)
+                if content:
+                    stats.token()
+                    if not passthrough:
+                        yield content
+                if passthrough:
+                    yield payload, content
+    finally:
+        stats.trace.add_total("upstream_wait", waited)
+    for payload in parser.flush():
+        if payload == DONE:
+            response.done = True
+        else:
+            content = extract_content(payload, core.process_chunk)
+            if content:
+                stats.token()
+                if not passthrough:
+                    yield content
+            if passthrough:
+                yield payload, content
+
+
+async def guarded_contents(response):
+    """iter_contents 加上首个事件 / 空闲超时, 超时时抛出 StreamAbandoned"""
+    contents = iter_contents(response).__aiter__()
+    while True:
+        deadline, reason = upstream_deadline(response, time.monotonic())
+        try:
+            if deadline is None:
+                content = await contents.__anext__()
+            else:
+                content = await asyncio.wait_for(contents.__anext__(), max(deadline - time.monotonic(), 0))
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise StreamAbandoned(reason) from None
+        yield content
+
+
+async def process_non_stream_response(response, model, meter, key=None):
+    """处理非流式响应; 给定 key 时只有收到 [DONE] 且未截断的内容写入缓存"""
+    buffer = core.ContentBuffer(core.MAX_RESPONSE_BYTES)
+    async for content in guarded_contents(response):
+        meter.add(content)
+        if not buffer.append(content):
+            logging.warning("响应超过 %d 字节, 已截断", core.MAX_RESPONSE_BYTES)
+            break
+
+    full_content = buffer.getvalue()
+    if not full_content:
+        return None
+
+    if key is not None and response.done and not buffer.truncated:
+        core.response_cache.put(key, full_content, buffer.finish_reason)
+    meter.upstream = getattr(response, 'usage', None)
+    return core.build_completion(model, full_content, buffer.finish_reason, meter.usage())
+
+
+async def read_body(receive):
+    """读取完整请求体"""
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_response(send, status, body, content_type="text/plain; charset=utf-8", headers=None):
+    """发送完整响应"""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    raw_headers = [
+        (b"content-type", content_type.encode()),
+        (b"content-length", str(len(body)).encode())
+    ]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), str(value).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, data, headers=None):
+    await send_response(send, status, dumps(data), "application/json", headers)
+
+
+def get_header(scope, name):
+    """读取请求头"""
+    name = name.lower().encode()
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+async def home(scope, receive, send):
+    """健康检查端点"""
+    await send_json(send, 200, {
+        "status": "Chutes API Service Running",
+        "version": "1.0",
+        "mode": "asgi",
+        "has_auth_token": bool(core.auth_token),
+        "has_cf_clearance": bool(core.current_cf_clearance),
+        "response_cache": core.response_cache.snapshot() if core.response_cache is not None else None,
+        "admission": core.admission.snapshot() if core.admission is not None else None,
+        "logging": core.logs.snapshot(),
+        "abandoned_streams": core.stream_watchdog.snapshot()
+    })
+
+
+async def get_metrics(scope, receive, send):
+    """Prometheus 指标"""
+    await send_response(send, 200, core.metrics.render(), core.prom.CONTENT_TYPE)
+
+
+async def admin_profile(scope, receive, send):
+    """采样分析当前 worker 进程 N 秒并返回报告, 采样在线程池中进行, 事件循环照常处理请求"""
+    if not core.ADMIN_TOKEN:
+        return await send_response(send, 404, "Not Found")
+    if not core.check_admin_header(get_header(scope, "authorization")):
+        return await send_response(send, 401, "Unauthorized")
+    params = dict(urllib.parse.parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    try:
+        seconds = min(float(params.get("seconds", 10)), core.PROFILE_MAX_SECONDS)
+        interval = float(params.get("interval_ms", 5)) / 1000
+    except ValueError:
+        return await send_response(send, 400, "Invalid seconds or interval_ms")
+    loop = asyncio.get_running_loop()
+    try:
+        stacks, samples = await loop.run_in_executor(None, profiler.sample, seconds, interval)
+    except profiler.ProfilerBusy:
+        return await send_response(send, 409, "Profiling already in progress")
+    if params.get("format") == "collapsed":
+        return await send_response(send, 200, profiler.collapsed(stacks))
+    await send_response(send, 200, profiler.report(stacks, samples, seconds))
+
+
+async def admin_usage(scope, receive, send):
+    """按租户与模型汇总的用量 (所有 worker), 合并快照文件在线程池中进行"""
+    if not core.ADMIN_TOKEN:
+        return await send_response(send, 404, "Not Found")
+    if not core.check_admin_header(get_header(scope, "authorization")):
+        return await send_response(send, 401, "Unauthorized")
+    report = await asyncio.get_running_loop().run_in_executor(None, core.usage_ledger.report)
+    await send_json(send, 200, report)
+
+
+async def get_models(scope, receive, send):
+    """获取可用模型列表; 响应体按目录版本预先构造, If-None-Match 与 ETag 相同时返回 304"""
+    if not core.check_auth_header(get_header(scope, "authorization")):
+        return await send_response(send, 401, "Unauthorized")
+
+    body, etag = core.current_models_listing()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(get_header(scope, "if-none-match"), etag):
+        return await send_response(send, 304, b"", headers=headers)
+    await send_response(send, 200, body, "application/json", headers)
+
+
+async def chat(scope, receive, send):
+    """聊天完成接口"""
+    if not core.check_auth_header(get_header(scope, "authorization")):
+        return await send_response(send, 401, "Unauthorized")
+
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        openai_request = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return await send_response(send, 400, "Invalid JSON body")
+    if not isinstance(openai_request, dict):
+        return await send_response(send, 400, "请求体必须是 JSON 对象")
+
+    trace = Trace(get_header(scope, "x-request-id") or None, get_header(scope, "x-trace") == "1")
+    # 每个请求在自己的协程上下文中运行, 绑定的请求 id 不会影响其他请求
+    core.logs.bind(trace.request_id)
+    logging.info("收到新的聊天请求")
+    model = openai_request.get('model')
+    id_header = {"X-Request-Id": trace.request_id}
+    try:
+        core.validate_request(openai_request)
+        count = core.choice_count(openai_request)
+    except ValueError as e:
+        return await send_response(send, 400, str(e), headers=id_header)
+    openai_request = core.trim_context(openai_request)
+    api_key = core.request_api_key(get_header(scope, "authorization"))
+
+    key = None
+    if count == 1 and core.response_cache is not None and core.is_cacheable(openai_request):
+        key = core.completion_key(openai_request)
+        cached = core.response_cache.get(key)
+        if cached is not None:
+            logging.info("命中响应缓存")
+            usage = core.cached_usage(openai_request, cached)
+            core.usage_ledger.record(api_key, model, usage, 0, cached=True)
+            if openai_request.get('stream', False):
+                return await send_replay(send, cached, model, trace, usage if core.include_usage(openai_request) else None)
+            result = core.build_completion(model, cached.content, cached.finish_reason, usage)
+            return await send_json(send, 200, result, dict(id_header, **{"X-Cache": "HIT"}))
+
+    ticket = None
+    if core.admission is not None:
+        try:
+            with trace.span("admission"):
+                ticket = await core.admission.acquire_async(
+                    core.get_route(openai_request.get('model', 'deepseek-ai/DeepSeek-R1')).name,
+                    api_key
+                )
+        except Rejected as rejected:
+            logging.warning("请求未被准入: %s", rejected.reason)
+            return await send_response(send, rejected.status, rejected.reason,
+                                       headers=dict(id_header, **{"Retry-After": rejected.retry_after}))
+    try:
+        if count > 1:
+            await serve_choices(openai_request, count, trace, receive, send, api_key)
+        else:
+            await serve_completion(openai_request, trace, key, receive, send, api_key)
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+async def serve_completion(openai_request, trace, key, receive, send, api_key=""):
+    """请求上游并发送响应; 给定 key 时完整结束后写入缓存, 用量计入 api_key 所属的租户"""
+    model = openai_request.get('model')
+    id_header = {"X-Request-Id": trace.request_id}
+    try:
+        response, error = await make_request_with_retry(openai_request, trace=trace)
+    except CircuitOpen as e:
+        logging.warning("%s", e)
+        return await send_response(send, 503, str(e), headers=dict(id_header, **{"Retry-After": e.retry_after}))
+    except ValueError as e:
+        logging.warning("%s", e)
+        return await send_response(send, 400, str(e), headers=id_header)
+    if response is None:
+        return await send_response(send, 500, error, headers=id_header)
+
+    meter = core.usage_meter(openai_request)
+    try:
+        if not openai_request.get('stream', False):
+            try:
+                result = await process_non_stream_response(response, model, meter, key)
+            except StreamAbandoned as e:
+                core.stream_watchdog.record(response.metric_labels, e.reason)
+                core.log_abandoned(e.reason)
+                return await send_response(send, 504, f"Upstream stream abandoned: {e.reason}", headers=id_header)
+            except Exception as e:
+                # 响应尚未开始, 客户端应收到错误而不是断开的连接
+                logging.error("处理非流式响应时出错: %s", e, exc_info=True)
+                return await send_json(send, 500, {"error": {"message": "Failed to process response"}}, id_header)
+            if result is None:
+                return await send_response(send, 500, "Empty response from server", headers=id_header)
+            core.usage_ledger.record(api_key, model, result["usage"], meter.elapsed())
+            response.stats.close()
+            trace.finish()
+            headers = dict(id_header, **{"Server-Timing": trace.server_timing()})
+            if key is not None:
+                headers["X-Cache"] = "MISS"
+            return await send_json(send, 200, result, headers)
+
+        try:
+            await stream_response(openai_request, response, receive, send, key, trace, meter)
+        finally:
+            # 客户端中途断开时按已生成的部分计入
+            meter.upstream = getattr(response, 'usage', None)
+            core.usage_ledger.record(api_key, model, meter.usage(), meter.elapsed())
+    except Exception as e:
+        logging.error("聊天接口出错: %s", e, exc_info=True)
+    finally:
+        response.stats.close()
+        trace.finish()
+        await response.aclose()
+
+
+async def send_replay(send, entry, model, trace, usage=None):
+    """以 SSE 流回放缓存的补全"""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": stream_headers(trace) + [(b"x-cache", b"HIT")]
+    })
+    for frame in core.replay_cached(entry, model, usage):
+        await send({"type": "http.response.body", "body": frame, "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def stream_headers(trace, key=None):
+    headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+    if trace.request_id:
+        headers.append((b"x-request-id", trace.request_id.encode("latin-1")))
+    if key is not None:
+        headers.append((b"x-cache", b"MISS"))
+    return headers
+
+
+async def stream_response(openai_request, response, receive, send, key=None, trace=NULL_TRACE, meter=None):
+    """将上游流转换为 OpenAI SSE 流, 客户端断开时立即停止读取上游; 给定 key 时完整结束后写入缓存"""
+    meter = meter or core.usage_meter(openai_request)
+    report_usage = core.include_usage(openai_request)
+    encoder = ChunkEncoder(openai_request.get('model'), include_usage=report_usage)
+    coalescer = core.create_coalescer(openai_request)
+    # 透传上游的 data 帧时内容只用于计量与缓存
+    rewriter = FrameRewriter(openai_request.get('model')) \
+        if core.stream_passthrough(openai_request, coalescer) else None
+    buffer = core.ContentBuffer(core.MAX_RESPONSE_BYTES) if key is not None else None
+    contents = iter_contents(response, rewriter is not None).__aiter__()
+    next_content = None
+    written = 0.0
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    await send({"type": "http.response.start", "status": 200, "headers": stream_headers(trace, key)})
+    try:
+        while True:
+            if next_content is None:
+                next_content = asyncio.ensure_future(contents.__anext__())
+                waiting_since = time.monotonic()
+            # 合并窗口与上游超时共用 asyncio.wait 的超时, 不为每个增量另建定时任务
+            timeout = coalescer.timeout() if coalescer is not None else None
+            deadline, reason = upstream_deadline(response, waiting_since)
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            done, _ = await asyncio.wait(
+                {next_content, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected in done:
+                core.stream_watchdog.record(response.metric_labels, CLIENT_DISCONNECT)
+                core.log_abandoned(CLIENT_DISCONNECT)
+                return
+            frame = None
+            if next_content not in done:
+                if deadline is not None and (coalescer is None or time.monotonic() >= deadline):
+                    core.stream_watchdog.record(response.metric_labels, reason)
+                    core.log_abandoned(reason)
+                    return
+                # 合并窗口到期, 先发出已累积的内容
+                content = coalescer.expired()
+            else:
+                try:
+                    content = next_content.result()
+                except StopAsyncIteration:
+                    break
+                next_content = None
+                if rewriter is not None:
+                    payload, content = content
+                    frame = rewriter.frame(payload)
+                if content:
+                    meter.add(content)
+                    if buffer is not None and not buffer.append(content):
+                        buffer = None
+                if coalescer is not None:
+                    content = coalescer.push(content)
+            if content and frame is None:
+                frame = encoder.encode(content)
+            if frame is not None:
+                write_start = time.monotonic()
+                await send({"type": "http.response.body", "body": frame, "more_body": True})
+                written += time.monotonic() - write_start
+
+        if coalescer is not None:
+            rest = coalescer.flush()
+            if rest:
+                await send({"type": "http.response.body", "body": encoder.encode(rest), "more_body": True})
+        if rewriter is not None:
+            # 用量块沿用上游的 id
+            encoder.id = rewriter.id or encoder.id
+        # 与 Flask 模式一致: 上游没有发出 [DONE] 时 (连接提前结束) 不写缓存, 也不发出用量块与 [DONE]
+        if response.done:
+            if buffer is not None and buffer.chars:
+                core.response_cache.put(key, buffer.getvalue())
+            if report_usage:
+                meter.upstream = getattr(response, 'usage', None)
+                await send({"type": "http.response.body", "body": encoder.encode_usage(meter.usage()),
+                            "more_body": True})
+            if trace.emit:
+                response.stats.close()
+                trace.add_total("client_write", written)
+                written = 0.0
+                trace.finish()
+                await send({"type": "http.response.body", "body": trace.sse_comment(), "more_body": True})
+            await send({"type": "http.response.body", "body": DONE_FRAME, "more_body": True})
+    except Exception as e:
+        logging.error("生成响应时出错: %s", e, exc_info=True)
+    finally:
+        if next_content is not None and not next_content.done():
+            next_content.cancel()
+        disconnected.cancel()
+        trace.add_total("client_write", written)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def serve_choices(openai_request, count, trace, receive, send, api_key=""):
+    """n > 1: count 路上游请求并发进行, 增量按 choice 序号合并为一个响应
+
+    第一路使用请求本身的准入名额, 其余各路各自申请, 与其他请求共享并发上限。
+    """
+    model = openai_request.get('model')
+    id_header = {"X-Request-Id": trace.request_id}
+    leg_request = {k: v for k, v in openai_request.items() if k != 'n'}
+    route_name = core.get_route(openai_request.get('model', 'deepseek-ai/DeepSeek-R1')).name
+
+    async def open_leg(index):
+        ticket = None
+        if index and core.admission is not None:
+            try:
+                ticket = await core.admission.acquire_async(route_name, api_key)
+            except Rejected as rejected:
+                raise LegFailed(rejected.status, rejected.reason)
+        try:
+            response, error = await make_request_with_retry(leg_request, trace=trace)
+        except BaseException as e:
+            if ticket is not None:
+                ticket.release()
+            if isinstance(e, CircuitOpen):
+                raise LegFailed(503, str(e))
+            if isinstance(e, ValueError):
+                raise LegFailed(400, str(e))
+            raise
+        if response is None:
+            if ticket is not None:
+                ticket.release()
+            raise LegFailed(500, error)
+        response.ticket = ticket
+        return response
+
+    async def close_leg(response):
+        response.stats.close()
+        if response.ticket is not None:
+            response.ticket.release()
+        await response.aclose()
+
+    fanout = AsyncFanout(count, open_leg, guarded_contents, close_leg)
+    fanout.start()
+    meters = None
+    try:
+        with trace.span("fanout", n=count):
+            error = await fanout.wait_started()
+        if error:
+            return await send_response(send, error[0], error[1], headers=id_header)
+
+        prompt_tokens = core.usage_meter(openai_request).prompt_tokens
+        meters = [core.UsageMeter(prompt_tokens) for _ in range(count)]
+        if openai_request.get('stream', False):
+            return await stream_choices(openai_request, fanout, meters, receive, send, trace)
+
+        buffers = [core.ContentBuffer(core.MAX_RESPONSE_BYTES) for _ in range(count)]
+        while True:
+            item = await fanout.next()
+            if item is None:
+                break
+            index, content = item
+            buffer = buffers[index]
+            if buffer.truncated:
+                continue
+            meters[index].add(content)
+            if not buffer.append(content):
+                logging.warning("第 %d 路响应超过 %d 字节, 已截断", index + 1, core.MAX_RESPONSE_BYTES)
+        error = leg_failure(fanout)
+        if isinstance(error, StreamAbandoned):
+            return await send_response(send, 504, f"Upstream stream abandoned: {error.reason}", headers=id_header)
+        if error is not None:
+            logging.error("处理非流式响应时出错: %s", error)
+            return await send_response(send, 500, "Failed to process response", headers=id_header)
+        if not any(buffer.chars for buffer in buffers):
+            return await send_response(send, 500, "Empty response from server", headers=id_header)
+        choices = [core.completion_choice(buffer.getvalue(), buffer.finish_reason, index)
+                   for index, buffer in enumerate(buffers)]
+        result = core.build_completion(model, None, usage=choices_usage(fanout, meters), choices=choices)
+        trace.finish()
+        return await send_json(send, 200, result, dict(id_header, **{"Server-Timing": trace.server_timing()}))
+    except Exception as e:
+        logging.error("聊天接口出错: %s", e, exc_info=True)
+    finally:
+        fanout.cancel()
+        trace.finish()
+        if meters is not None:
+            # 客户端中途断开时按已生成的部分计入
+            core.usage_ledger.record(api_key, model, choices_usage(fanout, meters),
+                                     max(meter.elapsed() for meter in meters))
+
+
+def choices_usage(fanout, meters):
+    for meter, leg in zip(meters, fanout.legs):
+        meter.upstream = getattr(leg.handle, 'usage', None)
+    return core.merge_usage([meter.usage() for meter in meters])
+
+
+def leg_failure(fanout):
+    """记录各路的超时并返回决定响应的错误 (见 core.leg_error)"""
+    for leg in fanout.legs:
+        if isinstance(leg.error, StreamAbandoned):
+            core.stream_watchdog.record(leg.handle.metric_labels, leg.error.reason)
+    error = core.leg_error(fanout)
+    if isinstance(error, StreamAbandoned):
+        core.log_abandoned(error.reason)
+    return error
+
+
+async def stream_choices(openai_request, fanout, meters, receive, send, trace):
+    """n > 1 的流式响应: 各路增量按到达顺序发出, 每个 choice 一个编码器; 客户端断开时取消所有路"""
+    model = openai_request.get('model')
+    report_usage = core.include_usage(openai_request)
+    first = ChunkEncoder(model, include_usage=report_usage)
+    encoders = [first] + [ChunkEncoder(model, first.id, first.created, report_usage, index)
+                          for index in range(1, len(meters))]
+    next_item = None
+    written = 0.0
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    await send({"type": "http.response.start", "status": 200, "headers": stream_headers(trace)})
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(fanout.next())
+            done, _ = await asyncio.wait({next_item, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                for leg in fanout.legs:
+                    if not leg.finished:
+                        core.stream_watchdog.record(leg.handle.metric_labels, CLIENT_DISCONNECT)
+                core.log_abandoned(CLIENT_DISCONNECT)
+                return
+            item = next_item.result()
+            next_item = None
+            if item is None:
+                break
+            index, content = item
+            meters[index].add(content)
+            write_start = time.monotonic()
+            await send({"type": "http.response.body", "body": encoders[index].encode(content), "more_body": True})
+            written += time.monotonic() - write_start
+
+        if leg_failure(fanout) is not None:
+            return
+        if not all(leg.handle.done for leg in fanout.legs):
+            return
+        if report_usage:
+            await send({"type": "http.response.body", "body": first.encode_usage(choices_usage(fanout, meters)),
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": DONE_FRAME, "more_body": True})
+    except Exception as e:
+        logging.error("生成响应时出错: %s", e, exc_info=True)
+    finally:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
+        disconnected.cancel()
+        trace.add_total("client_write", written)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def send_file(send, chunks):
+    """逐块发送文件内容, 读取在线程池中进行"""
+    loop = asyncio.get_running_loop()
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/jsonl")]})
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def batch_api(scope, receive, send):
+    """/v1/files 与 /v1/batches; 存储与执行与 Flask 版本共用, 磁盘操作放到线程池执行"""
+    if not core.check_auth_header(get_header(scope, "authorization")):
+        return await send_response(send, 401, "Unauthorized")
+    loop = asyncio.get_running_loop()
+    store = core.batch_store
+    method = scope["method"]
+    parts = scope["path"].strip("/").split("/")[1:]
+    params = dict(urllib.parse.parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+
+    def run(func, *args):
+        return loop.run_in_executor(None, func, *args)
+
+    try:
+        if parts == ["files"] and method == "POST":
+            body = await read_body(receive)
+            if body is None:
+                return
+            fields = parse_multipart(get_header(scope, "content-type"), body)
+            if "file" not in fields:
+                return await send_response(send, 400, "缺少 file 字段")
+            filename, content = fields["file"]
+            purpose = fields.get("purpose", (None, b""))[1].decode("utf-8", "replace")
+            return await send_json(send, 200, await run(store.create_file, filename, purpose, lambda f: f.write(content)))
+        if len(parts) == 2 and parts[0] == "files" and method == "GET":
+            return await send_json(send, 200, await run(store.get_file, parts[1]))
+        if len(parts) == 3 and parts[0] == "files" and parts[2] == "content" and method == "GET":
+            await run(store.get_file, parts[1])
+            return await send_file(send, store.iter_file(parts[1]))
+        if parts == ["batches"] and method == "POST":
+            body = await read_body(receive)
+            if body is None:
+                return
+            try:
+                request = json.loads(body) if body else {}
+            except ValueError:
+                return await send_response(send, 400, "Invalid JSON")
+            batch = await run(
+                store.create_batch,
+                request.get("input_file_id"),
+                request.get("endpoint"),
+                request.get("completion_window", "24h"),
+                request.get("metadata")
+            )
+            core.batch_runner.submit(batch["id"])
+            return await send_json(send, 200, batch)
+        if parts == ["batches"] and method == "GET":
+            try:
+                limit = max(1, min(int(params.get("limit", 20)), 100))
+            except ValueError:
+                return await send_response(send, 400, "Invalid limit")
+            return await send_json(send, 200, await run(store.list_batches, limit, params.get("after")))
+        if len(parts) == 2 and parts[0] == "batches" and method == "GET":
+            return await send_json(send, 200, await run(store.get_batch, parts[1]))
+        if len(parts) == 3 and parts[0] == "batches" and parts[2] == "cancel" and method == "POST":
+            return await send_json(send, 200, await run(store.cancel_batch, parts[1]))
+    except BatchError as e:
+        return await send_response(send, e.status, e.message)
+    await send_response(send, 404, "Not Found")
+
+
+ROUTES = {
+    ("GET", "/"): home,
+    ("GET", "/metrics"): get_metrics,
+    ("GET", "/v1/models"): get_models,
+    ("POST", "/v1/chat/completions"): chat,
+    ("POST", "/admin/profile"): admin_profile,
+    ("GET", "/admin/usage"): admin_usage,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_client()
+            if ASGI_WORKERS > 1:
+                core.metrics.start_exporter(core.METRICS_DIR, core.METRICS_EXPORT_INTERVAL)
+            core.batch_runner.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI 入口"""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None and scope["path"].startswith(("/v1/files", "/v1/batches")):
+        handler = batch_api
+    if handler is None:
+        return await send_response(send, 404, "Not Found")
+    await handler(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', 8805))
+    core.metrics.clear_dir(core.METRICS_DIR)
+    uvicorn.run("asgi_app:app", host='0.0.0.0', port=port, workers=ASGI_WORKERS, log_level="warning")
@@ -0,0 +1,330 @@
+"""上游后端注册与路由
+
+- 后端类型: chutes (默认, 在 app.py 中实现)、openai (任意 OpenAI 兼容的 /v1/chat/completions, 如本地 vLLM)、stub (测试用的本地假上游)
+- 一个模型可以路由到多个目标 (后端 + 上游模型名), 按权重与 EWMA 延迟选择, 失败时自动切换到下一个目标
+- 配置来自 BACKENDS_FILE 指向的 JSON 文件或 BACKENDS_JSON:
+  {"backends": {"vllm": {"type": "openai", "url": "http://127.0.0.1:8000/v1/chat/completions", "api_key": ""}},
+   "models": {"Qwen/Qwen2.5-72B-Instruct": [{"backend": "vllm", "weight": 3}, {"backend": "chutes"}]}}
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+
+from session_pool import SessionPool
+from tracing import NULL_TRACE
+
+# 路由策略: least_outstanding (按进行中请求数与延迟) 或 weighted (按权重与延迟随机)
+ROUTING_POLICY = os.getenv('ROUTING_POLICY', 'least_outstanding')
+# EWMA 平滑系数
+EWMA_ALPHA = 0.3
+# 失败时计入 EWMA 的延迟惩罚倍数与下限 (秒)
+FAILURE_PENALTY = 2.0
+FAILURE_LATENCY = 1.0
+
+
+class Backend:
+    """上游后端; build() 构造上游请求体, send() / send_async() 发送该请求体并返回流式响应对象,
+    与 requests / httpx 的响应接口一致"""
+
+    kind = None
+
+    def __init__(self, name, config=None):
+        self.name = name
+        self.config = config or {}
+
+    def target_name(self, upstream_model):
+        """熔断器与指标使用的目标名"""
+        return f"{self.name}:{upstream_model}"
+
+    def build(self, openai_request, upstream_model):
+        """上游请求体; 请求无法转换时抛出 ValueError, 在发送之前调用, 不计入熔断与重试"""
+        return upstream_body(openai_request, upstream_model)
+
+    def send(self, body, trace=NULL_TRACE):
+        raise NotImplementedError
+
+    async def send_async(self, client, body):
+        raise NotImplementedError
+
+    def reset(self):
+        """fork 之后重置连接"""
+
+    def stats(self):
+        return None
+
+
+def upstream_body(openai_request, upstream_model):
+    """OpenAI 兼容后端的请求体: 替换模型名, 上游始终以流式返回, 非流式请求在本地聚合"""
+    body = {k: v for k, v in openai_request.items() if k not in ("cache",)}
+    body["model"] = upstream_model
+    body["stream"] = True
+    return body
+
+
+class OpenAIBackend(Backend):
+    """任意 OpenAI 兼容的 HTTP 服务"""
+
+    kind = "openai"
+
+    def __init__(self, name, config=None):
+        super().__init__(name, config)
+        self.url = self.config["url"]
+        self.headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        if self.config.get("api_key"):
+            self.headers["Authorization"] = f"Bearer {self.config['api_key']}"
+        self.timeout = float(self.config.get("connect_timeout", 10))
+        # socket 读超时 (秒), 默认不限制; 按事件计时的首个事件 / 空闲超时由看门狗负责
+        self.read_timeout = float(self.config["read_timeout"]) if self.config.get("read_timeout") else None
+        self.pool = self._create_pool()
+
+    def _create_pool(self):
+        def factory():
+            session = requests.Session()
+            session.headers.update(self.headers)
+            return session
+        return SessionPool(factory, max_size=int(self.config.get("pool_size", 16)))
+
+    def send(self, body, trace=NULL_TRACE):
+        with trace.span("acquire_session"):
+            session = self.pool.acquire()
+        try:
+            response = session.post(
+                self.url,
+                json=body,
+                stream=True,
+                timeout=(self.timeout, self.read_timeout)
+            )
+        except Exception:
+            self.pool.release(session, discard=True)
+            raise
+        response.pooled_session = session
+        response.session_pool = self.pool
+        return response
+
+    async def send_async(self, client, body):
+        request = client.build_request("POST", self.url, json=body, headers=self.headers)
+        return await client.send(request, stream=True)
+
+    def reset(self):
+        self.pool = self._create_pool()
+
+    def stats(self):
+        return self.pool.stats()
+
+
+class _StubRaw:
+    chunked = True
+
+
+class StubResponse:
+    """本地生成的 SSE 响应, 同时提供 requests 与 httpx 风格的读取接口"""
+
+    def __init__(self, frames, status_code=200, delay=0.0, text=""):
+        self.status_code = status_code
+        self.text = text
+        self.raw = _StubRaw()
+        self._frames = frames
+        self._delay = delay
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for frame in self._frames:
+            if self.closed:
+                return
+            if self._delay:
+                time.sleep(self._delay)
+            yield frame
+
+    async def aiter_bytes(self):
+        for frame in self._frames:
+            if self.closed:
+                return
+            if self._delay:
+                await asyncio.sleep(self._delay)
+            yield frame
+
+    async def aread(self):
+        return self.text.encode("utf-8")
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+
+class StubBackend(Backend):
+    """测试用后端: 把固定文本按词逐个以 SSE 返回, 可设置每帧延迟与状态码"""
+
+    kind = "stub"
+
+    def __init__(self, name, config=None):
+        super().__init__(name, config)
+        self.text = self.config.get("text", "Hello from the stub backend.")
+        self.delay = float(self.config.get("delay", 0))
+        self.status = int(self.config.get("status", 200))
+
+    def _response(self, upstream_model):
+        if self.status != 200:
+            return StubResponse([], self.status, text=f"stub error {self.status}")
+        frames = []
+        words = self.text.split(" ")
+        for i, word in enumerate(words):
+            chunk = {"model": upstream_model, "choices": [{"index": 0, "delta": {
+                "content": word if i == len(words) - 1 else word + " "}}]}
+            frames.append(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+        frames.append(b"data: [DONE]\n\n")
+        return StubResponse(frames, delay=self.delay)
+
+    def send(self, body, trace=NULL_TRACE):
+        return self._response(body["model"])
+
+    async def send_async(self, client, body):
+        return self._response(body["model"])
+
+
+class Target:
+    """路由目标: 后端 + 上游模型名, 记录进行中请求数与 EWMA 延迟"""
+
+    __slots__ = ('backend', 'upstream_model', 'name', 'weight', 'outstanding', 'ewma', 'failures', '_lock')
+
+    def __init__(self, backend, upstream_model, weight=1.0):
+        self.backend = backend
+        self.upstream_model = upstream_model
+        self.name = backend.target_name(upstream_model)
+        self.weight = max(float(weight), 0.001)
+        self.outstanding = 0
+        self.ewma = None
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def observe(self, latency, success=True):
+        """记录响应头延迟; 失败时按当前 EWMA 的倍数惩罚"""
+        with self._lock:
+            if not success:
+                self.failures += 1
+                latency = max(latency, (self.ewma or latency) * FAILURE_PENALTY, FAILURE_LATENCY)
+            self.ewma = latency if self.ewma is None else self.ewma + (latency - self.ewma) * EWMA_ALPHA
+
+    def end(self):
+        with self._lock:
+            self.outstanding = max(0, self.outstanding - 1)
+
+    def cost(self):
+        """least_outstanding 的排序依据, 越小越优先; 没有延迟数据时视为最快, 让新目标尽快得到样本"""
+        if self.ewma is None:
+            return 0.0
+        return (self.outstanding + 1) * self.ewma / self.weight
+
+    def snapshot(self):
+        return {
+            "backend": self.backend.name,
+            "model": self.upstream_model,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "failures": self.failures
+        }
+
+
+def build_bodies(targets, openai_request):
+    """每个候选目标的上游请求体 {目标: 请求体}; 请求无法转换时抛出 ValueError (客户端错误, 不发往上游)"""
+    bodies = {}
+    for target in targets:
+        try:
+            bodies[target] = target.backend.build(openai_request, target.upstream_model)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"无效的请求: {e!r}") from e
+    return bodies
+
+
+class Route:
+    """单个模型的所有路由目标"""
+
+    def __init__(self, name, targets):
+        self.name = name
+        self.targets = targets
+
+    def candidates(self, policy=None):
+        """按策略排序的目标列表, 第一个为首选, 其余用于故障切换"""
+        policy = policy or ROUTING_POLICY
+        if len(self.targets) == 1:
+            return list(self.targets)
+        if policy == "weighted":
+            remaining = list(self.targets)
+            ordered = []
+            while remaining:
+                weights = [t.weight / (t.ewma or 0.001) for t in remaining]
+                choice = random.choices(range(len(remaining)), weights)[0]
+                ordered.append(remaining.pop(choice))
+            return ordered
+        return sorted(self.targets, key=Target.cost)
+
+
+class BackendRegistry:
+    """后端与模型路由表"""
+
+    def __init__(self, backend_types):
+        self.backend_types = dict(backend_types)
+        self.backends = {}
+        self.routes = {}
+
+    def add_backend(self, name, config):
+        kind = config.get("type", "openai")
+        factory = self.backend_types.get(kind)
+        if factory is None:
+            raise ValueError(f"未知的后端类型: {kind}")
+        backend = self.backends[name] = factory(name, config)
+        return backend
+
+    def add_route(self, model, name, targets):
+        self.routes[model] = Route(name, targets)
+
+    def load(self, config, default_upstream):
+        """加载 {"backends": ..., "models": ...} 配置; default_upstream(backend, model) 给出未指定上游模型名时的默认值"""
+        for name, backend_config in (config.get("backends") or {}).items():
+            self.add_backend(name, backend_config)
+        for model, entries in (config.get("models") or {}).items():
+            targets = []
+            for entry in entries:
+                backend = self.backends[entry["backend"]]
+                upstream_model = entry.get("model") or default_upstream(backend, model)
+                targets.append(Target(backend, upstream_model, entry.get("weight", 1)))
+            self.add_route(model, model, targets)
+
+    def route(self, model):
+        return self.routes.get(model)
+
+    def reset(self):
+        for backend in self.backends.values():
+            backend.reset()
+
+    def snapshot(self):
+        return {
+            "policy": ROUTING_POLICY,
+            "routes": {model: [t.snapshot() for t in route.targets] for model, route in self.routes.items()
+                       if len(route.targets) > 1 or route.targets[0].backend.kind != "chutes"},
+            "backends": {name: backend.stats() for name, backend in self.backends.items()
+                         if backend.stats() is not None}
+        }
+
+
+def load_config():
+    """读取 BACKENDS_FILE / BACKENDS_JSON, 都未设置时返回空配置"""
+    path = os.getenv('BACKENDS_FILE')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    raw = os.getenv('BACKENDS_JSON')
+    if raw:
+        return json.loads(raw)
+    return {}
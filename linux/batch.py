@@ -0,0 +1,531 @@
+"""离线批处理 (兼容 OpenAI 的 /v1/files 与 /v1/batches)
+
+- 上传的 JSONL 文件与批处理状态保存在同一目录, 多个 worker 进程共享
+- 每行一个请求 {"custom_id", "method", "url", "body"}, 由线程池执行, 同一模型的并发数单独限制
+- 结果逐行追加写入输出文件 (失败的写入错误文件), 运行期间即可下载已完成的部分
+- 已写出的 custom_id 就是检查点: 进程重启或 worker 回收后, 其它进程定期扫描未完成的批处理并从检查点继续
+- 正在执行的批处理持有文件锁 (fcntl.flock), 保证同一时刻只在一个进程中执行
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.parser import BytesParser
+from email.policy import HTTP
+
+from codec import dumps
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+# 未结束的状态; 扫描时这些批处理会被继续执行
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+_WINDOW_RE = re.compile(r'^(\d+)h$')
+
+
+class BatchError(Exception):
+    """批处理接口的请求错误"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def parse_multipart(content_type, body):
+    """解析 multipart/form-data 请求体, 返回 {字段名: (文件名, 内容)}"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise BatchError(400, "请求体不是 multipart/form-data")
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name:
+            fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+    return fields
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(dumps(data))
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    with open(path, "rb") as f:
+        return json.loads(f.read())
+
+
+class BatchStore:
+    """文件与批处理状态的磁盘存储"""
+
+    def __init__(self, root):
+        self.root = root
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+
+    # ---- 文件 ----
+
+    def file_path(self, file_id):
+        return os.path.join(self.files_dir, file_id)
+
+    def create_file(self, filename, purpose, write):
+        """保存上传的文件; write(f) 把内容写入打开的二进制文件"""
+        if purpose != "batch":
+            raise BatchError(400, f"不支持的 purpose: {purpose}, 只支持 batch")
+        file_id = "file-" + uuid.uuid4().hex[:24]
+        path = self.file_path(file_id)
+        with open(path, "wb") as f:
+            write(f)
+        return self._save_file_meta(file_id, filename or "upload.jsonl", purpose)
+
+    def _save_file_meta(self, file_id, filename, purpose):
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": 0,
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose
+        }
+        path = self.file_path(file_id)
+        if os.path.exists(path):
+            meta["bytes"] = os.path.getsize(path)
+        _write_json(path + ".json", meta)
+        return meta
+
+    def get_file(self, file_id):
+        if not _ID_RE.match(file_id or ""):
+            raise BatchError(404, f"文件不存在: {file_id}")
+        try:
+            meta = _read_json(self.file_path(file_id) + ".json")
+        except FileNotFoundError:
+            raise BatchError(404, f"文件不存在: {file_id}")
+        path = self.file_path(file_id)
+        # 输出文件在运行期间持续增长
+        meta["bytes"] = os.path.getsize(path) if os.path.exists(path) else 0
+        return meta
+
+    def iter_file(self, file_id, chunk_size=65536):
+        """逐块读取文件内容"""
+        self.get_file(file_id)
+        path = self.file_path(file_id)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    # ---- 批处理 ----
+
+    def batch_path(self, batch_id):
+        return os.path.join(self.batches_dir, batch_id + ".json")
+
+    def run_lock_path(self, batch_id):
+        return os.path.join(self.batches_dir, batch_id + ".run")
+
+    @contextmanager
+    def _locked(self, batch_id):
+        """跨进程修改批处理状态时持有的锁"""
+        with open(os.path.join(self.batches_dir, batch_id + ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def iter_requests(self, file_id):
+        """逐行读取输入文件, 产出 (行号, custom_id, body); 格式错误时抛出 BatchError"""
+        seen = set()
+        with open(self.file_path(file_id), "rb") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    raise BatchError(400, f"第 {line_no} 行不是合法的 JSON")
+                if not isinstance(item, dict):
+                    raise BatchError(400, f"第 {line_no} 行不是 JSON 对象")
+                custom_id = item.get("custom_id")
+                body = item.get("body")
+                if not isinstance(custom_id, str) or not custom_id:
+                    raise BatchError(400, f"第 {line_no} 行缺少 custom_id")
+                if custom_id in seen:
+                    raise BatchError(400, f"第 {line_no} 行的 custom_id 重复: {custom_id}")
+                if item.get("method", "POST").upper() != "POST" or item.get("url") not in SUPPORTED_ENDPOINTS:
+                    raise BatchError(400, f"第 {line_no} 行: 只支持 POST {', '.join(SUPPORTED_ENDPOINTS)}")
+                if not isinstance(body, dict) or not body.get("model"):
+                    raise BatchError(400, f"第 {line_no} 行的 body 缺少 model")
+                seen.add(custom_id)
+                yield line_no, custom_id, body
+
+    def create_batch(self, input_file_id, endpoint, completion_window="24h", metadata=None):
+        """校验输入文件并创建批处理"""
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise BatchError(400, f"不支持的 endpoint: {endpoint}")
+        match = _WINDOW_RE.match(completion_window or "")
+        if not match:
+            raise BatchError(400, f"不支持的 completion_window: {completion_window}")
+        self.get_file(input_file_id)
+        total = sum(1 for _ in self.iter_requests(input_file_id))
+        if total == 0:
+            raise BatchError(400, "输入文件为空")
+
+        batch_id = "batch_" + uuid.uuid4().hex
+        output = self._save_file_meta("file-" + uuid.uuid4().hex[:24], f"{batch_id}_output.jsonl", "batch_output")
+        errors = self._save_file_meta("file-" + uuid.uuid4().hex[:24], f"{batch_id}_error.jsonl", "batch_output")
+        now = int(time.time())
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "in_progress",
+            "output_file_id": output["id"],
+            "error_file_id": errors["id"],
+            "created_at": now,
+            "in_progress_at": now,
+            "expires_at": now + int(match.group(1)) * 3600,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "metadata": metadata
+        }
+        _write_json(self.batch_path(batch_id), batch)
+        return batch
+
+    def get_batch(self, batch_id):
+        if not _ID_RE.match(batch_id or ""):
+            raise BatchError(404, f"批处理不存在: {batch_id}")
+        try:
+            return _read_json(self.batch_path(batch_id))
+        except FileNotFoundError:
+            raise BatchError(404, f"批处理不存在: {batch_id}")
+
+    def update_batch(self, batch_id, **changes):
+        """读取-修改-写回; request_counts 只更新给出的字段"""
+        with self._locked(batch_id):
+            batch = self.get_batch(batch_id)
+            counts = changes.pop("request_counts", None)
+            if counts:
+                batch["request_counts"].update(counts)
+            batch.update(changes)
+            _write_json(self.batch_path(batch_id), batch)
+            return batch
+
+    def list_batches(self, limit=20, after=None):
+        """按创建时间倒序列出, after 为上一页最后一个批处理的 id"""
+        batches = []
+        for name in os.listdir(self.batches_dir):
+            if name.endswith(".json"):
+                try:
+                    batches.append(_read_json(os.path.join(self.batches_dir, name)))
+                except (OSError, ValueError):
+                    continue
+        batches.sort(key=lambda batch: (batch["created_at"], batch["id"]), reverse=True)
+        if after:
+            ids = [batch["id"] for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": page,
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > limit
+        }
+
+    def cancel_batch(self, batch_id):
+        with self._locked(batch_id):
+            batch = self.get_batch(batch_id)
+            if batch["status"] in ("cancelling", "cancelled"):
+                return batch
+            if batch["status"] not in ACTIVE_STATUSES:
+                raise BatchError(400, f"批处理已结束 ({batch['status']}), 无法取消")
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = int(time.time())
+            _write_json(self.batch_path(batch_id), batch)
+            return batch
+
+    def active_batches(self):
+        """未结束的批处理 id"""
+        result = []
+        for name in os.listdir(self.batches_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                batch = _read_json(os.path.join(self.batches_dir, name))
+            except (OSError, ValueError):
+                continue
+            if batch.get("status") in ACTIVE_STATUSES:
+                result.append(batch["id"])
+        return result
+
+    def checkpoint(self, batch):
+        """已写出结果的 custom_id 与成功/失败数; 截掉进程中断时写了一半的最后一行"""
+        done = set()
+        counts = {}
+        for key, file_id in (("completed", batch["output_file_id"]), ("failed", batch["error_file_id"])):
+            counts[key] = 0
+            path = self.file_path(file_id)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb+") as f:
+                data = f.read()
+                end = data.rfind(b"\n") + 1
+                if end != len(data):
+                    f.truncate(end)
+            for line in data[:end].splitlines():
+                try:
+                    done.add(json.loads(line)["custom_id"])
+                    counts[key] += 1
+                except (ValueError, KeyError):
+                    continue
+        return done, counts
+
+
+class _InFlight:
+    """进行中的请求计数"""
+
+    def __init__(self):
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def add(self):
+        with self._cond:
+            self.count += 1
+
+    def done(self):
+        with self._cond:
+            self.count -= 1
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        """等待全部完成, 返回是否已全部完成"""
+        with self._cond:
+            if self.count:
+                self._cond.wait(timeout)
+            return self.count == 0
+
+
+class BatchRunner:
+    """执行批处理
+
+    execute(body) 执行单个请求并返回 (状态码, 响应体, 请求 id)。
+    所有批处理共用 workers 个线程, 每个模型 (按 model_key(model) 归类) 最多 concurrency 个并发,
+    limits 可以单独设置某些模型的并发数。
+    """
+
+    def __init__(self, store, execute, workers=16, concurrency=8, limits=None, model_key=None,
+                 scan_interval=30.0, progress_interval=1.0):
+        self.store = store
+        self.execute = execute
+        self.workers = workers
+        self.concurrency = concurrency
+        self.limits = dict(limits or {})
+        self.model_key = model_key or (lambda model: model)
+        self.scan_interval = scan_interval
+        self.progress_interval = progress_interval
+        self._executor = None
+        self._semaphores = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动线程池与扫描线程 (可重复调用); fork 之后才能调用"""
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="batch")
+        threading.Thread(target=self._scan_loop, daemon=True).start()
+
+    def reset(self):
+        """fork 之后丢弃从主进程继承的状态"""
+        self._executor = None
+        self._semaphores = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, batch_id):
+        """立即开始执行新创建的批处理"""
+        self.start()
+        self._claim(batch_id)
+
+    def snapshot(self):
+        with self._lock:
+            running = list(self._running)
+        return {"running": running, "workers": self.workers, "concurrency": self.concurrency}
+
+    def _scan_loop(self):
+        while True:
+            try:
+                for batch_id in self.store.active_batches():
+                    self._claim(batch_id)
+            except Exception as e:
+                logging.warning("扫描批处理失败: %s", e)
+            time.sleep(self.scan_interval)
+
+    def _claim(self, batch_id):
+        """取得批处理的执行锁后在后台执行; 其它进程正在执行时直接返回"""
+        with self._lock:
+            if batch_id in self._running:
+                return
+            lock_file = open(self.store.run_lock_path(batch_id), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return
+            self._running[batch_id] = lock_file
+        threading.Thread(target=self._run, args=(batch_id, lock_file), daemon=True).start()
+
+    def _run(self, batch_id, lock_file):
+        try:
+            self._execute_batch(batch_id)
+        except Exception as e:
+            logging.error("批处理 %s 执行失败: %s", batch_id, e, exc_info=True)
+            now = int(time.time())
+            self.store.update_batch(batch_id, status="failed", failed_at=now,
+                                    errors={"object": "list", "data": [{"code": "internal_error", "message": str(e)}]})
+        finally:
+            with self._lock:
+                self._running.pop(batch_id, None)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _semaphore(self, model):
+        key = self.model_key(model)
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                semaphore = self._semaphores[key] = threading.BoundedSemaphore(
+                    max(1, self.limits.get(key, self.limits.get(model, self.concurrency))))
+            return semaphore
+
+    def _execute_batch(self, batch_id):
+        store = self.store
+        batch = store.get_batch(batch_id)
+        done, counts = store.checkpoint(batch)
+        if done:
+            logging.info("批处理 %s 从检查点继续: 已完成 %d 个请求", batch_id, len(done))
+
+        state = {"status": batch["status"], "checked": 0.0, "saved": time.monotonic()}
+        write_lock = threading.Lock()
+        inflight = _InFlight()
+
+        def stop_reason():
+            """每 progress_interval 秒重新读取一次状态, 其它进程的取消请求经由磁盘生效"""
+            now = time.monotonic()
+            if now - state["checked"] >= self.progress_interval:
+                state["checked"] = now
+                state["status"] = store.get_batch(batch_id)["status"]
+            if state["status"] == "cancelling":
+                return "cancelled"
+            if time.time() >= batch["expires_at"]:
+                return "expired"
+            return None
+
+        def save_progress(force=False):
+            now = time.monotonic()
+            if force or now - state["saved"] >= self.progress_interval:
+                state["saved"] = now
+                with write_lock:
+                    snapshot = dict(counts)
+                store.update_batch(batch_id, request_counts=snapshot)
+
+        with open(store.file_path(batch["output_file_id"]), "ab") as output, \
+                open(store.file_path(batch["error_file_id"]), "ab") as errors:
+
+            def record(custom_id, status, body, request_id):
+                ok = status == 200
+                line = {
+                    "id": "batch_req_" + uuid.uuid4().hex,
+                    "custom_id": custom_id,
+                    "response": {"status_code": status, "request_id": request_id, "body": body},
+                    "error": None if ok else {"code": "request_failed", "message": _error_message(body)}
+                }
+                data = dumps(line) + b"\n"
+                with write_lock:
+                    target = output if ok else errors
+                    target.write(data)
+                    target.flush()
+                    counts["completed" if ok else "failed"] += 1
+
+            def run_one(custom_id, body, semaphore):
+                try:
+                    try:
+                        status, response_body, request_id = self.execute(body)
+                    except Exception as e:
+                        logging.error("批处理请求 %s 出错: %s", custom_id, e, exc_info=True)
+                        status, response_body, request_id = 500, {"error": {"message": str(e)}}, None
+                    record(custom_id, status, response_body, request_id)
+                finally:
+                    semaphore.release()
+                    inflight.done()
+
+            reason = None
+            for _, custom_id, body in store.iter_requests(batch["input_file_id"]):
+                if custom_id in done:
+                    continue
+                reason = stop_reason()
+                if reason:
+                    break
+                semaphore = self._semaphore(body["model"])
+                # 等待模型的并发名额, 期间仍然响应取消
+                while not semaphore.acquire(timeout=self.progress_interval):
+                    save_progress()
+                    reason = stop_reason()
+                    if reason:
+                        break
+                if reason:
+                    break
+                inflight.add()
+                self._executor.submit(run_one, custom_id, dict(body, stream=False), semaphore)
+                save_progress()
+
+            if reason is None:
+                store.update_batch(batch_id, status="finalizing", finalizing_at=int(time.time()))
+            while not inflight.wait(self.progress_interval):
+                save_progress()
+
+        now = int(time.time())
+        with write_lock:
+            final_counts = dict(counts)
+        if reason == "cancelled":
+            store.update_batch(batch_id, status="cancelled", cancelled_at=now, request_counts=final_counts)
+        elif reason == "expired":
+            store.update_batch(batch_id, status="expired", expired_at=now, request_counts=final_counts)
+        else:
+            store.update_batch(batch_id, status="completed", completed_at=now, request_counts=final_counts)
+        logging.info("批处理 %s 结束: %s, %s", batch_id, reason or 'completed', final_counts)
+
+
+def _error_message(body):
+    if isinstance(body, dict):
+        error = body.get("error")
+        if isinstance(error, dict):
+            return str(error.get("message", ""))
+        if error:
+            return str(error)
+    return str(body)[:500]
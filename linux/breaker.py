@@ -0,0 +1,187 @@
+"""上游熔断与重试预算
+
+- 每个 chuteName 一个熔断器: 最近 window 次调用中错误率或慢调用比例超过阈值时打开,
+  打开期间直接失败; open_seconds 之后进入半开状态, 放行少量探测请求, 成功则关闭, 失败则重新打开
+- 重试预算在所有请求之间共享: 每个新请求存入 ratio 个令牌, 每次重试消耗一个,
+  另外每秒补充 min_per_second 个, 上游整体故障时重试量被限制在请求量的一定比例
+- 重试间隔为带完全抖动的指数退避, 避免大量请求在同一时刻重试
+"""
+import random
+import threading
+import time
+from collections import deque
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(Exception):
+    """熔断器打开, 请求被直接拒绝"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"上游 {name} 暂时不可用 (熔断中)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """单个 chute 的熔断器"""
+
+    def __init__(self, name, window=20, min_calls=5, error_rate=0.5, slow_seconds=30.0, slow_rate=0.8,
+                 open_seconds=30.0, half_open_calls=1, on_transition=None):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.on_transition = on_transition
+        self.state = CLOSED
+        self._outcomes = deque()
+        self._errors = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否放行一次调用, 不放行时抛出 CircuitOpen"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_seconds - now
+                if remaining > 0:
+                    raise CircuitOpen(self.name, max(1, int(remaining + 0.999)))
+                self._transition(HALF_OPEN)
+            if self._probes >= self.half_open_calls:
+                raise CircuitOpen(self.name, 1)
+            self._probes += 1
+
+    def cancel(self):
+        """放行后没有实际调用上游 (如本地出错), 归还半开状态的探测名额"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+
+    def record(self, success, latency=0.0):
+        """记录一次调用结果; latency 为收到响应头的耗时"""
+        slow = success and latency >= self.slow_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if success and not slow:
+                    self._reset()
+                    self._transition(CLOSED)
+                else:
+                    self._open()
+                return
+            if self.state == OPEN:
+                return
+
+            self._outcomes.append((not success, slow))
+            self._errors += not success
+            self._slow += slow
+            if len(self._outcomes) > self.window:
+                old_error, old_slow = self._outcomes.popleft()
+                self._errors -= old_error
+                self._slow -= old_slow
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and (
+                    self._errors / calls >= self.error_rate or self._slow / calls >= self.slow_rate):
+                self._open()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "errors": self._errors,
+                "slow": self._slow
+            }
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._reset()
+        self._transition(OPEN)
+
+    def _reset(self):
+        self._outcomes.clear()
+        self._errors = 0
+        self._slow = 0
+        self._probes = 0
+
+    def _transition(self, state):
+        if state != self.state:
+            self.state = state
+            if self.on_transition is not None:
+                self.on_transition(self.name, state)
+
+
+class BreakerRegistry:
+    """按 chuteName 创建熔断器"""
+
+    def __init__(self, **options):
+        self.options = options
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    breaker = self._breakers[name] = CircuitBreaker(name, **self.options)
+        return breaker
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+class RetryBudget:
+    """所有请求共享的重试令牌桶"""
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_tokens=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def deposit(self):
+        """新请求到达时调用"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """尝试为一次重试取出令牌"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+    def snapshot(self):
+        with self._lock:
+            self._refill()
+            return {"tokens": round(self._tokens, 2), "exhausted": self.exhausted}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+
+def backoff_delay(attempt, base=0.5, cap=4.0):
+    """第 attempt 次 (从 0 开始) 重试前的等待秒数, 完全抖动"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,197 @@
+"""确定性补全的响应缓存
+
+- 键: 请求中会影响输出的全部字段 (messages、采样参数、max_tokens、stop、tools 等) 加上 chuteName 的规范化哈希,
+  只去掉 stream / stream_options / cache 这些不影响补全内容的字段
+- 只缓存 temperature=0 或显式声明 "cache": true 的请求
+- 内存层为带 TTL 与字节预算的 LRU, 可选磁盘层 (RESPONSE_CACHE_DIR) 在重启后继续命中
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 不参与缓存键计算的请求字段: 只影响输出方式, 不影响补全内容
+_IGNORED_FIELDS = ("stream", "stream_options", "cache")
+
+
+def is_cacheable(openai_request):
+    """判断请求是否可以使用缓存: 显式的 "cache" 字段优先, 否则要求 temperature=0"""
+    explicit = openai_request.get('cache')
+    if explicit is not None:
+        return bool(explicit)
+    temperature = openai_request.get('temperature')
+    return temperature is not None and temperature == 0
+
+
+def cache_key(openai_request, chute_name):
+    """计算请求的规范化哈希; OpenAI 兼容后端会原样转发这些字段, 任何一个不同都可能得到不同的补全"""
+    canonical = {k: v for k, v in openai_request.items() if k not in _IGNORED_FIELDS}
+    canonical["chuteName"] = chute_name
+    raw = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class CacheEntry:
+    """缓存的补全结果"""
+
+    __slots__ = ('content', 'finish_reason', 'stored_at', 'size')
+
+    def __init__(self, content, finish_reason="stop", stored_at=None):
+        self.content = content
+        self.finish_reason = finish_reason
+        self.stored_at = stored_at or time.time()
+        self.size = len(content.encode('utf-8'))
+
+    def to_json(self):
+        return json.dumps({
+            "content": self.content,
+            "finish_reason": self.finish_reason,
+            "stored_at": self.stored_at
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, raw):
+        data = json.loads(raw)
+        return cls(data["content"], data.get("finish_reason", "stop"), data.get("stored_at"))
+
+
+class ResponseCache:
+    """线程安全的 LRU + TTL 响应缓存"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600, disk_dir=None, disk_max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """读取缓存, 未命中或已过期返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry.stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry
+                self._remove_locked(key)
+
+        entry = self._disk_get(key, now)
+        with self._lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+            self._put_locked(key, entry)
+        return entry
+
+    def put(self, key, content, finish_reason="stop"):
+        """写入缓存"""
+        entry = CacheEntry(content, finish_reason)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._put_locked(key, entry)
+            self.stats["stores"] += 1
+        self._disk_put(key, entry)
+
+    def snapshot(self):
+        """返回缓存状态"""
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._size)
+
+    def _put_locked(self, key, entry):
+        if key in self._entries:
+            self._remove_locked(key)
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove_locked(oldest)
+            self.stats["evictions"] += 1
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = CacheEntry.from_json(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        if now - entry.stored_at > self.ttl:
+            self._remove_file(path)
+            return None
+        return entry
+
+    def _disk_put(self, key, entry):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(entry.to_json())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("写入磁盘缓存失败: %s", e)
+            return
+        with self._lock:
+            self._disk_writes += 1
+            check = self._disk_writes % 100 == 0
+        if check:
+            self._trim_disk()
+
+    def _trim_disk(self):
+        """删除过期文件, 超出磁盘预算时从最旧的开始删除"""
+        now = time.time()
+        files = []
+        total = 0
+        try:
+            names = os.listdir(self.disk_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove_file(path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_file(path)
+            total -= size
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,247 @@
+"""模型目录: 对外提供的模型名、对应的 chuteName 与每个模型的设置
+
+- 来源: MODELS_FILE 指向的 JSON 文件 (默认为同目录下的 models.json), 或 MODELS_JSON:
+  {"default": "deepseek-ai/DeepSeek-R1",
+   "models": {"deepseek-ai/DeepSeek-R1": {"chute": "chutes-deepseek-ai-deepseek-r1", "aliases": ["r1"],
+                                          "context_tokens": 60000, "max_concurrency": 8},
+              "Qwen/Qwen2.5-72B-Instruct": "chutes-qwen-qwen2-5-72b-instruct"}}
+  值只有 chuteName 时可以直接写字符串; default 为未知模型使用的模型
+- 文件每 interval 秒检查一次修改时间, 内容变化后重新加载: 新目录完整构造后整体替换 (写时复制),
+  读取方拿到的快照不会再被修改, 进行中的请求不受影响; 新内容无效时记录错误并保留原目录
+- 检查在读取目录时顺带进行, 不需要后台线程; fork 之后每个 worker 各自检查
+linux 与 win 版本共用本模块。
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# 目录中没有 default 时未知模型使用的 chute
+DEFAULT_CHUTE = 'chutes-deepseek-ai-deepseek-r1'
+# 每个模型可以设置的字段
+SETTINGS = ('context_tokens', 'max_concurrency')
+
+
+class ModelEntry:
+    """目录中的一个模型"""
+
+    __slots__ = ('id', 'chute', 'aliases', 'owned_by', 'created', 'settings')
+
+    def __init__(self, model_id, chute, aliases=(), owned_by="chutes", created=None, settings=None):
+        self.id = model_id
+        self.chute = chute
+        self.aliases = tuple(aliases)
+        self.owned_by = owned_by
+        self.created = created
+        self.settings = settings or {}
+
+
+class Catalog:
+    """目录快照, 构造之后不再修改"""
+
+    def __init__(self, models, default=None, version="", created=0):
+        # {模型名: ModelEntry}, 按目录中的顺序
+        self.models = models
+        self.version = version
+        self.created = created
+        names = {}
+        for entry in models.values():
+            for alias in entry.aliases:
+                names[alias] = entry
+        # 别名不覆盖同名的模型
+        names.update(models)
+        self._names = names
+        self.default = models.get(default) if default is not None else None
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self.models)
+
+    def lookup(self, name):
+        """模型名或别名对应的 ModelEntry, 不在目录中时返回 None"""
+        return self._names.get(name)
+
+    def chute(self, name):
+        """模型对应的 chuteName, 未知模型使用 default"""
+        entry = self._names.get(name)
+        if entry is None:
+            entry = self.default
+        return entry.chute if entry is not None else DEFAULT_CHUTE
+
+    def setting(self, field):
+        """{chuteName: 值}, 只包含设置了 field 的模型"""
+        return {entry.chute: entry.settings[field] for entry in self.models.values() if field in entry.settings}
+
+
+def parse_catalog(config, version="", created=0):
+    """解析目录配置, 格式错误时抛出 ValueError"""
+    if not isinstance(config, dict) or not isinstance(config.get("models"), dict):
+        raise ValueError("模型目录需要 models 对象")
+    models = {}
+    for model_id, spec in config["models"].items():
+        if isinstance(spec, str):
+            spec = {"chute": spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get("chute"), str) or not spec["chute"]:
+            raise ValueError(f"模型 {model_id} 缺少 chute")
+        aliases = spec.get("aliases") or []
+        if isinstance(aliases, str) or not all(isinstance(alias, str) for alias in aliases):
+            raise ValueError(f"模型 {model_id} 的 aliases 需要是字符串列表")
+        settings = {}
+        for field in SETTINGS:
+            value = spec.get(field)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise ValueError(f"模型 {model_id} 的 {field} 需要是非负整数")
+            settings[field] = value
+        created_at = spec.get("created")
+        models[model_id] = ModelEntry(
+            model_id, spec["chute"], aliases, spec.get("owned_by", "chutes"),
+            created_at if isinstance(created_at, int) else None, settings
+        )
+    default = config.get("default")
+    if default is not None and default not in models:
+        raise ValueError(f"default 模型 {default} 不在目录中")
+    return Catalog(models, default, version, created)
+
+
+def models_response(catalog, extra=()):
+    """/v1/models 的响应体与 ETag; extra 为目录之外可用的模型 (BACKENDS 配置的路由)"""
+    data = [{
+        "id": entry.id,
+        "object": "model",
+        "created": entry.created if entry.created is not None else catalog.created,
+        "owned_by": entry.owned_by
+    } for entry in catalog.models.values()]
+    data.extend({"id": model, "object": "model", "created": catalog.created, "owned_by": "chutes"}
+                for model in extra if model not in catalog.models)
+    body = json.dumps({"object": "list", "data": data}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return body, '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+
+def etag_matches(header, etag):
+    """If-None-Match 是否包含 etag (忽略弱校验前缀)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class ModelCatalog:
+    """当前目录; path 为 None 时使用 raw (JSON 字符串), 不检查更新
+
+    on_change(catalog) 在新目录生效之前调用, 用于更新路由与各模型的限制; 抛出异常时放弃这次加载。
+    """
+
+    def __init__(self, path=None, raw=None, interval=5.0, on_change=None, on_reload=None):
+        self.path = path
+        self.raw = raw
+        self.interval = interval
+        self.on_change = on_change
+        # on_reload(result): 每次重新加载的结果 ("ok" / "error"), 用于指标
+        self.on_reload = on_reload
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._next_check = 0.0
+        self.loaded_at = None
+        self.stats = {"reloads": 0, "errors": 0}
+        self.last_error = None
+        self._catalog = self._load()
+
+    def current(self):
+        """当前目录快照; 到了检查时间时顺带检查文件是否有变化"""
+        if self.path is not None and self.interval > 0 and time.monotonic() >= self._next_check:
+            self.check()
+        return self._catalog
+
+    def check(self):
+        """检查文件修改时间, 有变化时重新加载; 其他线程正在检查时直接返回"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = time.monotonic() + self.interval
+            try:
+                stat = os.stat(self.path)
+            except OSError as e:
+                self._failed(e)
+                return False
+            if (stat.st_mtime_ns, stat.st_size) == self._stamp:
+                return False
+            return self._reload()
+        finally:
+            self._lock.release()
+
+    def apply(self, catalog):
+        """通知 on_change 后替换当前目录"""
+        if self.on_change is not None:
+            self.on_change(catalog)
+        self._catalog = catalog
+        self.loaded_at = time.time()
+
+    def _read(self):
+        if self.path is None:
+            return (self.raw or "").encode("utf-8"), int(time.time())
+        stat = os.stat(self.path)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self._stamp = (stat.st_mtime_ns, stat.st_size)
+        return data, int(stat.st_mtime)
+
+    def _parse(self, data, created):
+        version = hashlib.sha1(data).hexdigest()[:12]
+        return parse_catalog(json.loads(data), version, created)
+
+    def _load(self):
+        """启动时加载, 目录无效时直接抛出异常"""
+        catalog = self._parse(*self._read())
+        self.loaded_at = time.time()
+        return catalog
+
+    def _reload(self):
+        try:
+            data, created = self._read()
+            if hashlib.sha1(data).hexdigest()[:12] == self._catalog.version:
+                return False
+            catalog = self._parse(data, created)
+            self.apply(catalog)
+        except Exception as e:
+            self._failed(e)
+            return False
+        self.stats["reloads"] += 1
+        self.last_error = None
+        logging.info("模型目录已重新加载: 版本 %s, %d 个模型", catalog.version, len(catalog))
+        if self.on_reload is not None:
+            self.on_reload("ok")
+        return True
+
+    def _failed(self, error):
+        self.stats["errors"] += 1
+        self.last_error = str(error)
+        logging.error("模型目录加载失败, 继续使用版本 %s: %s", self._catalog.version, error)
+        if self.on_reload is not None:
+            self.on_reload("error")
+
+    def snapshot(self):
+        catalog = self._catalog
+        return dict(self.stats, version=catalog.version, models=len(catalog), source=self.path or "MODELS_JSON",
+                    last_error=self.last_error)
+
+
+def load_catalog(default_path, **options):
+    """按 MODELS_FILE / MODELS_JSON 创建 ModelCatalog; MODELS_FILE 优先, 都未设置时读取 default_path"""
+    path = os.getenv('MODELS_FILE')
+    raw = os.getenv('MODELS_JSON')
+    if not path and raw:
+        return ModelCatalog(raw=raw, **options)
+    return ModelCatalog(path or default_path, **options)
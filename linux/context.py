@@ -0,0 +1,111 @@
+"""多轮对话的上下文裁剪
+
+- 按模型的上下文预算 (减去为输出保留的 token) 从最新的消息往前保留, 系统消息与最后一条消息始终保留
+- 被丢弃的较早消息用一条说明代替, 保留部分的第一条非系统消息总是 user, 保持角色交替
+- token 数为估算值: ASCII 约 4 字符一个 token, 其余字符约一个字符一个 token, 不依赖分词器
+- 估算只需要一次 len 与一次 UTF-8 编码, 比按内容计算摘要再查缓存还快, 因此不缓存估算结果
+"""
+# 每条消息的格式开销 (角色、分隔符)
+MESSAGE_OVERHEAD = 4
+TRIM_NOTE = "[Earlier conversation truncated: {count} messages omitted]"
+
+
+def estimate_tokens(text):
+    """估算文本的 token 数"""
+    return estimate_from_counts(len(text), len(text.encode("utf-8", "surrogatepass")))
+
+
+def estimate_from_counts(chars, size):
+    """按字符数与 UTF-8 字节数估算 token 数, 用于增量累计的输出"""
+    if size == chars:
+        return (chars + 3) // 4
+    # 非 ASCII 字符大多为 3 字节 (CJK), 每个约一个 token
+    wide = min(chars, (size - chars) // 2)
+    return (chars - wide + 3) // 4 + wide
+
+
+def message_text(content):
+    """消息内容中的文本; content 可以是字符串或 OpenAI 的 content parts 列表"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return "" if content is None else str(content)
+
+
+class ContextTrimmer:
+    """按 token 预算裁剪消息列表"""
+
+    def __init__(self, max_tokens, limits=None, reserve_tokens=4096):
+        # max_tokens 为 0 时不裁剪
+        self.max_tokens = max_tokens
+        self.limits = dict(limits or {})
+        self.reserve_tokens = reserve_tokens
+        self.stats = {"trimmed": 0}
+
+    def count(self, message):
+        """单条消息的 token 估算"""
+        return estimate_tokens(message_text(message.get("content"))) + MESSAGE_OVERHEAD
+
+    def budget(self, key, max_output=None):
+        """key (模型名或 chuteName) 可用于输入的 token 数, None 表示不限制"""
+        limit = self.limits.get(key, self.max_tokens)
+        if not limit:
+            return None
+        reserve = max_output if isinstance(max_output, int) and max_output > 0 else self.reserve_tokens
+        return max(limit - reserve, 0)
+
+    def trim(self, messages, budget):
+        """返回 (裁剪后的消息列表, 丢弃的消息数); budget 为 None 或不超预算时原样返回
+
+        从最后一条往前累计, 只估算放得下的消息, 超长对话的开销与保留部分的长度成正比。
+        """
+        if budget is None or len(messages) <= 1:
+            return messages, 0
+        first_kept, _ = self._plan(messages, budget)
+        if not first_kept:
+            return messages, 0
+
+        roles = [message.get("role") for message in messages]
+        result = [message for index, message in enumerate(messages[:first_kept]) if roles[index] == "system"]
+        dropped = first_kept - len(result)
+        result.append({"role": "system", "content": TRIM_NOTE.format(count=dropped)})
+        result.extend(messages[first_kept:])
+        self.stats["trimmed"] += 1
+        return result, dropped
+
+    def measure(self, messages, budget):
+        """裁剪后实际转发的消息 (含省略说明) 的 token 估算"""
+        if budget is None or len(messages) <= 1:
+            return sum(self.count(message) for message in messages)
+        return self._plan(messages, budget)[1]
+
+    def _plan(self, messages, budget):
+        """返回 (保留部分第一条非系统消息的下标, 保留部分的 token 数); 不需要裁剪时下标为 0"""
+        last = len(messages) - 1
+        roles = [message.get("role") for message in messages]
+        count = self.count
+        used = count(messages[last]) + sum(
+            count(messages[index]) for index in range(last) if roles[index] == "system")
+        first_kept = last
+        for index in range(last - 1, -1, -1):
+            if roles[index] == "system":
+                continue
+            tokens = count(messages[index])
+            if used + tokens > budget:
+                break
+            used += tokens
+            first_kept = index
+        else:
+            return 0, used
+
+        # 为省略说明留出空间, 并让保留部分以 user 消息开头
+        used += estimate_tokens(TRIM_NOTE) + MESSAGE_OVERHEAD
+        while first_kept < last and (used > budget or roles[first_kept] != "user"):
+            if roles[first_kept] != "system":
+                used -= count(messages[first_kept])
+            first_kept += 1
+        return first_kept, used
+
+    def snapshot(self):
+        return dict(self.stats, max_tokens=self.max_tokens)
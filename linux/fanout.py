@@ -0,0 +1,206 @@
+"""n > 1: 并发发起多路上游请求, 把各路的增量合并为一个流
+
+- 每一路在自己的线程 (异步模式为任务) 中启动并读取上游, 增量连同 choice 序号放入共享的有界队列;
+  队列满时读取方等待, 客户端读取慢时背压传到每一路上游
+- wait_started() 等待所有路收到响应头; 任何一路启动失败时调用方 cancel() 其余各路并返回该错误
+- 单路读取中途出错只结束这一路 (错误保存在 error 中), 其余各路继续; cancel() 中断所有读取
+"""
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+
+# 一路读取结束的标记
+_END = object()
+
+
+class LegFailed(Exception):
+    """open() 中表示这一路启动失败, status / message 作为整个请求的错误响应"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class FanoutLeg:
+    """一路请求
+
+    handle 为 open() 的返回值; error 为启动失败的 (状态码, 消息), 或读取中途的异常。
+    """
+
+    __slots__ = ('index', 'handle', 'error', 'started', 'finished')
+
+    def __init__(self, index):
+        self.index = index
+        self.handle = None
+        self.error = None
+        self.started = False
+        self.finished = False
+
+
+def _open_failed(index, error):
+    if isinstance(error, LegFailed):
+        return (error.status, error.message)
+    logging.error("第 %d 路请求失败: %s", index + 1, error, exc_info=True)
+    return (500, str(error))
+
+
+class Fanout:
+    """线程版本
+
+    open(index) 在后台线程中调用, 返回这一路的句柄 (启动失败时抛出 LegFailed); read(handle) 返回增量内容的迭代器;
+    close(handle) 在读取结束或取消后调用; abort(handle) 从其他线程中断阻塞在该路上游读取上的线程。
+    """
+
+    def __init__(self, count, open, read, close, abort, queue_size=64):
+        self.legs = [FanoutLeg(index) for index in range(count)]
+        self.cancelled = False
+        self._open = open
+        self._read = read
+        self._close = close
+        self._abort = abort
+        self._items = queue.Queue(queue_size)
+        self._cond = threading.Condition()
+
+    def start(self):
+        for leg in self.legs:
+            # 后台线程沿用当前上下文, 日志带有同一个请求 id
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._run, leg), daemon=True).start()
+
+    def wait_started(self):
+        """等待所有路收到响应头, 返回第一个启动失败的 (状态码, 消息), 都成功时返回 None"""
+        with self._cond:
+            while True:
+                for leg in self.legs:
+                    if leg.started and leg.handle is None:
+                        return leg.error
+                if all(leg.started for leg in self.legs):
+                    return None
+                self._cond.wait()
+
+    def __iter__(self):
+        """按到达顺序产出 (choice 序号, 增量内容), 所有路结束后返回"""
+        remaining = len(self.legs)
+        items = self._items
+        while remaining:
+            index, content = items.get()
+            if content is _END:
+                remaining -= 1
+                continue
+            yield index, content
+
+    def cancel(self):
+        """停止所有路 (客户端断开或启动失败); 可重复调用"""
+        self.cancelled = True
+        with self._cond:
+            legs = [leg for leg in self.legs if leg.handle is not None and not leg.finished]
+        for leg in legs:
+            try:
+                self._abort(leg.handle)
+            except Exception:
+                pass
+
+    def _run(self, leg):
+        handle = error = None
+        try:
+            handle = self._open(leg.index)
+        except Exception as e:
+            error = _open_failed(leg.index, e)
+        with self._cond:
+            leg.handle = handle
+            leg.error = error
+            leg.started = True
+            self._cond.notify_all()
+        if handle is None:
+            return
+        try:
+            if not self.cancelled:
+                for content in self._read(handle):
+                    if not self._put((leg.index, content)):
+                        break
+        except Exception as e:
+            leg.error = e
+        finally:
+            leg.finished = True
+            self._close(handle)
+            self._put((leg.index, _END))
+
+    def _put(self, item):
+        """放入队列; 队列满时等待, 已取消时放弃并返回 False"""
+        while True:
+            try:
+                self._items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if self.cancelled:
+                    return False
+
+
+class AsyncFanout:
+    """asyncio 版本
+
+    open(index) 为协程, 返回这一路的句柄 (启动失败时抛出 LegFailed); read(handle) 返回增量内容的异步迭代器;
+    close(handle) 为协程, 读取结束或取消后调用。
+    """
+
+    def __init__(self, count, open, read, close, queue_size=64):
+        self.legs = [FanoutLeg(index) for index in range(count)]
+        self._open = open
+        self._read = read
+        self._close = close
+        self._items = asyncio.Queue(queue_size)
+        self._changed = asyncio.Event()
+        self._remaining = count
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._run(leg)) for leg in self.legs]
+
+    async def wait_started(self):
+        while True:
+            for leg in self.legs:
+                if leg.started and leg.handle is None:
+                    return leg.error
+            if all(leg.started for leg in self.legs):
+                return None
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def next(self):
+        """下一个 (choice 序号, 增量内容), 所有路结束后返回 None"""
+        while self._remaining:
+            index, content = await self._items.get()
+            if content is _END:
+                self._remaining -= 1
+                continue
+            return index, content
+        return None
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _run(self, leg):
+        try:
+            leg.handle = await self._open(leg.index)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            leg.error = _open_failed(leg.index, e)
+        finally:
+            leg.started = True
+            self._changed.set()
+        if leg.handle is None:
+            return
+        try:
+            async for content in self._read(leg.handle):
+                await self._items.put((leg.index, content))
+        except Exception as e:
+            leg.error = e
+        finally:
+            leg.finished = True
+            await self._close(leg.handle)
+        await self._items.put((leg.index, _END))
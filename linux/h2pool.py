@@ -0,0 +1,176 @@
+"""HTTP/2 上游连接池
+
+- 基于 httpx.AsyncClient(http2=True): 并发的聊天流复用少量 HTTP/2 连接, 流量控制与 GOAWAY 由 httpx / h2 处理
+- httpx 在一个 HTTP/2 连接的并发流用满后只会排队, 不会新建连接; 这里为每个连接创建一个只有一个连接的客户端,
+  新请求交给活跃流最少的那个, 并发流分摊到 max_connections 个连接上
+- 客户端运行在一个后台事件循环线程中, 请求线程把每次读取提交给该循环并等待结果。httpx 的同步客户端在多路复用的
+  连接上无法从其他线程中断阻塞的读取, 而对冲与看门狗需要这一点: 这里 cancel() 取消挂起的读取, 读取线程立即返回,
+  同一连接上的其他流不受影响
+- https 通过 ALPN 协商 h2, http 地址按 h2c (prior knowledge) 连接, 便于本地测试
+- 响应对象提供代理用到的 requests.Response 接口 (status_code / headers / text / iter_content / close)
+"""
+import asyncio
+import concurrent.futures
+import threading
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class H2Error(Exception):
+    """HTTP/2 请求被取消"""
+
+
+async def _next_chunk(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class _Raw:
+    """与 requests 的 response.raw 兼容: 响应体按数据帧到达即处理"""
+
+    chunked = True
+
+
+class H2Response:
+    """HTTP/2 流式响应"""
+
+    raw = _Raw()
+
+    def __init__(self, pool, slot, response):
+        self.url = str(response.url)
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self._pool = pool
+        self._slot = slot
+        self._response = response
+        self._pending = None
+        self._cancelled = False
+        self._closed = False
+        self._content = None
+
+    def iter_content(self, chunk_size=None):
+        """按数据帧产出解码后的响应体, chunk_size 被忽略"""
+        chunks = self._response.aiter_bytes()
+        while True:
+            chunk = self._wait(_next_chunk(chunks))
+            if chunk is None:
+                return
+            yield chunk
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    @property
+    def text(self):
+        try:
+            return self.content.decode(self._response.charset_encoding or "utf-8", "replace")
+        except LookupError:
+            return self.content.decode("utf-8", "replace")
+
+    def cancel(self):
+        """从其他线程中断读取; 之后的读取都抛出 H2Error"""
+        self._cancelled = True
+        pending = self._pending
+        if pending is not None:
+            pending.cancel()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._pool.release(self._slot, self._response)
+
+    def _wait(self, coro):
+        future = self._pool.submit(coro)
+        self._pending = future
+        # 先登记再检查, 与 cancel() 交错时也不会漏掉取消
+        if self._cancelled:
+            future.cancel()
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise H2Error("HTTP/2 流已取消") from None
+        finally:
+            self._pending = None
+
+
+class H2Pool:
+    """HTTP/2 连接池; headers 为每个请求都带的请求头, transport 用于测试时替换 httpx 的传输层"""
+
+    def __init__(self, headers=None, max_connections=4, connect_timeout=10, acquire_timeout=30,
+                 response_timeout=None, transport=None):
+        if httpx is None:
+            raise RuntimeError("HTTP/2 传输需要安装 httpx 与 h2: pip install httpx h2")
+        self.max_connections = max_connections
+        try:
+            self.clients = [httpx.AsyncClient(
+                headers=headers,
+                http1=False,
+                http2=True,
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+                timeout=httpx.Timeout(None, connect=connect_timeout, read=response_timeout, pool=acquire_timeout),
+                transport=transport
+            ) for _ in range(max_connections)]
+        except ImportError:
+            raise RuntimeError("HTTP/2 传输需要安装 h2: pip install h2") from None
+        # 每个客户端 (连接) 上进行中的流数
+        self._active = [0] * max_connections
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="h2pool", daemon=True).start()
+        self._lock = threading.Lock()
+        self.stats = {"streams_opened": 0}
+
+    def submit(self, coro):
+        """在连接池的事件循环中运行协程, 返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def post(self, url, data=b"", headers=None, cookies=None):
+        return self.request("POST", url, data, headers, cookies)
+
+    def request(self, method, url, data=b"", headers=None, cookies=None):
+        """发出请求并等待响应头, 响应体通过 iter_content() 流式读取, 用完后必须 close()"""
+        headers = dict(headers or {})
+        if cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in cookies.items())
+        with self._lock:
+            slot = min(range(len(self._active)), key=self._active.__getitem__)
+            self._active[slot] += 1
+            self.stats["streams_opened"] += 1
+        client = self.clients[slot]
+        try:
+            request = client.build_request(method, url, content=data, headers=headers)
+            response = self.submit(client.send(request, stream=True)).result()
+        except BaseException:
+            self._done(slot)
+            raise
+        return H2Response(self, slot, response)
+
+    def release(self, slot, response):
+        """关闭响应并归还流名额"""
+        self._done(slot)
+        try:
+            self.submit(response.aclose()).result()
+        except Exception:
+            pass
+
+    def _done(self, slot):
+        with self._lock:
+            self._active[slot] -= 1
+
+    def close(self):
+        for client in self.clients:
+            self.submit(client.aclose()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, active_streams=sum(self._active), streams_per_connection=list(self._active),
+                        max_connections=self.max_connections)
@@ -0,0 +1,294 @@
+"""对冲请求 (hedged requests)
+
+- 上游在 delay 秒内没有返回首个数据块时, 再向下一个目标 (只有一个目标时为同一目标) 发送相同的请求,
+  先返回数据的一方胜出, 另一方被取消并释放连接
+- delay 为固定值, 或按最近首字节延迟的分位数 (如 p95) 动态估算, 样本不足时不对冲
+- 对冲请求消耗全局预算 (与重试预算相同的令牌桶), 每个请求补充 ratio 个令牌, 即最多增加 ratio 比例的上游请求
+"""
+import asyncio
+import itertools
+import queue
+import socket
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """最近 window 个首字节延迟的分位数估计"""
+
+    def __init__(self, quantile=0.95, window=200, min_samples=20):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._cached = None
+
+    def estimate(self):
+        """样本不足 min_samples 时返回 None"""
+        with self._lock:
+            count = len(self._samples)
+            if count < self.min_samples:
+                return None
+            if self._cached is None:
+                ordered = sorted(self._samples)
+                self._cached = ordered[min(count - 1, int(count * self.quantile))]
+            return self._cached
+
+
+class HedgePolicy:
+    """对冲延迟与预算
+
+    delay 为秒数 (固定延迟) 或 "p95" 这样的分位数 (按路由分别统计)。
+    """
+
+    def __init__(self, delay, budget, min_delay=0.05):
+        self.budget = budget
+        self.min_delay = min_delay
+        self.fixed = None
+        self.quantile = None
+        if isinstance(delay, str) and delay.lower().startswith("p"):
+            self.quantile = float(delay[1:]) / 100
+        else:
+            self.fixed = float(delay)
+        self._trackers = {}
+        self._lock = threading.Lock()
+
+    def _tracker(self, name):
+        tracker = self._trackers.get(name)
+        if tracker is None:
+            with self._lock:
+                tracker = self._trackers.setdefault(name, LatencyTracker(self.quantile))
+        return tracker
+
+    def delay_for(self, name):
+        """路由 name 的对冲延迟 (秒), None 表示本次不对冲"""
+        if self.fixed is not None:
+            return max(self.fixed, self.min_delay)
+        estimate = self._tracker(name).estimate()
+        if estimate is None:
+            return None
+        return max(estimate, self.min_delay)
+
+    def observe(self, name, seconds):
+        """记录一次首字节延迟, 只有分位数模式需要"""
+        if self.quantile is not None:
+            self._tracker(name).observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            names = list(self._trackers)
+        return {
+            "delay": self.fixed if self.fixed is not None else f"p{self.quantile * 100:g}",
+            "delays": {name: self.delay_for(name) for name in names},
+            "budget": self.budget.snapshot()
+        }
+
+
+class Prefetched:
+    """已预读首个数据块的上游响应, 读取时先返回预读的块, 其余属性转发给原响应"""
+
+    def __init__(self, response, first, rest):
+        self.response = response
+        self._first = first
+        self._rest = rest
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_content(self, chunk_size=None):
+        if self._first is None:
+            return iter(())
+        return itertools.chain((self._first,), self._rest)
+
+    async def aiter_bytes(self):
+        if self._first is None:
+            return
+        yield self._first
+        async for chunk in self._rest:
+            yield chunk
+
+
+def prefetch(response):
+    """阻塞读取 requests 响应的首个数据块"""
+    chunked = getattr(response.raw, 'chunked', False)
+    chunks = response.iter_content(chunk_size=None if chunked else 512)
+    return Prefetched(response, next(chunks, None), chunks)
+
+
+async def prefetch_async(response):
+    """读取 httpx 响应的首个数据块"""
+    chunks = response.aiter_bytes().__aiter__()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    return Prefetched(response, first, chunks)
+
+
+def abort(response):
+    """让阻塞在读取上的线程立即返回: HTTP/2 响应取消挂起的读取, requests 响应关闭底层的 socket"""
+    cancel = getattr(response, 'cancel', None)
+    if cancel is not None:
+        cancel()
+        return
+    try:
+        sock = response.raw._connection.sock
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+
+
+class Leg:
+    """对冲中的一路请求; 胜负已定后 cancelled 为 True, 还在运行的一路自行清理"""
+
+    __slots__ = ('index', 'cancelled', 'finished', 'response')
+
+    def __init__(self, index):
+        self.index = index
+        self.cancelled = False
+        self.finished = False
+        # 收到响应头后由调用方设置, 取消时用于中断首字节读取
+        self.response = None
+
+
+def race(primary, start_hedge, delay, is_winner, discard):
+    """同步对冲
+
+    primary(leg) 在后台线程运行; delay 秒内没有返回时调用 start_hedge(), 它返回第二路的可调用对象
+    (预算不足等情况返回 None)。先返回且 is_winner(result) 为真的一路胜出, 其余结果交给 discard()。
+    返回 (结果, 胜出的一路: 0 为原请求 1 为对冲请求, 是否发起了对冲); 都失败时返回或抛出最后一路的结果。
+    delay 为 None 时直接在当前线程运行 primary。
+    """
+    if delay is None:
+        return primary(Leg(0)), 0, False
+
+    outcomes = queue.Queue()
+    lock = threading.Lock()
+    legs = []
+    decided = False
+
+    def run(call, leg):
+        try:
+            outcome = (leg, call(leg), None)
+        except Exception as e:
+            outcome = (leg, None, e)
+        leg.finished = True
+        with lock:
+            if not decided:
+                outcomes.put(outcome)
+                return
+        if outcome[2] is None:
+            discard(outcome[1])
+
+    def start(call):
+        leg = Leg(len(legs))
+        legs.append(leg)
+        threading.Thread(target=run, args=(call, leg), daemon=True).start()
+
+    start(primary)
+    pending = 1
+    hedged = False
+    last = None
+    winner = None
+    while pending:
+        try:
+            leg, result, error = outcomes.get(timeout=None if hedged else delay)
+        except queue.Empty:
+            hedged = True
+            hedge = start_hedge()
+            if hedge is not None:
+                start(hedge)
+                pending += 1
+            continue
+        pending -= 1
+        if error is None and is_winner(result):
+            winner = (leg, result)
+            break
+        if last is not None and last[2] is None:
+            discard(last[1])
+        last = (leg, result, error)
+        if len(legs) == 1:
+            # 对冲之前原请求就已失败, 交给调用方的重试逻辑
+            break
+
+    with lock:
+        decided = True
+        leftovers = []
+        while not outcomes.empty():
+            leftovers.append(outcomes.get_nowait())
+    for leg in legs:
+        if winner is None or leg is not winner[0]:
+            leg.cancelled = True
+            if not leg.finished and leg.response is not None:
+                abort(leg.response)
+    if winner is not None and last is not None and last[2] is None:
+        discard(last[1])
+    for _, result, error in leftovers:
+        if error is None:
+            discard(result)
+
+    if winner is not None:
+        return winner[1], winner[0].index, len(legs) > 1
+    leg, result, error = last
+    if error is not None:
+        raise error
+    return result, leg.index, len(legs) > 1
+
+
+async def race_async(primary, start_hedge, delay, is_winner, discard):
+    """异步对冲, 语义同 race(); primary / start_hedge() 返回的对象为协程函数, discard 也是协程函数
+
+    失败的一路直接取消 (task.cancel()), 由协程自行关闭响应。
+    """
+    if delay is None:
+        return await primary(), 0, False
+
+    tasks = {asyncio.ensure_future(primary()): 0}
+    pending = set(tasks)
+    hedged = False
+    last = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                hedge = start_hedge()
+                if hedge is not None:
+                    task = asyncio.ensure_future(hedge())
+                    tasks[task] = 1
+                    pending.add(task)
+                continue
+            for task in done:
+                error = task.exception()
+                result = None if error is not None else task.result()
+                if error is None and is_winner(result):
+                    for other in done:
+                        if other is not task and other.exception() is None:
+                            await discard(other.result())
+                    if last is not None and last[2] is None:
+                        await discard(last[1])
+                    return result, tasks[task], len(tasks) > 1
+                if last is not None and last[2] is None:
+                    await discard(last[1])
+                last = (tasks[task], result, error)
+            if len(tasks) == 1:
+                break
+    finally:
+        for task in pending:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                # 在等待 discard 期间完成的另一路
+                asyncio.ensure_future(discard(task.result()))
+
+    index, result, error = last
+    if error is not None:
+        raise error
+    return result, index, len(tasks) > 1
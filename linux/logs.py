@@ -0,0 +1,267 @@
+"""日志: 后台线程写出, 请求线程只负责入队
+
+- 请求线程中 logging.info 等调用只创建 LogRecord 并放入有界队列, 消息格式化 (%-参数)、JSON 序列化与写 stderr
+  都在后台线程完成, 不再在处理器锁上互相阻塞; 队列满时丢弃并计数, 不阻塞请求
+- LOG_FORMAT=json 时每行一个 JSON 对象, 否则沿用 "时间 - 级别 - 消息" 的文本格式
+- 按级别采样 (LOG_SAMPLE, 如 "info=0.1,debug=0"); 有请求 id 时按 id 的哈希决定, 同一请求的日志要么全部保留要么全部丢弃
+- ERROR 及以上按消息模板限速 (LOG_ERROR_RATE 条/秒), 被抑制的条数附在该模板下一条输出的日志上
+- bind() 设置当前上下文 (线程或协程) 的请求 id, 之后的日志都带上该 id
+linux 与 win 版本共用本模块。
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'info').upper()
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', '')
+LOG_ERROR_RATE = float(os.getenv('LOG_ERROR_RATE', 10))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+# ERROR 限速时记录的最大消息模板数
+_MAX_BUCKETS = 1000
+
+
+def bind(request_id):
+    """设置当前上下文的请求 id; None 表示清除"""
+    _request_id.set(request_id)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def parse_sample(value):
+    """"info=0.1,debug=0" -> {logging.INFO: 0.1, logging.DEBUG: 0.0}"""
+    rates = {}
+    for item in value.split(","):
+        name, sep, rate = item.strip().partition("=")
+        if not sep:
+            continue
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class Gate(logging.Filter):
+    """在调用线程中执行: 附加请求 id, 按级别采样, ERROR 按模板限速"""
+
+    def __init__(self, sample=None, error_rate=0.0):
+        super().__init__()
+        self.sample = dict(sample or {})
+        self.error_rate = error_rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.stats = {"sampled_out": 0, "suppressed": 0}
+
+    def filter(self, record):
+        request_id = _request_id.get()
+        record.request_id = request_id
+        rate = self.sample.get(record.levelno)
+        if rate is not None and rate < 1.0:
+            if request_id is not None:
+                keep = zlib.crc32(request_id.encode()) < rate * 0x100000000
+            else:
+                keep = random.random() < rate
+            if not keep:
+                self.stats["sampled_out"] += 1
+                return False
+        record.suppressed = 0
+        if record.levelno >= logging.ERROR and self.error_rate > 0:
+            return self._allow(record)
+        return True
+
+    def _allow(self, record):
+        """令牌桶: 每个 (logger, 消息模板) 每秒 error_rate 条, 突发上限同为 error_rate 条"""
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= _MAX_BUCKETS:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [self.error_rate, now, 0]
+            tokens = min(self.error_rate, bucket[0] + (now - bucket[1]) * self.error_rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.stats["suppressed"] += 1
+                return False
+            bucket[0] = tokens - 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class DeferredQueueHandler(logging.Handler):
+    """只把 LogRecord 放入队列; 与 logging.handlers.QueueHandler 不同, 不在调用线程中格式化消息"""
+
+    def __init__(self, size):
+        super().__init__()
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def handle(self, record):
+        # 跳过 Handler.handle 中的处理器锁, queue.Queue 自身是线程安全的
+        if self.filter(record):
+            self.emit(record)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """沿用原来的文本格式, 有请求 id 时附在级别之后"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            line = line.replace(" - " + record.levelname + " - ", f" - {record.levelname} - [{request_id}] ", 1)
+        if getattr(record, "suppressed", 0):
+            line += f" (同类错误已抑制 {record.suppressed} 条)"
+        return line
+
+
+class AsyncLogging:
+    """根 logger 的队列处理器与后台写出线程"""
+
+    def __init__(self, stream=None, fmt=LOG_FORMAT, sample=None, error_rate=LOG_ERROR_RATE,
+                 queue_size=LOG_QUEUE_SIZE):
+        self.stream = stream or sys.stderr
+        self.formatter = JsonFormatter() if fmt == 'json' else TextFormatter()
+        self.gate = Gate(sample, error_rate)
+        self.handler = DeferredQueueHandler(queue_size)
+        self.handler.addFilter(self.gate)
+        self.queue_size = queue_size
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, args=(self.handler.queue,), name="log-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self, records):
+        stream = self.stream
+        format_record = self.formatter.format
+        stopping = False
+        while not stopping:
+            record = records.get()
+            if record is None:
+                break
+            lines = [record]
+            # 一次取出已排队的日志, 合并为一次写入
+            while len(lines) < 256:
+                try:
+                    record = records.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                lines.append(record)
+            text = []
+            for record in lines:
+                try:
+                    text.append(format_record(record))
+                except Exception:
+                    text.append(f"日志格式化失败: {record.msg!r} {record.args!r}")
+            try:
+                stream.write("\n".join(text) + "\n")
+                stream.flush()
+            except Exception:
+                pass
+
+    def stop(self, timeout=5):
+        """写出已排队的日志后停止后台线程"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self.handler.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def after_fork(self):
+        """fork 之后子进程中没有后台线程, 队列的锁也可能处于被持有的状态, 重新创建"""
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.start()
+
+    def snapshot(self):
+        return dict(self.gate.stats, dropped=self.handler.dropped, queued=self.handler.queue.qsize())
+
+
+_active = None
+
+
+def lean_records():
+    """LogRecord 不再采集格式中用不到的字段 (调用位置需要遍历栈帧, 线程名), 降低调用线程的开销
+
+    进程号仍然保留: 只是一次 os.getpid(), gunicorn 自己的日志格式中用到 %(process)d。
+    """
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    if hasattr(logging, "logAsyncioTasks"):
+        logging.logAsyncioTasks = False
+
+
+def setup(**options):
+    """配置根 logger 使用后台写出, 返回 AsyncLogging; 重复调用返回同一个实例"""
+    global _active
+    if _active is not None:
+        return _active
+    options.setdefault("sample", parse_sample(LOG_SAMPLE))
+    active = AsyncLogging(**options)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(active.handler)
+    root.setLevel(LOG_LEVEL)
+    lean_records()
+    active.start()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=active.after_fork)
+    import atexit
+    atexit.register(active.stop)
+    _active = active
+    return active
+
+
+def snapshot():
+    return _active.snapshot() if _active is not None else {}
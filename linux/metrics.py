@@ -0,0 +1,265 @@
+"""Prometheus 指标
+
+- 热路径上的记录只写当前线程自己的分片 (普通 dict), 不加锁; 采集时再合并所有分片
+- 已退出线程的分片在采集或新线程注册时并入 retired, 不会随线程数无限增长
+- 多进程部署时每个 worker 定期把快照写入 METRICS_DIR, /metrics 合并所有 worker 的数据
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    __slots__ = ('_registry', 'name')
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self.name = name
+
+    def inc(self, labels, amount=1):
+        data = self._registry._data()
+        key = (self.name, labels)
+        data[key] = data.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def dec(self, labels, amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram:
+    """直方图, 分片中保存各桶的非累积计数, 最后一位为总和"""
+
+    __slots__ = ('_registry', 'name', 'buckets')
+
+    def __init__(self, registry, name, buckets):
+        self._registry = registry
+        self.name = name
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        data = self._registry._data()
+        key = (self.name, labels)
+        counts = data.get(key)
+        if counts is None:
+            # len(buckets) 个桶 + (+Inf) 桶 + 总和
+            counts = data[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+        self._export_dir = None
+
+    def counter(self, name, help_text, labelnames):
+        return self._register(Counter(self, name), "counter", help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames):
+        return self._register(Gauge(self, name), "gauge", help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames, buckets):
+        return self._register(Histogram(self, name, buckets), "histogram", help_text, labelnames)
+
+    def _register(self, metric, kind, help_text, labelnames):
+        self._metrics[metric.name] = (kind, help_text, tuple(labelnames), metric)
+        return metric
+
+    def _data(self):
+        """当前线程的分片"""
+        try:
+            return self._local.data
+        except AttributeError:
+            data = {}
+            with self._lock:
+                self._retire_dead_locked()
+                self._shards.append((threading.current_thread(), data))
+            self._local.data = data
+            return data
+
+    def _retire_dead_locked(self):
+        alive = []
+        for thread, data in self._shards:
+            if thread.is_alive():
+                alive.append((thread, data))
+            else:
+                _merge(self._retired, list(data.items()))
+        self._shards = alive
+
+    def reset(self):
+        """fork 之后清空从主进程继承的数据"""
+        with self._lock:
+            self._shards = []
+            self._retired = {}
+            self._export_dir = None
+        self._local = threading.local()
+
+    def collect(self):
+        """合并所有分片, 返回 {(name, labels): value}"""
+        with self._lock:
+            self._retire_dead_locked()
+            merged = {}
+            _merge(merged, list(self._retired.items()))
+            for _, data in self._shards:
+                _merge(merged, list(data.items()))
+        return merged
+
+    # 多进程
+
+    def start_exporter(self, directory, interval=5.0):
+        """启动后台线程, 定期把本进程的快照写入 directory"""
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logging.warning("无法创建指标目录: %s", e)
+            return
+        self._export_dir = directory
+
+        def run():
+            while self._export_dir == directory:
+                self.export()
+                time.sleep(interval)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def export(self):
+        directory = self._export_dir
+        if directory is None:
+            return
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        items = [[name, list(labels), value] for (name, labels), value in self.collect().items()]
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(items, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("写入指标快照失败: %s", e)
+
+    @staticmethod
+    def clear_dir(directory):
+        """服务启动时删除上一次运行留下的快照"""
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith(".json"):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def _collect_dir(self):
+        """合并本进程的实时数据与其他 worker 的快照; 已退出 worker 的计数保留, 仪表值丢弃"""
+        merged = self.collect()
+        pid = os.getpid()
+        try:
+            names = os.listdir(self._export_dir)
+        except OSError:
+            return merged
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                other = int(name[:-5])
+            except ValueError:
+                continue
+            if other == pid:
+                continue
+            alive = _pid_alive(other)
+            try:
+                with open(os.path.join(self._export_dir, name)) as f:
+                    items = json.load(f)
+            except (OSError, ValueError):
+                continue
+            entries = []
+            for metric, labels, value in items:
+                spec = self._metrics.get(metric)
+                if spec is None or (spec[0] == "gauge" and not alive):
+                    continue
+                entries.append(((metric, tuple(labels)), value))
+            _merge(merged, entries)
+        return merged
+
+    def merged(self):
+        """所有 worker 合并后的数据, 未启用多进程导出时只有本进程"""
+        return self._collect_dir() if self._export_dir else self.collect()
+
+    def render(self):
+        """输出 Prometheus 文本格式"""
+        merged = self.merged()
+        by_metric = {}
+        for (name, labels), value in merged.items():
+            by_metric.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, labelnames, metric) in self._metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_metric.get(name, ())):
+                label_text = _format_labels(labelnames, labels)
+                bucket_prefix = f"{label_text}," if label_text else ""
+                if kind != "histogram":
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{bucket_prefix}le="{_format_value(bound)}"}} {cumulative}')
+                cumulative += value[-2]
+                lines.append(f'{name}_bucket{{{bucket_prefix}le="+Inf"}} {cumulative}')
+                lines.append(f"{name}_sum{{{label_text}}} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{{{label_text}}} {cumulative}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _merge(target, items):
+    for key, value in items:
+        current = target.get(key)
+        if current is None:
+            target[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(current, list):
+            for i, v in enumerate(value):
+                current[i] += v
+        else:
+            target[key] = current + value
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels))
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
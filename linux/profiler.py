@@ -0,0 +1,71 @@
+"""采样式性能分析
+
+在一段时间内定期抓取当前进程所有线程的调用栈, 按函数汇总。
+不需要预先插桩, 只在被调用期间有开销; 输出可读报告或 flamegraph.pl 可用的折叠栈。
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """已有分析在进行中"""
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample(seconds, interval=0.005):
+    """采样 seconds 秒, 返回 (折叠栈计数, 采样次数); 同一时间只允许一个分析"""
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        return stacks, samples
+    finally:
+        _lock.release()
+
+
+def collapsed(stacks):
+    """flamegraph.pl 折叠栈格式"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def report(stacks, samples, seconds, top=30):
+    """按自身耗时与累计耗时排序的文本报告"""
+    own = Counter()
+    inclusive = Counter()
+    total = sum(stacks.values()) or 1
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+
+    lines = [f"采样 {seconds:g} 秒, {samples} 次, 共 {total} 个线程栈", "", "自身耗时:"]
+    for frame, count in own.most_common(top):
+        lines.append(f"{count / total * 100:6.1f}%  {count:7d}  {frame}")
+    lines += ["", "累计耗时:"]
+    for frame, count in inclusive.most_common(top):
+        lines.append(f"{count / total * 100:6.1f}%  {count:7d}  {frame}")
+    lines.append("")
+    return "\n".join(lines)
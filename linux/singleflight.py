@@ -0,0 +1,141 @@
+"""相同请求的单飞合并
+
+同时到达的相同请求共享一次上游调用: 上游由后台线程读取, 解析出的增量写入广播缓冲区,
+每个订阅者按自己的进度读取。晚加入的订阅者先拿到已有的积压内容再接收实时内容,
+生产者从不等待订阅者, 一个慢的订阅者不会拖慢其他订阅者。
+"""
+import threading
+
+
+class Flight:
+    """一次进行中的上游调用及其广播缓冲区"""
+
+    def __init__(self, key):
+        self.key = key
+        self.items = []
+        self.finished = False
+        self.done = False
+        self.finish_reason = "stop"
+        self.error = None
+        self.subscribers = 0
+        self._cond = threading.Condition()
+
+    @property
+    def abandoned(self):
+        """所有订阅者都已离开"""
+        return self.subscribers <= 0
+
+    def publish(self, content):
+        """生产者写入一个增量"""
+        with self._cond:
+            self.items.append(content)
+            self._cond.notify_all()
+
+    def finish(self, done=False, finish_reason="stop", error=None):
+        """生产者结束; error 为 (状态码, 错误信息)"""
+        with self._cond:
+            self.finished = True
+            self.done = done
+            self.finish_reason = finish_reason
+            self.error = error
+            self._cond.notify_all()
+
+    def subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+        return Subscription(self)
+
+    def leave(self):
+        with self._cond:
+            self.subscribers -= 1
+
+
+class Subscription:
+    """单个订阅者的读取游标, 接口与上游内容迭代器一致 (可迭代, done, close)"""
+
+    def __init__(self, flight):
+        self.flight = flight
+        self._closed = False
+
+    @property
+    def done(self):
+        return self.flight.done
+
+    @property
+    def error(self):
+        return self.flight.error
+
+    @property
+    def finish_reason(self):
+        return self.flight.finish_reason
+
+    def wait_started(self, timeout=None):
+        """等待第一个增量或结束, 用于在开始响应前得知上游是否出错"""
+        flight = self.flight
+        with flight._cond:
+            flight._cond.wait_for(lambda: flight.items or flight.finished, timeout)
+        return flight.error
+
+    def __iter__(self):
+        flight = self.flight
+        index = 0
+        while True:
+            with flight._cond:
+                while index >= len(flight.items) and not flight.finished:
+                    flight._cond.wait()
+                batch = flight.items[index:]
+                finished = flight.finished
+            index += len(batch)
+            yield from batch
+            if finished and index >= len(flight.items):
+                return
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.flight.leave()
+
+
+class SingleFlight:
+    """按键合并进行中的请求"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"flights": 0, "coalesced": 0}
+
+    def join(self, key, start):
+        """加入或发起 key 对应的调用; 新建时在后台线程执行 start(flight)
+
+        返回 (订阅, 是否为发起者)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None or flight.finished
+            if leader:
+                flight = Flight(key)
+                self._flights[key] = flight
+                self.stats["flights"] += 1
+            else:
+                self.stats["coalesced"] += 1
+            subscription = flight.subscribe()
+
+        if leader:
+            threading.Thread(target=self._run, args=(flight, start), daemon=True).start()
+        return subscription, leader
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._flights))
+
+    def _run(self, flight, start):
+        try:
+            start(flight)
+        except Exception as e:
+            flight.finish(error=(500, f"服务器内部错误: {str(e)}"))
+        finally:
+            if not flight.finished:
+                flight.finish()
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
@@ -0,0 +1,250 @@
+"""上游 SSE 流的增量解析
+
+直接在原始字节块上工作:
+- 按 SSE 规范处理 \\n / \\r\\n / \\r 换行, 多行 data: 在空行处合并为一个事件
+- 事件完整之后才解码, 跨读取边界被截断的 UTF-8 多字节字符不会出错
+- extract_content() 在常见的单 choice 增量块上直接定位 delta.content, 跳过完整 JSON 解析
+- extract_usage() 只在事件带有非空 usage 对象时才解析 JSON
+linux 与 win 版本共用本模块。
+"""
+import re
+import json
+
+DONE = b"[DONE]"
+
+_CONTENT_KEY = b'"content"'
+# 上游用量字段, 调用方可先用 `USAGE_KEY in payload` 过滤
+USAGE_KEY = b'"usage"'
+
+
+class SSEParser:
+    """增量 SSE 解析器, feed() 返回已完整的事件 data 字节串"""
+
+    __slots__ = ('_buf', '_mode', '_cr')
+
+    # 换行模式: 首个包含换行的数据块决定, 上游在一个流内不会混用 \n 与 \r\n
+    _UNKNOWN, _LF, _CRLF = 0, 1, 2
+
+    def __init__(self):
+        self._buf = b""
+        self._mode = self._UNKNOWN
+        self._cr = False
+
+    def feed(self, chunk):
+        """输入一段原始字节, 返回本次解析出的完整事件列表"""
+        if not chunk:
+            return ()
+        if self._mode != self._LF:
+            if self._mode == self._UNKNOWN:
+                if b"\r" in chunk:
+                    self._mode = self._CRLF
+                elif b"\n" in chunk:
+                    self._mode = self._LF
+            if self._mode == self._CRLF:
+                chunk = self._normalize(chunk)
+
+        buf = self._buf
+        if buf:
+            # 只在新数据附近查找事件结尾, 避免重复扫描缓冲区
+            search_from = len(buf) - 1
+            buf += chunk
+        else:
+            search_from = 0
+            buf = chunk
+        end = buf.find(b"\n\n", search_from)
+        if end == -1:
+            # 事件尚未结束, 常见于小块读取, 不做任何解析
+            self._buf = buf
+            return ()
+
+        events = []
+        start = 0
+        while end != -1:
+            block = buf[start:end]
+            if block.startswith(b"data: ") and b"\n" not in block:
+                # 单行 data 事件
+                events.append(block[6:])
+            else:
+                _parse_block(block, events)
+            start = end + 2
+            end = buf.find(b"\n\n", start)
+        self._buf = buf[start:]
+        return events
+
+    def flush(self):
+        """流结束时取出未以空行结尾的最后一个事件"""
+        events = self._flush_block(self._buf)
+        self._buf = b""
+        self._mode = self._UNKNOWN
+        self._cr = False
+        return events
+
+    @staticmethod
+    def _flush_block(block):
+        events = []
+        _parse_block(block, events)
+        return events
+
+    def _normalize(self, chunk):
+        """把 \r\n 和单独的 \r 统一为 \n, 处理跨块被截断的 \r\n"""
+        if self._cr:
+            self._cr = False
+            chunk = b"\n" + (chunk[1:] if chunk[:1] == b"\n" else chunk)
+        if chunk.endswith(b"\r"):
+            self._cr = True
+            chunk = chunk[:-1]
+        return chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def _parse_block(block, events):
+    """逐行解析事件块, 合并多行 data:"""
+    pending = []
+    for line in block.split(b"\n"):
+        if not line:
+            if pending:
+                events.append(b"\n".join(pending))
+                pending = []
+            continue
+        if line.startswith(b"data:"):
+            value = line[5:]
+            pending.append(value[1:] if value[:1] == b" " else value)
+        # event/id/retry 字段与注释行不影响内容, 直接忽略
+    if pending:
+        events.append(b"\n".join(pending))
+
+
+def iter_events(chunks):
+    """从原始字节块迭代器中逐个产出事件 data
+
+    与 SSEParser 行为一致; \n 换行的流走内联的快速循环, 省去每块一次的方法调用。
+    """
+    chunks = iter(chunks)
+    pending = b""
+    for chunk in chunks:
+        if b"\r" in chunk:
+            # \r\n 或 \r 换行的流交给 SSEParser 统一处理
+            parser = SSEParser()
+            yield from parser.feed(pending + chunk)
+            for chunk in chunks:
+                yield from parser.feed(chunk)
+            yield from parser.flush()
+            return
+        if b"\n" in chunk:
+            pending += chunk
+            break
+        pending += chunk
+    else:
+        yield from SSEParser._flush_block(pending)
+        return
+
+    search_from = 0
+    chunk = pending
+    pending = b""
+    while True:
+        end = chunk.find(b"\n\n", search_from)
+        if end == -1:
+            pending = chunk
+        else:
+            start = 0
+            while end != -1:
+                block = chunk[start:end]
+                if block[:6] == b"data: " and b"\n" not in block:
+                    yield block[6:]
+                else:
+                    events = []
+                    _parse_block(block, events)
+                    yield from events
+                start = end + 2
+                end = chunk.find(b"\n\n", start)
+            pending = chunk[start:]
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        if pending:
+            search_from = len(pending) - 1
+            chunk = pending + chunk
+        else:
+            search_from = 0
+
+    yield from SSEParser._flush_block(pending)
+
+
+def iter_response_events(response):
+    """按到达顺序读取 requests 流式响应的原始字节并解析事件
+
+    分块传输时每个块到达即处理; 非分块响应按 512 字节读取, 与 iter_lines 默认值一致。
+    """
+    chunked = getattr(response.raw, 'chunked', False)
+    return iter_events(response.iter_content(chunk_size=None if chunked else 512))
+
+
+def _default_chunk_content(chunk):
+    try:
+        return chunk["choices"][0]["delta"].get("content") or None
+    except Exception:
+        return None
+
+
+# delta 对象内 (中间不跨越其他对象) 作为键出现的 content 及其字符串值
+_DELTA_CONTENT_RE = re.compile(
+    rb'"delta"\s*:\s*\{[^{}]*?(?<=[{,\s])"content"\s*:\s*(?:"([^"\\]*(?:\\.[^"\\]*)*)"|(null))'
+)
+
+
+def extract_content(payload, fallback=None):
+    """从单个事件 data 中取出 choices[0].delta.content
+
+    快速路径只处理只有一个 "content" 键且直接位于 delta 中的常见情况,
+    其他情况回退到 json.loads + fallback(chunk) (默认与 process_chunk 语义一致)。
+    无法解析的事件返回 None。
+    """
+    count = payload.count(_CONTENT_KEY)
+    if not count:
+        # 没有 content 字段, 结果必然为空
+        return None
+
+    if count == 1:
+        match = _DELTA_CONTENT_RE.search(payload)
+        if match is not None:
+            value = match.group(1)
+            if not value:
+                # null 或空串
+                return None
+            try:
+                if b"\\" not in value:
+                    return value.decode("utf-8")
+                return json.loads(b'"' + value + b'"') or None
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                pass
+
+    try:
+        chunk = json.loads(payload)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    return (fallback or _default_chunk_content)(chunk)
+
+
+_USAGE_RE = re.compile(rb'"usage"\s*:\s*\{')
+_EMPTY_CHOICES_RE = re.compile(rb'"choices"\s*:\s*\[\s*\]')
+
+
+def extract_usage(payload):
+    """事件中的 usage 对象 (含 completion_tokens 时), 没有或为 null 时返回 None
+
+    有的上游在每个增量块上都带 "usage": null, 先用正则排除, 不为每个块解析 JSON。
+    """
+    if _USAGE_RE.search(payload) is None:
+        return None
+    try:
+        usage = json.loads(payload).get("usage")
+    except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+        return None
+    if isinstance(usage, dict) and isinstance(usage.get("completion_tokens"), int):
+        return usage
+    return None
+
+
+def usage_only(payload):
+    """事件只携带 usage (choices 为空或没有 choices), 透传时由代理自己输出的用量块代替"""
+    return b'"choices"' not in payload or _EMPTY_CHOICES_RE.search(payload) is not None
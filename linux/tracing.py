@@ -0,0 +1,239 @@
+"""单个请求的阶段耗时记录
+
+- 每个请求一个 Trace, 请求 id 取自 X-Request-Id 请求头或自动生成, 随响应头返回
+- 阶段 (会话获取、退避等待、上游请求、首字节、流式读取) 以 span 记录, 累计值 (等待上游、写客户端) 以 total 记录
+- 非流式响应通过 Server-Timing 头返回, 流式响应可在 [DONE] 之前附加一条 SSE 注释
+- 按 TRACE_SAMPLE_RATE 采样导出为 Zipkin v2 span: TRACE_EXPORT 为 http(s) 地址时 POST, 否则追加写入该文件
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+import uuid
+
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '')
+# 为 1 时所有流式响应都附加 trace 注释, 否则只在请求头 X-Trace: 1 时附加
+TRACE_SSE = os.getenv('TRACE_SSE', '0') == '1'
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'chutes2api')
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTrace:
+    """未追踪时使用, 所有记录操作为空"""
+
+    request_id = None
+    emit = False
+
+    def span(self, name, **tags):
+        return _NULL_SPAN
+
+    def add(self, name, start, end, **tags):
+        pass
+
+    def add_total(self, name, seconds):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'tags', 'start')
+
+    def __init__(self, trace, name, tags):
+        self.trace = trace
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags["error"] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.monotonic(), **self.tags)
+        return False
+
+
+class Trace(NullTrace):
+    """单个请求的时间线"""
+
+    def __init__(self, request_id=None, emit=False):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.emit = emit or TRACE_SSE
+        self.started = time.monotonic()
+        self.wall_started = time.time()
+        self.ended = None
+        self.spans = []
+        self.totals = {}
+
+    def span(self, name, **tags):
+        """以上下文管理器记录一个阶段"""
+        return _Span(self, name, tags)
+
+    def add(self, name, start, end, **tags):
+        self.spans.append((name, start, end, tags))
+
+    def add_total(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def finish(self):
+        """结束请求: 由流式读取时长推算自身处理耗时, 并按采样率导出"""
+        if self.ended is not None:
+            return
+        self.ended = time.monotonic()
+        for name, start, end, _ in self.spans:
+            if name == "stream":
+                own = (end - start) - self.totals.get("upstream_wait", 0.0) - self.totals.get("client_write", 0.0)
+                self.totals["process"] = max(0.0, own)
+                break
+        if _exporter is not None and random.random() < TRACE_SAMPLE_RATE:
+            _exporter.submit(self.to_spans())
+
+    def phases(self):
+        """[(阶段名, 毫秒, 描述)]"""
+        result = []
+        for name, start, end, tags in self.spans:
+            desc = ",".join(f"{k}={v}" for k, v in tags.items())
+            result.append((name, (end - start) * 1000, desc))
+        for name, seconds in self.totals.items():
+            result.append((name, seconds * 1000, ""))
+        if self.ended is not None:
+            result.append(("total", (self.ended - self.started) * 1000, ""))
+        return result
+
+    def server_timing(self):
+        """Server-Timing 响应头"""
+        items = []
+        for name, ms, desc in self.phases():
+            item = f"{name};dur={ms:.1f}"
+            if desc:
+                item += f';desc="{desc}"'
+            items.append(item)
+        return ", ".join(items)
+
+    def sse_comment(self):
+        """附加在流末尾的 SSE 注释帧, 客户端会忽略注释行"""
+        summary = {
+            "request_id": self.request_id,
+            "phases": [{"name": name, "ms": round(ms, 1), "desc": desc} if desc else {"name": name, "ms": round(ms, 1)}
+                       for name, ms, desc in self.phases()]
+        }
+        return b": trace " + json.dumps(summary, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+    def to_spans(self):
+        """转换为 Zipkin v2 span 列表, 根 span 覆盖整个请求"""
+        trace_id = self.request_id if _is_hex(self.request_id, (16, 32)) else uuid.uuid4().hex
+        root_id = uuid.uuid4().hex[:16]
+        ended = self.ended or time.monotonic()
+
+        def micros(mono):
+            return int((self.wall_started + (mono - self.started)) * 1e6)
+
+        spans = [{
+            "traceId": trace_id,
+            "id": root_id,
+            "name": "chat.completions",
+            "kind": "SERVER",
+            "timestamp": micros(self.started),
+            "duration": max(1, int((ended - self.started) * 1e6)),
+            "localEndpoint": {"serviceName": TRACE_SERVICE_NAME},
+            "tags": dict({"request_id": self.request_id},
+                         **{f"{name}_ms": f"{seconds * 1000:.1f}" for name, seconds in self.totals.items()})
+        }]
+        for name, start, end, tags in self.spans:
+            spans.append({
+                "traceId": trace_id,
+                "parentId": root_id,
+                "id": uuid.uuid4().hex[:16],
+                "name": name,
+                "timestamp": micros(start),
+                "duration": max(1, int((end - start) * 1e6)),
+                "localEndpoint": {"serviceName": TRACE_SERVICE_NAME},
+                "tags": {k: str(v) for k, v in tags.items()}
+            })
+        return spans
+
+
+def _is_hex(value, lengths):
+    if len(value) not in lengths:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+class SpanExporter:
+    """后台线程批量导出 span, 队列满时丢弃, 不阻塞请求线程"""
+
+    def __init__(self, target, max_queue=1000, batch_size=100):
+        self.target = target
+        self.batch_size = batch_size
+        self._queue = queue.Queue(max_queue)
+        self.dropped = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, spans):
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = list(self._queue.get())
+            while len(batch) < self.batch_size:
+                try:
+                    batch.extend(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logging.warning("导出 trace 失败: %s", e)
+
+    def _write(self, spans):
+        if self.target.startswith(("http://", "https://")):
+            req = urllib.request.Request(
+                self.target,
+                data=json.dumps(spans).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+                method="POST"
+            )
+            urllib.request.urlopen(req, timeout=5).close()
+            return
+        with open(self.target, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+
+_exporter = SpanExporter(TRACE_EXPORT) if TRACE_EXPORT and TRACE_SAMPLE_RATE > 0 else None
+
+
+def reset_after_fork():
+    """fork 之后重新启动导出线程"""
+    global _exporter
+    _exporter = SpanExporter(TRACE_EXPORT) if TRACE_EXPORT and TRACE_SAMPLE_RATE > 0 else None
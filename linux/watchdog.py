@@ -0,0 +1,165 @@
+"""进行中上游流的看门狗
+
+一个后台线程每 interval 秒检查一次所有登记的流, 不为每个流增加线程:
+- 首个增量超时: 发出请求 first_byte 秒后仍没有收到第一个 SSE 事件
+- 空闲超时: 收到第一个事件之后, 等待下一个 SSE 事件超过 idle 秒 (上游只发心跳注释同样算空闲);
+  只计算阻塞在上游读取上的时间, 读取方把内容交给下游、阻塞在写客户端上 (背压) 时不计入
+- 客户端断开: 登记了客户端 socket 时 (WSGI 服务器提供的 gunicorn.socket / werkzeug.socket) 检查对端是否已关闭,
+  上游停滞、没有数据可写时也能及时发现, 不必等到下一次写失败
+触发时记录原因并调用登记的 abort() 中断阻塞在上游读取上的线程, 读取方据此抛出 StreamAbandoned。
+"""
+import os
+import select
+import socket
+import threading
+import time
+
+CLIENT_DISCONNECT = "client_disconnect"
+FIRST_BYTE_TIMEOUT = "first_byte_timeout"
+IDLE_TIMEOUT = "idle_timeout"
+REASONS = (CLIENT_DISCONNECT, FIRST_BYTE_TIMEOUT, IDLE_TIMEOUT)
+
+# 对端关闭连接: POLLRDHUP 只在 Linux 上提供, 其他平台退回 MSG_PEEK
+_CLOSED_EVENTS = (getattr(select, "POLLHUP", 0) | getattr(select, "POLLERR", 0) |
+                  getattr(select, "POLLNVAL", 0) | getattr(select, "POLLRDHUP", 0))
+
+
+class StreamAbandoned(Exception):
+    """上游流被中断, reason 为 REASONS 之一"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def client_closed(sock):
+    """客户端是否已关闭连接; 只检查, 不读走数据"""
+    try:
+        fd = sock.fileno()
+        if fd < 0:
+            return True
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(fd, select.POLLIN | getattr(select, "POLLRDHUP", 0))
+            events = poller.poll(0)
+            if not events:
+                return False
+            if events[0][1] & _CLOSED_EVENTS:
+                return True
+            if hasattr(select, "POLLRDHUP"):
+                # 可读但对端未关闭: 客户端发来了下一个请求 (keep-alive)
+                return False
+        elif not select.select([fd], [], [], 0)[0]:
+            return False
+        return sock.recv(1, socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0)) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+class Watch:
+    """一个登记的流
+
+    读取方开始阻塞读取上游时把 waiting 设为当前时间, 收到事件后设为 None 并把 received 设为 True。
+    """
+
+    __slots__ = ('abort', 'client', 'labels', 'first_deadline', 'idle', 'received', 'waiting', 'reason')
+
+    def __init__(self, abort, client, labels, first_deadline, idle):
+        self.abort = abort
+        self.client = client
+        self.labels = labels
+        self.first_deadline = first_deadline
+        self.idle = idle
+        self.received = False
+        self.waiting = None
+        # 看门狗中断这个流的原因
+        self.reason = None
+
+    def expired(self, now):
+        if not self.received:
+            if self.first_deadline is not None and now > self.first_deadline:
+                return FIRST_BYTE_TIMEOUT
+            return None
+        waiting = self.waiting
+        if self.idle and waiting is not None and now - waiting > self.idle:
+            return IDLE_TIMEOUT
+        return None
+
+
+class StreamWatchdog:
+    """first_byte / idle 为 0 时不检查对应的超时; on_abandon(labels, reason) 用于写入指标"""
+
+    def __init__(self, first_byte=0.0, idle=0.0, interval=1.0, on_abandon=None):
+        self.first_byte = first_byte
+        self.idle = idle
+        self.interval = interval
+        self.on_abandon = on_abandon
+        self._watches = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = dict.fromkeys(REASONS, 0)
+
+    def watch(self, abort, sent=None, client=None, labels=()):
+        """登记一个流; sent 为发出请求的时间 (monotonic), 默认为现在"""
+        first_deadline = None
+        if self.first_byte:
+            first_deadline = (sent if sent is not None else time.monotonic()) + self.first_byte
+        watch = Watch(abort, client, labels, first_deadline, self.idle)
+        if first_deadline is None and not self.idle and client is None:
+            return watch
+        with self._lock:
+            if self._pid != os.getpid():
+                # 首次使用或 fork 之后: 子进程中没有检查线程, 继承的登记也不属于本进程
+                self._pid = os.getpid()
+                self._watches = set()
+                threading.Thread(target=self._run, name="stream-watchdog", daemon=True).start()
+            self._watches.add(watch)
+        return watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            self._watches.discard(watch)
+
+    def record(self, labels, reason):
+        """记录在其他地方发现的放弃 (写客户端失败、异步模式的超时与断开)"""
+        self.stats[reason] += 1
+        if self.on_abandon is not None:
+            self.on_abandon(labels, reason)
+
+    def check(self, now=None):
+        """检查一轮, 返回本轮中断的流数"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            watches = list(self._watches)
+        aborted = 0
+        for watch in watches:
+            reason = watch.expired(now)
+            if reason is None and watch.client is not None and client_closed(watch.client):
+                reason = CLIENT_DISCONNECT
+            if reason is None:
+                continue
+            with self._lock:
+                if watch not in self._watches:
+                    continue
+                self._watches.discard(watch)
+            watch.reason = reason
+            self.record(watch.labels, reason)
+            aborted += 1
+            try:
+                watch.abort()
+            except Exception:
+                pass
+        return aborted
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def snapshot(self):
+        with self._lock:
+            watched = len(self._watches)
+        return dict(self.stats, watched=watched, first_byte_timeout_seconds=self.first_byte,
+                    idle_timeout_seconds=self.idle)
@@ -0,0 +1,5 @@
+"""测试共用的设置: 被测模块位于 linux/ (win/ 中的共用模块与之相同)"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "linux"))
@@ -0,0 +1,286 @@
+"""Flask 版本的请求处理: 上游替换为本地的 StubResponse"""
+import json
+import time
+
+import pytest
+
+import app
+from backends import StubResponse
+from breaker import BreakerRegistry, RetryBudget
+from cache import ResponseCache
+from metrics import Registry
+from singleflight import Flight
+from usage import ANONYMOUS, UsageLedger
+
+MODEL = "deepseek-ai/DeepSeek-R1"
+CHUTE = "chutes-deepseek-ai-deepseek-r1"
+
+
+def frames(words, done=True):
+    result = [b"data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": word}}]}).encode() + b"\n\n"
+              for word in words]
+    if done:
+        result.append(b"data: [DONE]\n\n")
+    return result
+
+
+class Upstream:
+    """记录发往上游的请求体, 按 replies 依次返回响应帧"""
+
+    def __init__(self):
+        self.bodies = []
+        self.replies = []
+
+    def send(self, body):
+        self.bodies.append(body)
+        reply = self.replies.pop(0) if self.replies else frames(["hello", " world"])
+        return reply if isinstance(reply, StubResponse) else StubResponse(reply)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = Upstream()
+    monkeypatch.setattr(app.ChutesBackend, "send", lambda backend, body, trace=None: upstream.send(body))
+    monkeypatch.setattr(app, "breakers", BreakerRegistry(window=4, min_calls=2, open_seconds=30))
+    monkeypatch.setattr(app, "retry_budget", RetryBudget())
+    monkeypatch.setattr(app, "response_cache", ResponseCache())
+    monkeypatch.setattr(app, "flights", None)
+    monkeypatch.setattr(app, "hedging", None)
+    monkeypatch.setattr(app, "admission", None)
+    monkeypatch.setattr(app, "RETRY_BACKOFF_BASE", 0.0)
+    return upstream
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def chat(client, **body):
+    body.setdefault("model", MODEL)
+    body.setdefault("messages", [{"role": "user", "content": "hi"}])
+    return client.post("/v1/chat/completions", json=body)
+
+
+@pytest.mark.parametrize("messages", [
+    [{"role": "user"}],
+    [{"content": "hi"}],
+    [{"role": "user", "content": 1}],
+    ["hi"],
+    [],
+    "hi",
+])
+def test_invalid_messages_are_rejected_before_the_breaker(upstream, client, messages):
+    for _ in range(5):
+        assert chat(client, messages=messages).status_code == 400
+    assert upstream.bodies == []
+    assert app.breakers.get(CHUTE).snapshot() == {"state": "closed", "calls": 0, "errors": 0, "slow": 0}
+    assert chat(client).status_code == 200
+
+
+def test_unconvertible_body_is_not_retried(upstream):
+    tokens = app.retry_budget.snapshot()["tokens"]
+    response = app.make_request_with_retry({"model": MODEL, "messages": [{"role": "user"}]})
+    assert response.status_code == 400
+    assert upstream.bodies == []
+    assert app.breakers.get(CHUTE).snapshot()["calls"] == 0
+    assert app.retry_budget.snapshot()["tokens"] >= tokens
+
+
+def test_upstream_failures_still_open_the_breaker(upstream, monkeypatch):
+    def fail(backend, body, trace=None):
+        raise ConnectionError("down")
+
+    monkeypatch.setattr(app.ChutesBackend, "send", fail)
+    response = app.make_request_with_retry({"model": MODEL, "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code in (500, 503)
+    assert app.breakers.get(CHUTE).state == "open"
+
+
+def test_http2_cloudflare_challenge_falls_back_to_the_session_pool(monkeypatch):
+    closed = []
+
+    class Challenge:
+        status_code = 403
+        headers = {"cf-mitigated": "challenge"}
+
+        def close(self):
+            closed.append(True)
+
+    class Pool:
+        def post(self, url, data, headers, cookies):
+            return Challenge()
+
+    class Scraper:
+        def post(self, url, **options):
+            return StubResponse(frames(["ok"]))
+
+    scraper = Scraper()
+
+    class Sessions:
+        def acquire(self):
+            return scraper
+
+    monkeypatch.setattr(app, "UPSTREAM_TRANSPORT", "http2")
+    monkeypatch.setattr(app, "get_h2_pool", Pool)
+    monkeypatch.setattr(app, "session_pool", Sessions())
+    response = app.ChutesBackend("chutes").send({"messages": []})
+    assert closed == [True]
+    assert response.pooled_session is scraper
+
+
+@pytest.mark.parametrize("body", [[], "x", 1])
+def test_non_object_body_is_rejected(upstream, client, body):
+    assert client.post("/v1/chat/completions", json=body).status_code == 400
+
+
+def test_non_stream_is_cached_only_after_done(upstream, client):
+    upstream.replies = [frames(["partial"], done=False)]
+    first = chat(client, temperature=0)
+    assert first.status_code == 200
+    assert first.json["choices"][0]["message"]["content"] == "partial"
+    assert app.response_cache.snapshot()["entries"] == 0
+
+    assert chat(client, temperature=0).headers["X-Cache"] == "MISS"
+    hit = chat(client, temperature=0)
+    assert hit.headers["X-Cache"] == "HIT"
+    assert hit.json["choices"][0]["message"]["content"] == "hello world"
+    assert len(upstream.bodies) == 2
+
+
+def test_requests_differing_in_max_tokens_do_not_share_an_entry(upstream, client):
+    upstream.replies = [frames(["long answer"]), frames(["short"])]
+    assert chat(client, temperature=0).json["choices"][0]["message"]["content"] == "long answer"
+    limited = chat(client, temperature=0, max_tokens=1)
+    assert limited.headers["X-Cache"] == "MISS"
+    assert limited.json["choices"][0]["message"]["content"] == "short"
+    assert chat(client, temperature=0, max_tokens=1, stream=True).headers["X-Cache"] == "HIT"
+    assert len(upstream.bodies) == 2
+    assert app.completion_key({"model": MODEL, "messages": [], "max_tokens": 1}) != \
+        app.completion_key({"model": MODEL, "messages": [], "max_tokens": 2})
+
+
+def test_cache_hits_are_recorded_in_the_usage_ledger(upstream, client, monkeypatch):
+    monkeypatch.setattr(app, "usage_ledger", UsageLedger(Registry()))
+    body = {"temperature": 0, "stream": True, "stream_options": {"include_usage": True}}
+    chat(client, **body).get_data()
+    response = chat(client, **body)
+    assert response.headers["X-Cache"] == "HIT"
+    events = response.get_data(as_text=True).split("\n\n")
+    assert '"usage":{' in events[-3] and events[-2] == "data: [DONE]"
+    row = app.usage_ledger.report()[ANONYMOUS]
+    assert row["requests"] == 2 and row["cached_requests"] == 1
+    assert row["cached_completion_tokens"] > 0
+
+def test_stream_without_done_is_not_cached_and_has_no_done(upstream, client):
+    upstream.replies = [frames(["partial"], done=False)]
+    body = chat(client, temperature=0, stream=True).get_data()
+    assert b"partial" in body
+    assert b"[DONE]" not in body
+    assert app.response_cache.snapshot()["entries"] == 0
+
+    body = chat(client, temperature=0, stream=True).get_data()
+    assert body.endswith(b"data: [DONE]\n\n")
+    assert app.response_cache.snapshot()["entries"] == 1
+
+
+def test_truncated_response_is_not_cached(upstream, client, monkeypatch):
+    monkeypatch.setattr(app, "MAX_RESPONSE_BYTES", 8)
+    upstream.replies = [frames(["hello", " world"])]
+    result = chat(client, temperature=0).json
+    assert result["choices"][0] == {"message": {"role": "assistant", "content": "hello wo"},
+                                    "finish_reason": "length", "index": 0}
+    assert app.response_cache.snapshot()["entries"] == 0
+
+
+def test_context_is_trimmed_once_per_request(upstream, client, monkeypatch):
+    counted = []
+
+    class Counter:
+        def inc(self, labels, value=1):
+            counted.append((labels, value))
+
+    monkeypatch.setattr(app, "context_trimmed_total", Counter())
+    monkeypatch.setattr(app.context_trimmer, "max_tokens", 200)
+    monkeypatch.setattr(app.context_trimmer, "reserve_tokens", 50)
+    messages = [{"role": "user", "content": "x" * 400}, {"role": "assistant", "content": "y" * 400},
+                {"role": "user", "content": "last"}]
+    upstream.replies = [StubResponse([], 502), frames(["ok"])]
+    # 缓存键与重试各自构造上游请求体, 裁剪只在入口处计一次
+    assert chat(client, temperature=0, messages=messages).status_code == 200
+    assert counted == [((CHUTE,), 2)]
+    assert len(upstream.bodies) == 2
+    assert all(len(body["messages"]) == 2 for body in upstream.bodies)
+
+
+def test_single_flight_truncation_finishes_subscribers(upstream, monkeypatch):
+    monkeypatch.setattr(app, "MAX_RESPONSE_BYTES", 8)
+    flight = Flight("k")
+    subscription = flight.subscribe()
+    app.run_flight(flight, {"model": MODEL, "messages": [{"role": "user", "content": "hi"}]})
+    assert "".join(subscription) == "hello wo"
+    assert subscription.done
+    assert subscription.finish_reason == "length"
+
+
+def test_hedge_loser_with_slow_headers_is_aborted(upstream, client, monkeypatch):
+    read = []
+
+    class Stalled(StubResponse):
+        """首个数据块一直不到达, 直到响应被关闭"""
+
+        def iter_content(self, chunk_size=None):
+            read.append(True)
+            while not self.closed:
+                time.sleep(0.01)
+            return iter(())
+
+    primary = Stalled([])
+
+    def send(backend, body, trace=None):
+        if upstream.bodies:
+            return upstream.send(body)
+        upstream.bodies.append(body)
+        # 原请求的响应头在对冲请求胜出之后才到达
+        time.sleep(0.3)
+        return primary
+
+    monkeypatch.setattr(app.ChutesBackend, "send", send)
+    monkeypatch.setattr(app, "hedging", app.HedgePolicy(0.05, RetryBudget(ratio=1, min_per_second=0)))
+    assert chat(client, stream=False).get_json()["choices"][0]["message"]["content"] == "hello world"
+    deadline = time.monotonic() + 2
+    while not primary.closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert primary.closed
+    # 落败的一路没有等待首个数据块
+    assert not read
+
+def test_read_ahead_flushes_during_upstream_pause():
+    coalescer = app.TokenCoalescer(max_bytes=1024, interval=0.02)
+
+    def contents():
+        yield "a"
+        yield "b"
+        time.sleep(0.3)
+        yield "c"
+
+    emitted = []
+    started = time.monotonic()
+    for content in app.read_ahead(contents(), coalescer.timeout):
+        content = coalescer.expired() if content is None else coalescer.push(content)
+        if content:
+            emitted.append((content, time.monotonic() - started))
+    assert [content for content, _ in emitted] == ["a", "b", "c"]
+    # b 在上游停顿期间按合并窗口发出, 不等到 c
+    assert emitted[1][1] < 0.2
+
+
+def test_read_ahead_reraises_errors():
+    def contents():
+        yield "a"
+        raise RuntimeError("boom")
+
+    reader = app.read_ahead(contents(), lambda: None)
+    assert next(reader) == "a"
+    with pytest.raises(RuntimeError):
+        next(reader)
@@ -0,0 +1,134 @@
+"""ASGI 版本的请求处理: 直接调用 ASGI 入口, 上游替换为本地的 StubResponse"""
+import asyncio
+import json
+
+import pytest
+
+import app as core
+import asgi_app
+from backends import StubResponse
+from breaker import BreakerRegistry, RetryBudget
+from cache import ResponseCache
+from test_app import CHUTE, MODEL, frames
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    replies = []
+    bodies = []
+
+    async def send_async(backend, client, body):
+        bodies.append(body)
+        return StubResponse(replies.pop(0) if replies else frames(["hello", " world"]))
+
+    monkeypatch.setattr(core.ChutesBackend, "send_async", send_async)
+    monkeypatch.setattr(core, "breakers", BreakerRegistry(window=4, min_calls=2, open_seconds=30))
+    monkeypatch.setattr(core, "retry_budget", RetryBudget())
+    monkeypatch.setattr(core, "response_cache", ResponseCache())
+    monkeypatch.setattr(core, "hedging", None)
+    monkeypatch.setattr(core, "admission", None)
+    monkeypatch.setattr(asgi_app, "get_client", lambda: None)
+    return replies, bodies
+
+
+def call(body):
+    """发送一个聊天请求, 返回 (状态码, 响应头, 响应体)"""
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+
+    async def scenario():
+        messages = []
+        requested = asyncio.Event()
+
+        async def receive():
+            if not requested.is_set():
+                requested.set()
+                return {"type": "http.request", "body": body, "more_body": False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions", "headers": []}
+        await asgi_app.app(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(scenario())
+    start = messages[0]
+    headers = {key.decode(): value.decode() for key, value in start["headers"]}
+    return start["status"], headers, b"".join(message.get("body", b"") for message in messages[1:])
+
+
+def request(**body):
+    body.setdefault("model", MODEL)
+    body.setdefault("messages", [{"role": "user", "content": "hi"}])
+    return body
+
+
+@pytest.mark.parametrize("body", [b"[]", b'"x"', b"1", b"{bad"])
+def test_non_object_body_is_rejected(upstream, body):
+    assert call(body)[0] == 400
+
+
+def test_invalid_messages_are_rejected_before_the_breaker(upstream):
+    _, bodies = upstream
+    for _ in range(5):
+        assert call(request(messages=[{"role": "user"}]))[0] == 400
+    assert bodies == []
+    assert core.breakers.get(CHUTE).snapshot()["calls"] == 0
+    assert call(request())[0] == 200
+
+
+def test_non_stream_is_cached_only_after_done(upstream):
+    replies, bodies = upstream
+    replies.append(frames(["partial"], done=False))
+    status, _, body = call(request(temperature=0))
+    assert status == 200
+    assert json.loads(body)["choices"][0]["message"]["content"] == "partial"
+    assert core.response_cache.snapshot()["entries"] == 0
+
+    assert call(request(temperature=0))[1]["x-cache"] == "MISS"
+    assert call(request(temperature=0))[1]["x-cache"] == "HIT"
+    assert len(bodies) == 2
+
+
+def test_non_stream_processing_error_returns_json_500(upstream, monkeypatch):
+    async def broken(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(asgi_app, "process_non_stream_response", broken)
+    status, headers, body = call(request())
+    assert status == 500
+    assert headers["content-type"] == "application/json"
+    assert json.loads(body)["error"]["message"] == "Failed to process response"
+
+
+def test_stream_replay_has_request_id(upstream):
+    call(request(temperature=0, stream=True))
+    _, headers, _ = call(request(temperature=0, stream=True))
+    assert headers["x-cache"] == "HIT"
+    assert headers["x-request-id"]
+
+
+def test_stream_without_done_ends_without_done(upstream):
+    replies, _ = upstream
+    replies.append(frames(["partial"], done=False))
+    _, _, body = call(request(temperature=0, stream=True, stream_options={"include_usage": True}))
+    assert b"partial" in body
+    assert b"[DONE]" not in body
+    assert b'"usage":{' not in body
+    assert core.response_cache.snapshot()["entries"] == 0
+
+    _, _, body = call(request(temperature=0, stream=True, stream_options={"include_usage": True}))
+    assert body.endswith(b"data: [DONE]\n\n")
+    assert b'"usage":{' in body
+    assert core.response_cache.snapshot()["entries"] == 1
+
+
+def test_choices_stream_requires_every_leg_done(upstream):
+    replies, _ = upstream
+    replies.extend([frames(["a"]), frames(["b"], done=False)])
+    _, _, body = call(request(n=2, stream=True))
+    assert b"[DONE]" not in body
+    _, _, body = call(request(n=2, stream=True))
+    assert body.endswith(b"data: [DONE]\n\n")
@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, RetryBudget, backoff_delay
+
+
+def tripped(open_seconds=30.0):
+    breaker = CircuitBreaker("chute", window=4, min_calls=2, error_rate=0.5, open_seconds=open_seconds)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_stays_closed_below_min_calls_and_error_rate():
+    breaker = CircuitBreaker("chute", window=4, min_calls=3, error_rate=0.5)
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    breaker.allow()
+
+
+def test_window_forgets_old_outcomes():
+    breaker = CircuitBreaker("chute", window=2, min_calls=2, error_rate=1.0)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_error_rate_and_rejects():
+    breaker = tripped()
+    with pytest.raises(CircuitOpen) as info:
+        breaker.allow()
+    assert info.value.retry_after >= 1
+
+
+def test_opens_on_slow_calls():
+    breaker = CircuitBreaker("chute", window=4, min_calls=2, slow_seconds=1.0, slow_rate=0.5)
+    breaker.record(True, 2.0)
+    breaker.record(True, 2.0)
+    assert breaker.state == OPEN
+
+
+def test_half_open_probe_success_closes():
+    breaker = tripped(open_seconds=0.01)
+    time.sleep(0.02)
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # 同一时间只放行一个探测请求
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    breaker.allow()
+
+
+def test_half_open_probe_failure_reopens():
+    breaker = tripped(open_seconds=0.01)
+    time.sleep(0.02)
+    breaker.allow()
+    breaker.record(False)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+
+
+def test_cancel_returns_probe_slot():
+    breaker = tripped(open_seconds=0.01)
+    time.sleep(0.02)
+    breaker.allow()
+    breaker.cancel()
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+
+def test_transition_callback():
+    seen = []
+    breaker = CircuitBreaker("chute", min_calls=1, error_rate=0.5, open_seconds=0.01,
+                             on_transition=lambda name, state: seen.append((name, state)))
+    breaker.record(False)
+    time.sleep(0.02)
+    breaker.allow()
+    breaker.record(True)
+    assert seen == [("chute", OPEN), ("chute", HALF_OPEN), ("chute", CLOSED)]
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.5, min_per_second=0.0, max_tokens=2.0)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    assert budget.exhausted == 1
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_retry_budget_refills_over_time():
+    budget = RetryBudget(ratio=0.0, min_per_second=100.0, max_tokens=1.0)
+    assert budget.withdraw()
+    time.sleep(0.02)
+    assert budget.withdraw()
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, base=0.5, cap=4.0) <= min(4.0, 0.5 * 2 ** attempt)
@@ -0,0 +1,20 @@
+from buffer import ContentBuffer
+
+
+def test_joins_across_compactions():
+    buffer = ContentBuffer()
+    for i in range(ContentBuffer.COMPACT_EVERY * 2 + 3):
+        assert buffer.append(str(i % 10))
+    assert buffer.getvalue() == "".join(str(i % 10) for i in range(ContentBuffer.COMPACT_EVERY * 2 + 3))
+    assert buffer.finish_reason == "stop"
+
+
+def test_truncates_at_byte_limit_without_splitting_characters():
+    buffer = ContentBuffer(max_bytes=8)
+    assert buffer.append("ab")
+    # 每个汉字 3 字节, 第 8 字节落在第三个字中间
+    assert not buffer.append("你好吗")
+    assert buffer.getvalue() == "ab你好"
+    assert buffer.size == 8
+    assert buffer.truncated
+    assert buffer.finish_reason == "length"
@@ -0,0 +1,58 @@
+import time
+
+from cache import ResponseCache, cache_key, is_cacheable
+
+
+def test_is_cacheable():
+    assert is_cacheable({"temperature": 0})
+    assert not is_cacheable({"temperature": 0.7})
+    assert not is_cacheable({})
+    assert is_cacheable({"temperature": 1, "cache": True})
+    assert not is_cacheable({"temperature": 0, "cache": False})
+
+
+def test_cache_key_covers_forwarded_fields():
+    base = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+    key = cache_key(base, "c")
+    # 只影响输出方式的字段不参与计算
+    assert cache_key(dict(base, stream=True, stream_options={"include_usage": True}, cache=True), "c") == key
+    for field, value in (("max_tokens", 16), ("stop", ["\n"]), ("top_p", 0.5), ("response_format", {"type": "json_object"}),
+                         ("tools", [{"type": "function", "function": {"name": "f"}}])):
+        assert cache_key(dict(base, **{field: value}), "c") != key
+    assert cache_key(base, "other-chute") != key
+    assert cache_key(dict(base, messages=[{"role": "user", "content": "hello"}]), "c") != key
+
+
+def test_ttl_expiry():
+    cache = ResponseCache(ttl=0.05)
+    cache.put("k", "value")
+    assert cache.get("k").content == "value"
+    time.sleep(0.06)
+    assert cache.get("k") is None
+    assert cache.snapshot()["entries"] == 0
+
+
+def test_lru_eviction_by_bytes():
+    cache = ResponseCache(max_bytes=10)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    # 读取 a 之后, 最久未使用的是 b
+    assert cache.get("a") is not None
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a").content == "aaaa"
+    assert cache.get("c").content == "cccc"
+    assert cache.snapshot()["evictions"] == 1
+
+
+def test_oversized_entry_is_not_stored():
+    cache = ResponseCache(max_bytes=4)
+    cache.put("k", "toolong")
+    assert cache.get("k") is None
+
+
+def test_disk_layer_survives_new_instance(tmp_path):
+    ResponseCache(disk_dir=str(tmp_path)).put("k", "持久", "length")
+    entry = ResponseCache(disk_dir=str(tmp_path)).get("k")
+    assert entry.content == "持久"
+    assert entry.finish_reason == "length"
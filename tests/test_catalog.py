@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from catalog import DEFAULT_CHUTE, ModelCatalog, etag_matches, models_response, parse_catalog
+
+CONFIG = {
+    "default": "a/A",
+    "models": {
+        "a/A": {"chute": "chute-a", "aliases": ["a", "b/B"], "context_tokens": 1000},
+        "b/B": "chute-b"
+    }
+}
+
+
+def test_lookup_by_name_and_alias():
+    catalog = parse_catalog(CONFIG)
+    assert catalog.lookup("a").id == "a/A"
+    # 别名不覆盖同名的模型
+    assert catalog.lookup("b/B").id == "b/B"
+    assert catalog.chute("a") == "chute-a"
+    assert catalog.chute("unknown") == "chute-a"
+    assert catalog.setting("context_tokens") == {"chute-a": 1000}
+
+
+def test_unknown_model_without_default():
+    catalog = parse_catalog({"models": {"a/A": "chute-a"}})
+    assert catalog.chute("unknown") == DEFAULT_CHUTE
+    assert "unknown" not in catalog
+
+
+@pytest.mark.parametrize("config", [
+    [],
+    {},
+    {"models": []},
+    {"models": {"a": {}}},
+    {"models": {"a": {"chute": ""}}},
+    {"models": {"a": 1}},
+    {"models": {"a": {"chute": "c", "aliases": "x"}}},
+    {"models": {"a": {"chute": "c", "aliases": [1]}}},
+    {"models": {"a": {"chute": "c", "context_tokens": -1}}},
+    {"models": {"a": {"chute": "c", "context_tokens": "1000"}}},
+    {"models": {"a": {"chute": "c", "max_concurrency": True}}},
+    {"default": "missing", "models": {"a": "c"}},
+])
+def test_invalid_catalogs_are_rejected(config):
+    with pytest.raises(ValueError):
+        parse_catalog(config)
+
+
+def test_models_response_etag_is_stable():
+    catalog = parse_catalog(CONFIG, created=1)
+    body, etag = models_response(catalog, extra=["local/model", "a/A"])
+    assert models_response(parse_catalog(CONFIG, created=1), extra=["local/model", "a/A"]) == (body, etag)
+    ids = [model["id"] for model in json.loads(body)["data"]]
+    assert ids == ["a/A", "b/B", "local/model"]
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"x"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_reload_replaces_catalog_and_keeps_old_on_error(tmp_path):
+    path = tmp_path / "models.json"
+    path.write_text(json.dumps(CONFIG))
+    results = []
+    models = ModelCatalog(str(path), interval=0, on_reload=results.append)
+    first = models.current()
+
+    path.write_text(json.dumps({"models": {"c/C": "chute-c"}}))
+    assert models.check()
+    assert models.current().lookup("c/C") is not None
+    # 读取方拿到的旧快照不变
+    assert first.lookup("a") is not None
+
+    path.write_text("{not json")
+    assert not models.check()
+    assert models.current().lookup("c/C") is not None
+    assert results == ["ok", "error"]
+    assert models.snapshot()["errors"] == 1
+
+
+def test_on_change_failure_aborts_reload(tmp_path):
+    path = tmp_path / "models.json"
+    path.write_text(json.dumps(CONFIG))
+    models = ModelCatalog(str(path), interval=0)
+
+    def reject(catalog):
+        raise RuntimeError("rejected")
+
+    models.on_change = reject
+    path.write_text(json.dumps({"models": {"c/C": "chute-c"}}))
+    assert not models.check()
+    assert models.current().lookup("a/A") is not None
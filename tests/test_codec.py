@@ -0,0 +1,62 @@
+import json
+
+from codec import ChunkEncoder, FrameRewriter, TokenCoalescer, dumps
+
+
+def decode(frame):
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    return json.loads(frame[6:-2])
+
+
+def test_chunk_encoder_shares_id_and_escapes_content():
+    encoder = ChunkEncoder("model")
+    first = decode(encoder.encode('a"\n中'))
+    second = decode(encoder.encode("\x00"))
+    assert first["id"] == second["id"] == encoder.id
+    assert first["choices"][0]["delta"]["content"] == 'a"\n中'
+    assert second["choices"][0]["delta"]["content"] == "\x00"
+    assert first["model"] == "model"
+    assert "usage" not in first
+
+
+def test_chunk_encoder_usage_and_index():
+    encoder = ChunkEncoder("model", include_usage=True, index=2)
+    chunk = decode(encoder.encode("x"))
+    assert chunk["usage"] is None
+    assert chunk["choices"][0]["index"] == 2
+    usage = decode(encoder.encode_usage({"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}))
+    assert usage["choices"] == [] and usage["usage"]["total_tokens"] == 3
+
+
+def test_dumps_handles_lone_surrogates():
+    assert json.loads(dumps({"a": "\ud800"})) == {"a": "\ud800"}
+
+
+def test_coalescer_window():
+    coalescer = TokenCoalescer(max_bytes=1024, interval=0.02)
+    # 第一个增量立即输出
+    assert coalescer.push("a", now=0.0) == "a"
+    assert coalescer.push("b", now=0.005) is None
+    assert coalescer.timeout(now=0.01) == 0.01
+    assert coalescer.expired(now=0.01) is None
+    assert coalescer.expired(now=0.025) == "b"
+    assert coalescer.timeout(now=0.03) is None
+    assert coalescer.push("c", now=0.03) is None
+    assert coalescer.push("d", now=0.05) == "cd"
+
+
+def test_coalescer_flushes_on_size():
+    coalescer = TokenCoalescer(max_bytes=4, interval=10)
+    coalescer.push("x", now=0.0)
+    assert coalescer.push("ab", now=0.0) is None
+    assert coalescer.push("cd", now=0.0) == "abcd"
+    assert coalescer.flush() is None
+
+
+def test_frame_rewriter_replaces_model_and_keeps_fields():
+    rewriter = FrameRewriter("client-model")
+    payload = b'{"id":"up-1","model":"upstream","choices":[{"delta":{"reasoning_content":"r"}}]}'
+    frame = decode(rewriter.frame(payload))
+    assert frame["model"] == "client-model"
+    assert frame["choices"][0]["delta"]["reasoning_content"] == "r"
+    assert rewriter.id == "up-1"
@@ -0,0 +1,56 @@
+from context import MESSAGE_OVERHEAD, TRIM_NOTE, ContextTrimmer, estimate_tokens, message_text
+
+
+def conversation(turns, size=400):
+    messages = [{"role": "system", "content": "be brief"}]
+    for index in range(turns):
+        messages.append({"role": "user", "content": f"q{index} " + "x" * size})
+        messages.append({"role": "assistant", "content": f"a{index} " + "y" * size})
+    messages.append({"role": "user", "content": "last question"})
+    return messages
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("中文") == 2
+
+
+def test_message_text_accepts_content_parts():
+    assert message_text([{"type": "text", "text": "a"}, {"type": "image_url"}, {"text": "b"}]) == "ab"
+    assert message_text(None) == ""
+
+
+def test_no_trim_within_budget():
+    trimmer = ContextTrimmer(100000)
+    messages = conversation(3)
+    assert trimmer.trim(messages, trimmer.budget("chute")) == (messages, 0)
+
+
+def test_trim_keeps_system_and_recent_messages():
+    trimmer = ContextTrimmer(1000, reserve_tokens=100)
+    messages = conversation(10)
+    trimmed, dropped = trimmer.trim(messages, trimmer.budget("chute"))
+    assert dropped > 0
+    assert trimmed[0] == messages[0]
+    assert trimmed[1]["content"] == TRIM_NOTE.format(count=dropped)
+    assert trimmed[2]["role"] == "user"
+    assert trimmed[-1] == messages[-1]
+    assert len(trimmed) == len(messages) - dropped + 1
+    assert trimmer.measure(messages, trimmer.budget("chute")) <= trimmer.budget("chute")
+    # 裁剪后的消息已在预算内, 再次裁剪不会丢弃
+    assert trimmer.trim(trimmed, trimmer.budget("chute"))[1] == 0
+
+
+def test_budget_uses_limits_and_max_tokens():
+    trimmer = ContextTrimmer(1000, limits={"small": 500}, reserve_tokens=100)
+    assert trimmer.budget("other") == 900
+    assert trimmer.budget("small", 200) == 300
+    assert ContextTrimmer(0).budget("any") is None
+
+
+def test_count_depends_only_on_content():
+    trimmer = ContextTrimmer(1000)
+    short = trimmer.count({"role": "user", "content": "hi"})
+    assert short == estimate_tokens("hi") + MESSAGE_OVERHEAD
+    assert trimmer.count({"role": "user", "content": "hello " * 100}) > short
+    assert trimmer.count({"role": "assistant", "content": [{"type": "text", "text": "hi"}]}) == short
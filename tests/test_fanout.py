@@ -0,0 +1,134 @@
+import asyncio
+import threading
+
+from fanout import AsyncFanout, Fanout, LegFailed
+
+
+class Blocking:
+    """一路阻塞读取的上游: 产出 first 之后等待, 直到被 abort"""
+
+    def __init__(self, first):
+        self.first = first
+        self.aborted = threading.Event()
+        self.closed = False
+
+    def read(self):
+        yield self.first
+        if not self.aborted.wait(5):
+            raise AssertionError("未被中断")
+
+
+def run_with_timeout(target, timeout=5):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", target()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "读取没有结束"
+    return result["value"]
+
+
+def test_merges_legs_with_choice_index():
+    fanout = Fanout(3, open=lambda index: [f"{index}a", f"{index}b"], read=iter,
+                    close=lambda handle: None, abort=lambda handle: None)
+    fanout.start()
+    assert fanout.wait_started() is None
+    items = run_with_timeout(lambda: list(fanout))
+    for index in range(3):
+        assert [content for i, content in items if i == index] == [f"{index}a", f"{index}b"]
+
+
+def test_cancel_aborts_every_leg_and_ends_iteration():
+    upstreams = [Blocking("x"), Blocking("y")]
+    closed = []
+    fanout = Fanout(2, open=lambda index: upstreams[index], read=Blocking.read,
+                    close=closed.append, abort=lambda upstream: upstream.aborted.set())
+    fanout.start()
+    assert fanout.wait_started() is None
+    items = iter(fanout)
+    first = next(items)
+    fanout.cancel()
+    rest = run_with_timeout(lambda: list(items))
+    assert sorted(content for _, content in [first] + rest) == ["x", "y"]
+    assert all(upstream.aborted.is_set() for upstream in upstreams)
+    assert sorted(closed, key=id) == sorted(upstreams, key=id)
+    assert all(leg.finished for leg in fanout.legs)
+
+
+def test_open_failure_is_reported():
+    def open(index):
+        if index == 1:
+            raise LegFailed(429, "too many")
+        return ["ok"]
+
+    fanout = Fanout(2, open=open, read=iter, close=lambda handle: None, abort=lambda handle: None)
+    fanout.start()
+    assert fanout.wait_started() == (429, "too many")
+    fanout.cancel()
+
+
+def test_read_error_only_ends_that_leg():
+    def read(handle):
+        yield handle
+        if handle == "bad":
+            raise RuntimeError("boom")
+
+    fanout = Fanout(2, open=lambda index: "bad" if index else "good", read=read,
+                    close=lambda handle: None, abort=lambda handle: None)
+    fanout.start()
+    fanout.wait_started()
+    items = run_with_timeout(lambda: list(fanout))
+    assert sorted(content for _, content in items) == ["bad", "good"]
+    assert isinstance(fanout.legs[1].error, RuntimeError)
+    assert fanout.legs[0].error is None
+
+
+def test_async_cancel_closes_legs():
+    async def scenario():
+        closed = []
+        release = asyncio.Event()
+
+        async def open(index):
+            return index
+
+        async def read(index):
+            yield f"first-{index}"
+            await release.wait()
+            yield "never"
+
+        async def close(index):
+            closed.append(index)
+
+        fanout = AsyncFanout(2, open, read, close)
+        fanout.start()
+        assert await fanout.wait_started() is None
+        first = await fanout.next()
+        fanout.cancel()
+        await asyncio.sleep(0)
+        await asyncio.wait_for(asyncio.gather(*fanout._tasks, return_exceptions=True), 1)
+        return first, sorted(closed)
+
+    first, closed = asyncio.run(scenario())
+    assert first[1].startswith("first-")
+    assert closed == [0, 1]
+
+
+def test_async_open_failure():
+    async def scenario():
+        async def open(index):
+            if index:
+                raise LegFailed(503, "open")
+            return index
+
+        async def read(index):
+            yield "x"
+
+        async def close(index):
+            pass
+
+        fanout = AsyncFanout(2, open, read, close)
+        fanout.start()
+        error = await fanout.wait_started()
+        fanout.cancel()
+        return error
+
+    assert asyncio.run(scenario()) == (503, "open")
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+from h2pool import H2Error, H2Pool
+from hedge import abort
+
+
+class Upstream:
+    """httpx 的模拟传输层: 记录请求, 响应体先输出 first, 之后等待 release"""
+
+    def __init__(self, first=b"data: a\n\n", rest=b"data: [DONE]\n\n"):
+        self.first = first
+        self.rest = rest
+        self.requests = []
+        self.release = asyncio.Event()
+        self.closed = False
+
+    async def handle(self, request):
+        self.requests.append(request)
+        upstream = self
+
+        class Body(httpx.AsyncByteStream):
+            async def __aiter__(self):
+                yield upstream.first
+                await upstream.release.wait()
+                yield upstream.rest
+
+            async def aclose(self):
+                upstream.closed = True
+
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=Body())
+
+
+@pytest.fixture
+def upstream():
+    upstream = Upstream()
+    pool = H2Pool(headers={"User-Agent": "proxy-ua"}, transport=httpx.MockTransport(upstream.handle))
+    yield upstream, pool
+    pool.close()
+
+
+def test_sends_headers_and_cookies(upstream):
+    upstream, pool = upstream
+    upstream.release.set()
+    response = pool.post("https://chutes.example/app/api/chat", data=b"{}", headers={"Authorization": "Bearer x"},
+                         cookies={"cf_clearance": "cf"})
+    assert response.status_code == 200
+    assert b"".join(response.iter_content()) == b"data: a\n\ndata: [DONE]\n\n"
+    response.close()
+    request = upstream.requests[0]
+    assert request.headers["user-agent"] == "proxy-ua"
+    assert request.headers["authorization"] == "Bearer x"
+    assert request.headers["cookie"] == "cf_clearance=cf"
+    assert upstream.closed
+    assert pool.snapshot()["active_streams"] == 0
+
+
+def test_cancel_interrupts_a_blocked_read(upstream):
+    upstream, pool = upstream
+    response = pool.post("https://chutes.example/app/api/chat", data=b"{}")
+    chunks = response.iter_content()
+    assert next(chunks) == b"data: a\n\n"
+    result = {}
+
+    def read():
+        try:
+            next(chunks)
+        except H2Error as e:
+            result["error"] = e
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    reader.join(0.1)
+    assert reader.is_alive()
+    abort(response)
+    reader.join(2)
+    assert not reader.is_alive()
+    assert isinstance(result.get("error"), H2Error)
+    response.close()
+    assert upstream.closed
@@ -0,0 +1,77 @@
+import time
+
+from session_pool import SessionPool
+
+
+class Session:
+    def __init__(self):
+        self.closed = False
+        self.configured = 0
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(**options):
+    created = []
+
+    def factory():
+        created.append(Session())
+        return created[-1]
+
+    def configure(session):
+        session.configured += 1
+
+    return SessionPool(factory, configure, **options), created
+
+
+def test_released_session_is_reused():
+    pool, created = make_pool()
+    session = pool.acquire()
+    pool.release(session)
+    assert pool.acquire() is session
+    assert len(created) == 1
+    assert pool.stats()["reused"] == 1
+
+
+def test_discarded_session_is_closed():
+    pool, created = make_pool()
+    session = pool.acquire()
+    pool.release(session, discard=True)
+    assert session.closed
+    assert pool.acquire() is not session
+
+
+def test_overflow_sessions_are_closed_on_release():
+    pool, created = make_pool(max_size=1)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert pool.stats()["overflow"] == 1
+    pool.release(second)
+    pool.release(first)
+    assert second.closed and not first.closed
+    assert pool.stats()["idle"] == 1
+
+
+def test_refresh_reconfigures_in_place():
+    pool, created = make_pool()
+    session = pool.acquire()
+    pool.release(session)
+    pool.refresh()
+    assert pool.acquire() is session
+    assert session.configured == 2
+    assert pool.stats()["reconfigured"] == 1
+
+
+def test_idle_and_worn_sessions_are_evicted():
+    pool, created = make_pool(idle_timeout=0.01)
+    session = pool.acquire()
+    pool.release(session)
+    time.sleep(0.02)
+    assert pool.acquire() is not session
+    assert session.closed
+
+    pool, created = make_pool(max_uses=1)
+    session = pool.acquire()
+    pool.release(session)
+    assert session.closed
@@ -0,0 +1,48 @@
+import threading
+
+from singleflight import SingleFlight
+
+
+def test_subscribers_share_one_call_and_replay_backlog():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def start(flight):
+        calls.append(flight.key)
+        flight.publish("a")
+        release.wait(5)
+        flight.publish("b")
+        flight.finish(done=True)
+
+    first, leader = flights.join("k", start)
+    assert leader
+    first.wait_started(5)
+    second, leader = flights.join("k", start)
+    assert not leader
+    release.set()
+    assert list(first) == ["a", "b"]
+    assert list(second) == ["a", "b"]
+    assert first.done and second.done
+    assert calls == ["k"]
+    assert flights.snapshot()["coalesced"] == 1
+
+
+def test_leader_error_reaches_subscribers():
+    flights = SingleFlight()
+
+    def start(flight):
+        raise RuntimeError("boom")
+
+    subscription, _ = flights.join("k", start)
+    assert subscription.wait_started(5)[0] == 500
+    assert list(subscription) == []
+    assert not subscription.done
+
+
+def test_finished_flight_is_not_joined():
+    flights = SingleFlight()
+    first, _ = flights.join("k", lambda flight: flight.finish(done=True))
+    list(first)
+    _, leader = flights.join("k", lambda flight: flight.finish(done=True))
+    assert leader
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from sse import DONE, SSEParser, extract_content, extract_usage, iter_events, usage_only
+
+
+def chunk_event(content):
+    return b"data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": content}}]},
+                                  ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+STREAM = chunk_event("你好") + chunk_event(" world") + b"data: [DONE]\n\n"
+EXPECTED = [json.loads(event[6:]) for event in (chunk_event("你好"), chunk_event(" world"))]
+
+
+def parse_all(chunks):
+    parser = SSEParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.flush())
+    return events
+
+
+def split_at(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_parser_handles_events_split_across_chunks(size):
+    events = parse_all(split_at(STREAM, size))
+    assert [json.loads(event) for event in events[:-1]] == EXPECTED
+    assert events[-1] == DONE
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_iter_events_matches_parser(size):
+    assert list(iter_events(split_at(STREAM, size))) == parse_all([STREAM])
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 64])
+def test_crlf_line_endings(size):
+    crlf = STREAM.replace(b"\n", b"\r\n")
+    assert parse_all(split_at(crlf, size)) == parse_all([STREAM])
+    assert list(iter_events(split_at(crlf, size))) == parse_all([STREAM])
+
+
+def test_crlf_split_between_cr_and_lf():
+    events = parse_all([b"data: a\r", b"\n\r", b"\ndata: b\r\n\r\n"])
+    assert events == [b"a", b"b"]
+
+
+def test_bare_cr_line_endings():
+    assert parse_all([b"data: a\r\rdata: b\r\r"]) == [b"a", b"b"]
+
+
+def test_multiline_data_and_ignored_fields():
+    events = parse_all([b": comment\nevent: message\nid: 1\ndata: first\ndata:second\n\n"])
+    assert events == [b"first\nsecond"]
+
+
+def test_utf8_character_split_across_chunks():
+    raw = chunk_event("中文")
+    cut = raw.index("中".encode("utf-8")) + 1
+    events = parse_all([raw[:cut], raw[cut:]])
+    assert extract_content(events[0]) == "中文"
+
+
+def test_flush_returns_unterminated_event():
+    parser = SSEParser()
+    assert parser.feed(b"data: tail") == ()
+    assert parser.flush() == [b"tail"]
+    assert list(iter_events([b"data: tail"])) == [b"tail"]
+
+
+def test_extract_content_fast_path_and_fallback():
+    assert extract_content(b'{"choices":[{"delta":{"content":"a\\"b\\n"}}]}') == 'a"b\n'
+    assert extract_content(b'{"choices":[{"delta":{"content":null}}]}') is None
+    assert extract_content(b'{"choices":[{"delta":{"role":"assistant"}}]}') is None
+    # 嵌套对象中的 content 走完整解析
+    payload = b'{"choices":[{"delta":{"tool":{"content":"x"},"content":"y"}}]}'
+    assert extract_content(payload) == "y"
+
+
+def test_extract_usage():
+    assert extract_usage(b'{"choices":[],"usage":null}') is None
+    usage = {"prompt_tokens": 3, "completion_tokens": 5, "total_tokens": 8}
+    payload = json.dumps({"choices": [], "usage": usage}).encode()
+    assert extract_usage(payload) == usage
+    assert usage_only(payload)
+    assert not usage_only(chunk_event("x")[6:-2])
@@ -0,0 +1,65 @@
+from metrics import Registry
+from usage import ANONYMOUS, OTHER, UsageLedger, UsageMeter, merge_usage, parse_price
+
+USAGE = {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30}
+
+
+def test_meter_estimates_and_prefers_upstream():
+    meter = UsageMeter(prompt_tokens=7)
+    meter.add("abcd")
+    meter.add("efgh")
+    assert meter.usage() == {"prompt_tokens": 7, "completion_tokens": 2, "total_tokens": 9}
+    meter.upstream = {"completion_tokens": 5}
+    assert meter.usage() == {"prompt_tokens": 7, "completion_tokens": 5, "total_tokens": 12}
+
+
+def test_merge_usage_counts_prompt_once():
+    assert merge_usage([USAGE, USAGE]) == {"prompt_tokens": 10, "completion_tokens": 40, "total_tokens": 50}
+
+
+def test_parse_price():
+    assert parse_price("1.5:3") == (1.5, 3.0)
+    assert parse_price("2") == (2.0, 2.0)
+
+
+def test_ledger_reports_per_tenant_and_model():
+    ledger = UsageLedger(Registry(), prices={"m": (1.0, 2.0)}, tenants={"named": "team"})
+    ledger.record("named", "m", USAGE, 2.0)
+    ledger.record("named", "free", USAGE, 0)
+    ledger.record("", "m", USAGE, 0)
+    ledger.record("secret", "m", USAGE, 0)
+    report = ledger.report()
+    assert set(report) == {"team", ANONYMOUS, ledger.tenant("secret")}
+    team = report["team"]
+    assert team["requests"] == 2 and team["completion_tokens"] == 40
+    assert team["models"]["m"]["tokens_per_second"] == 10.0
+    assert team["cost"] == round((10 * 1.0 + 20 * 2.0) / 1e6, 6)
+    # 未命名的 key 只以哈希出现
+    assert "secret" not in str(report)
+
+
+def test_ledger_labels_are_bounded():
+    aliases = {"r1": "deepseek-ai/DeepSeek-R1", "deepseek-ai/DeepSeek-R1": "deepseek-ai/DeepSeek-R1"}
+    ledger = UsageLedger(Registry(), prices={"deepseek-ai/DeepSeek-R1": (1.0, 2.0)}, tenants={"named": "team"},
+                         model_label=lambda model: aliases.get(model, OTHER), max_tenants=2)
+    for key in ("named", "", "k1", "k2", "k3", "k4"):
+        ledger.record(key, "r1", USAGE, 1.0)
+    ledger.record("k1", "made-up", USAGE, 1.0)
+    report = ledger.report()
+    assert set(report) == {"team", ANONYMOUS, OTHER, ledger.tenant("k1"), ledger.tenant("k2")}
+    assert report[OTHER]["requests"] == 2
+    assert set(report[ledger.tenant("k1")]["models"]) == {"deepseek-ai/DeepSeek-R1", OTHER}
+    # 别名按对应模型的价格计费
+    assert report["team"]["cost"] == round((10 * 1.0 + 20 * 2.0) / 1e6, 6)
+    assert "k1" not in str(report)
+
+
+def test_cached_completions_are_marked_and_skip_throughput():
+    ledger = UsageLedger(Registry(), prices={"m": (1.0, 2.0)})
+    ledger.record("", "m", USAGE, 2.0)
+    ledger.record("", "m", USAGE, 0, cached=True)
+    row = ledger.report()[ANONYMOUS]["models"]["m"]
+    assert row["requests"] == 2 and row["cached_requests"] == 1
+    assert row["completion_tokens"] == 40 and row["cached_completion_tokens"] == 20
+    assert row["cost"] == round(2 * (10 * 1.0 + 20 * 2.0) / 1e6, 6)
+    assert row["tokens_per_second"] == 10.0
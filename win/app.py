@@ -1,34 +1,41 @@
-from flask import Flask, request, Response, stream_with_context, jsonify
+from flask import Flask, request, Response, stream_with_context
 import cloudscraper
-import json
 import uuid
 from datetime import datetime, timezone
 import time
 import os
+import logging
+import logs
+from session_pool import SessionPool
+from sse import DONE, USAGE_KEY, iter_response_events, extract_content, extract_usage
+from codec import DONE_FRAME, ChunkEncoder, dumps
+from buffer import ContentBuffer
+from usage import UsageMeter
+from context import ContextTrimmer
+from catalog import etag_matches, load_catalog, models_response
+
+# 配置日志: 后台线程写出, 请求线程只入队 (见 logs.py)
+logs.setup()
 
 app = Flask(__name__)
 
-# 模型映射字典
-MODEL_MAPPING = {
-    "nvidia/Llama-3.1-405B-Instruct-FP8": "chutes-nvidia-llama-3-1-405b-instruct-fp8",
-    "deepseek-ai/DeepSeek-R1": "chutes-deepseek-ai-deepseek-r1",
-    "Qwen/Qwen2.5-72B-Instruct": "chutes-qwen-qwen2-5-72b-instruct",
-    "Qwen/Qwen2.5-Coder-32B-Instruc": "chutes-qwen-qwen2-5-coder-32b-instruct",
-    "bytedance-research/UI-TARS-72B-DPO": "chutes-bytedance-research-ui-tars-72b-dpo",
-    "OpenGVLab/InternVL2_5-78B": "chutes-opengvlab-internvl2-5-78b",
-    "hugging-quants/Meta-Llama-3.1-70B-Instruct-AWQ-INT4": "chutes-hugging-quants-meta-llama-3-1-70b-instruct-awq-int4",
-    "NousResearch/Hermes-3-Llama-3.1-8B": "cxmplexbb-nousresearch-hermes-3-llama-3-1-8b",
-    "Qwen/QVQ-72B-Preview": "chutes-qwen-qvq-72b-preview",
-    "deepseek-ai/DeepSeek-R1-Distill-Qwen-32B": "chutes-deepseek-ai-deepseek-r1-distill-qwen-32b",
-    "jondurbin/bagel-8b-v1.0": "chutes-jondurbin-bagel-8b-v1-0",
-    "unsloth/QwQ-32B-Preview": "cxmplexbb-unsloth-qwq-32b-preview",
-    "Qwen/QwQ-32B-Preview": "chutes-qwq-32b-preview",
-    "jondurbin/airoboros-34b-3.3": "chutes-jondurbin-airoboros-34b-3-3",
-    "NovaSky-AI/Sky-T1-32B-Preview": "chutes-novasky-ai-sky-t1-32b-preview",
-    "driaforall/Dria-Agent-a-3B": "chutes-driaforall-dria-agent-a-3b",
-    "NousResearch/Nous-Hermes-Llama2-13b": "cxmplexbb-nousresearch-nous-hermes-llama2-13b",
-    "unsloth/Llama-3.2-1B-Instruct": "chutes-unsloth-llama-3-2-1b-instruct"
-}
+# 模型目录: 对外的模型名 (与别名) 到 chuteName 的映射及每个模型的设置, 来自 MODELS_FILE (默认同目录下的 models.json)
+# 或 MODELS_JSON; 文件修改后 MODELS_RELOAD_INTERVAL 秒内生效, 不需要重启 (见 catalog.py)
+model_catalog = load_catalog(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models.json'),
+    interval=float(os.getenv('MODELS_RELOAD_INTERVAL', 5))
+)
+
+# 上游地址; 压测时可指向本地模拟服务 (bench/mock_chutes.py)
+CHUTES_BASE_URL = os.getenv('CHUTES_BASE_URL', 'https://chutes.ai').rstrip('/')
+
+# 上游超时 (秒, 0 为不限制); 本版本只设置 socket 超时, 读超时取首个事件与空闲超时中较大的一个
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 10))
+UPSTREAM_READ_TIMEOUT = max(float(os.getenv('UPSTREAM_FIRST_BYTE_TIMEOUT', 120)),
+                            float(os.getenv('UPSTREAM_IDLE_TIMEOUT', 60))) or None
+
+# 非流式响应的最大字节数, 超出后截断并返回 finish_reason=length (0 表示不限制)
+MAX_RESPONSE_BYTES = int(os.getenv('MAX_RESPONSE_BYTES', 8 * 1024 * 1024))
 
 def check_auth():
     """检查认证"""
@@ -70,27 +77,83 @@ def create_scraper():
     
     return scraper
 
+def create_session_pool():
+    """创建上游会话池: 复用 scraper 及其 keep-alive 连接"""
+    return SessionPool(
+        create_scraper,
+        max_size=int(os.getenv('SESSION_POOL_SIZE', 16)),
+        idle_timeout=float(os.getenv('SESSION_IDLE_TIMEOUT', 300)),
+        max_age=float(os.getenv('SESSION_MAX_AGE', 1800))
+    )
+
+session_pool = create_session_pool()
+
+def reset_after_fork():
+    """worker fork 之后重置进程内状态, 不与主进程共享连接"""
+    global session_pool
+    session_pool = create_session_pool()
+
+def release_response(response, scraper, discard=False):
+    """关闭上游响应并将会话归还会话池"""
+    try:
+        response.close()
+    except Exception:
+        discard = True
+    session_pool.release(scraper, discard=discard)
+
+
+# 上下文裁剪: 转发完整的对话历史, 超过 CONTEXT_MAX_TOKENS (减去 max_tokens 或 CONTEXT_RESERVE_TOKENS) 时省略较早的消息
+# 模型目录中的 context_tokens 单独设置对应 chute 的上下文长度
+context_trimmer = ContextTrimmer(
+    int(os.getenv('CONTEXT_MAX_TOKENS', 60000)),
+    limits=model_catalog.current().setting('context_tokens'),
+    reserve_tokens=int(os.getenv('CONTEXT_RESERVE_TOKENS', 4096))
+)
+# /v1/models 的响应体与 ETag, 每个目录版本构造一次
+models_listing = models_response(model_catalog.current())
+
+def apply_catalog(catalog):
+    """新的模型目录生效之前更新上下文长度与 /v1/models 响应"""
+    global models_listing
+    context_trimmer.limits = catalog.setting('context_tokens')
+    models_listing = models_response(catalog)
+
+model_catalog.on_change = apply_catalog
 
 def create_chutes_request(openai_request):
-    """将OpenAI格式请求转换为Chutes格式"""
-    messages = openai_request['messages']
-    message_id = str(uuid.uuid4())
-    current_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-    
+    """将OpenAI格式请求转换为Chutes格式: 转发完整的对话历史, 超出上下文预算时裁剪较早的消息"""
     model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
-    chute_name = MODEL_MAPPING.get(model, 'chutes-deepseek-ai-deepseek-r1')
-    
+    chute_name = model_catalog.current().chute(model)
+
+    messages, _ = context_trimmer.trim(
+        openai_request['messages'],
+        context_trimmer.budget(chute_name, openai_request.get('max_tokens'))
+    )
+    current_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
     return {
         "messages": [{
-            "role": messages[-1]['role'],
-            "content": messages[-1]['content'],
-            "id": message_id,
+            "role": message['role'],
+            "content": message['content'],
+            "id": str(uuid.uuid4()),
             "createdOn": current_time
-        }],
+        } for message in messages],
         "model": model,
         "chuteName": chute_name
     }
 
+def include_usage(openai_request):
+    """请求是否设置了 stream_options.include_usage"""
+    options = openai_request.get('stream_options')
+    return isinstance(options, dict) and bool(options.get('include_usage'))
+
+def usage_meter(openai_request):
+    """创建用量计量器, prompt_tokens 按裁剪后实际转发的消息估算"""
+    model = openai_request.get('model', 'deepseek-ai/DeepSeek-R1')
+    return UsageMeter(context_trimmer.measure(
+        openai_request.get('messages') or [],
+        context_trimmer.budget(model_catalog.current().chute(model), openai_request.get('max_tokens'))
+    ))
+
 def process_chunk(chunk):
     """处理响应数据块"""
     try:
@@ -100,25 +163,25 @@ def process_chunk(chunk):
     except:
         return None
 
-def process_non_stream_response(response, model):
-    """处理非流式响应"""
+def process_non_stream_response(response, model, meter):
+    """处理非流式响应: 增量收集到 ContentBuffer, 耗时与响应长度成线性关系, 超过 MAX_RESPONSE_BYTES 时截断; 用量由 meter 计量"""
     try:
-        full_content = ""
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith("data: "):
-                    data = line[6:]
-                    if data == "[DONE]":
-                        break
-                    try:
-                        chunk = json.loads(data)
-                        content = process_chunk(chunk)
-                        if content:
-                            full_content += content
-                    except json.JSONDecodeError:
-                        continue
+        buffer = ContentBuffer(MAX_RESPONSE_BYTES)
+        for payload in iter_response_events(response):
+            if payload == DONE:
+                break
+            if USAGE_KEY in payload:
+                usage = extract_usage(payload)
+                if usage is not None:
+                    meter.upstream = usage
+            content = extract_content(payload, process_chunk)
+            if content:
+                meter.add(content)
+                if not buffer.append(content):
+                    logging.warning("响应超过 %d 字节, 已截断", MAX_RESPONSE_BYTES)
+                    break
 
+        full_content = buffer.getvalue()
         if not full_content:
             return Response("Empty response from server", status=500)
 
@@ -132,19 +195,27 @@ def process_non_stream_response(response, model):
                     "role": "assistant",
                     "content": full_content
                 },
-                "finish_reason": "stop",
+                "finish_reason": buffer.finish_reason,
                 "index": 0
             }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
+            "usage": meter.usage()
         }
     except Exception as e:
-        print(f"Error processing non-stream response: {str(e)}")
+        logging.error("Error processing non-stream response: %s", e)
         return Response("Failed to process response", status=500)
 
+@app.before_request
+def clear_log_context():
+    # 线程会被后续请求复用, 清除上一个请求绑定的日志请求 id
+    logs.bind(None)
+
+@app.after_request
+def add_request_id(response):
+    request_id = logs.current_request_id()
+    if request_id is not None:
+        response.headers['X-Request-Id'] = request_id
+    return response
+
 @app.route('/', methods=['GET'])
 def home():
     """健康检查端点"""
@@ -152,23 +223,16 @@ def home():
 
 @app.route('/v1/models', methods=['GET'])
 def get_models():
-    """获取可用模型列表"""
+    """获取可用模型列表; 响应体按目录版本预先构造, If-None-Match 与 ETag 相同时返回 304"""
     if not check_auth():
         return Response("Unauthorized", status=401)
-        
-    models = []
-    for model_id in MODEL_MAPPING.keys():
-        models.append({
-            "id": model_id,
-            "object": "model",
-            "created": int(time.time()),
-            "owned_by": "chutes"
-        })
-    
-    return jsonify({
-        "object": "list",
-        "data": models
-    })
+
+    model_catalog.current()
+    body, etag = models_listing
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers=headers)
+    return Response(body, status=200, content_type='application/json', headers=headers)
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat():
@@ -177,9 +241,12 @@ def chat():
         if not check_auth():
             return Response("Unauthorized", status=401)
 
-        openai_request = request.json
+        openai_request = request.get_json(silent=True)
+        if not isinstance(openai_request, dict):
+            return Response("请求体必须是 JSON 对象", status=400)
+        logs.bind(request.headers.get('X-Request-Id') or uuid.uuid4().hex)
         chutes_request = create_chutes_request(openai_request)
-        scraper = create_scraper()
+        scraper = session_pool.acquire()
 
         headers = {
             "Accept": "*/*",
@@ -197,61 +264,63 @@ def chat():
             "Sec-Fetch-Site": "same-origin"
         }
 
-        response = scraper.post(
-            "https://chutes.ai/app/api/chat",
-            headers=headers,
-            json=chutes_request,
-            stream=True
-        )
+        try:
+            response = scraper.post(
+                f"{CHUTES_BASE_URL}/app/api/chat",
+                headers=headers,
+                json=chutes_request,
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT or None, UPSTREAM_READ_TIMEOUT)
+            )
+        except Exception:
+            session_pool.release(scraper, discard=True)
+            raise
 
         if response.status_code != 200:
-            return Response(f"Chutes API error: {response.text}", status=response.status_code)
+            error_text = response.text
+            release_response(response, scraper)
+            return Response(f"Chutes API error: {error_text}", status=response.status_code)
 
         # 处理非流式请求
         if not openai_request.get('stream', False):
-            result = process_non_stream_response(response, chutes_request["model"])
+            try:
+                result = process_non_stream_response(response, chutes_request["model"], usage_meter(openai_request))
+            finally:
+                release_response(response, scraper)
             return Response(
-                json.dumps(result, ensure_ascii=False),
+                dumps(result),
                 status=200,
                 content_type='application/json'
             ) if isinstance(result, dict) else result
 
-        # 处理流式请求
+        # 处理流式请求: 整个补全共用一个 id, 每个增量只序列化内容本身 (见 codec.py)
         def generate():
+            report_usage = include_usage(openai_request)
+            encoder = ChunkEncoder(chutes_request["model"], include_usage=report_usage)
+            meter = usage_meter(openai_request) if report_usage else None
             try:
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith("data: "):
-                            data = line[6:]
-                            if data == "[DONE]":
-                                yield "data: [DONE]\n\n"
-                                break
-                            
-                            try:
-                                chunk = json.loads(data)
-                                content = process_chunk(chunk)
-                                if content:
-                                    response_chunk = {
-                                        "id": str(uuid.uuid4()),
-                                        "object": "chat.completion.chunk",
-                                        "created": int(time.time()),
-                                        "model": chutes_request["model"],
-                                        "choices": [{
-                                            "delta": {
-                                                "content": content
-                                            },
-                                            "index": 0,
-                                            "finish_reason": None
-                                        }]
-                                    }
-                                    yield f"data: {json.dumps(response_chunk, ensure_ascii=False)}\n\n"
-                            except json.JSONDecodeError:
-                                continue
-                            
+                for payload in iter_response_events(response):
+                    if payload == DONE:
+                        if report_usage:
+                            yield encoder.encode_usage(meter.usage())
+                        yield DONE_FRAME
+                        break
+
+                    if report_usage and USAGE_KEY in payload:
+                        usage = extract_usage(payload)
+                        if usage is not None:
+                            meter.upstream = usage
+                    content = extract_content(payload, process_chunk)
+                    if content:
+                        if report_usage:
+                            meter.add(content)
+                        yield encoder.encode(content)
+
             except Exception as e:
-                print(f"Error in generate: {str(e)}")
+                logging.error("Error in generate: %s", e)
                 return
+            finally:
+                release_response(response, scraper)
 
         return Response(
             stream_with_context(generate()),
@@ -259,9 +328,25 @@ def chat():
         )
 
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
+        logging.error("Error in chat endpoint: %s", e, exc_info=True)
         return Response(f"Internal server error: {str(e)}", status=500)
 
+def run_production_server():
+    """使用 gunicorn 多进程启动 (配置见 gunicorn.conf.py)"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    os.execvp('gunicorn', [
+        'gunicorn',
+        '--chdir', base_dir,
+        '-c', os.path.join(base_dir, 'gunicorn.conf.py'),
+        'app:app'
+    ])
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8805))
+    # DEV_SERVER=1 时使用 Flask 开发服务器
+    if os.getenv('DEV_SERVER') != '1' and os.name != 'nt':
+        try:
+            run_production_server()
+        except FileNotFoundError:
+            logging.warning("gunicorn not installed, falling back to development server")
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,75 @@
+"""非流式响应的内容缓冲
+
+增量内容线性时间拼接, 超过 MAX_RESPONSE_BYTES 时按字节截断, finish_reason 为 length。
+linux 与 win 版本共用本模块。
+"""
+import sys
+
+
+class ContentBuffer:
+    """线性时间拼接响应内容, 超过字节上限时截断
+
+    每累积 COMPACT_EVERY 个片段合并一次, 既不依赖 CPython 对 += 的原地优化,
+    也不会让成千上万个 token 小对象同时存活。
+    """
+
+    COMPACT_EVERY = 256
+
+    __slots__ = ('parts', 'blocks', 'chars', 'max_bytes', 'truncated', '_size', '_safe_chars')
+
+    def __init__(self, max_bytes=0):
+        self.parts = []
+        self.blocks = []
+        self.chars = 0
+        self.max_bytes = max_bytes
+        self.truncated = False
+        # 精确字节数只在接近上限时计算; 每个字符最多 4 字节, 字符数低于 _safe_chars 时必然未超限
+        self._size = None
+        self._safe_chars = max_bytes // 4 if max_bytes else sys.maxsize
+
+    def append(self, content):
+        """追加内容, 达到上限时返回 False"""
+        parts = self.parts
+        parts.append(content)
+        if len(parts) >= self.COMPACT_EVERY:
+            self.blocks.append("".join(parts))
+            parts.clear()
+        self.chars += len(content)
+        if self.chars <= self._safe_chars:
+            return True
+        return self._check_limit(content)
+
+    def _check_limit(self, content):
+        if self._size is None:
+            self._size = len(self.getvalue().encode('utf-8'))
+        else:
+            self._size += len(content.encode('utf-8'))
+        if self._size <= self.max_bytes:
+            return True
+        # 按字节截断, 丢弃被切断的多字节字符
+        text = self.getvalue().encode('utf-8')[:self.max_bytes].decode('utf-8', 'ignore')
+        self.blocks = [text]
+        self.parts = []
+        self.chars = len(text)
+        self._size = len(text.encode('utf-8'))
+        self.truncated = True
+        return False
+
+    @property
+    def size(self):
+        """当前内容的 UTF-8 字节数"""
+        if self._size is None:
+            return len(self.getvalue().encode('utf-8'))
+        return self._size
+
+    def getvalue(self):
+        if self.parts:
+            self.blocks.append("".join(self.parts))
+            self.parts.clear()
+        if len(self.blocks) > 1:
+            self.blocks = ["".join(self.blocks)]
+        return self.blocks[0] if self.blocks else ""
+
+    @property
+    def finish_reason(self):
+        return "length" if self.truncated else "stop"
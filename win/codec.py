@@ -0,0 +1,206 @@
+"""SSE 输出编码
+
+- JSON 后端可插拔: 安装 orjson 时默认使用, 否则回退到标准库 (JSON_BACKEND=json 强制使用标准库)
+- ChunkEncoder 为每个补全固定 id/created/model, 预先序列化信封前后缀, 每个 token 只需转义内容本身
+- FrameRewriter 透传上游的 data 帧, 只在字节层面替换 id / model, 不做 JSON 往返
+linux 与 win 版本共用本模块。
+"""
+import json
+import os
+import re
+import time
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+if JSON_BACKEND == 'json' or orjson is None:
+    orjson = None
+    JSON_BACKEND = 'json'
+else:
+    JSON_BACKEND = 'orjson'
+
+_encode_basestring = json.encoder.encode_basestring
+
+DONE_FRAME = b"data: [DONE]\n\n"
+
+# 用于在模板中定位 content 的占位符
+_PLACEHOLDER = "\x00content\x00"
+
+
+def dumps(obj):
+    """序列化为 UTF-8 字节串 (不转义非 ASCII 字符)"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson 不接受孤立代理字符等输入, 交给标准库
+            pass
+    try:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    except UnicodeEncodeError:
+        return json.dumps(obj).encode('ascii')
+
+
+def encode_string(value):
+    """序列化单个字符串为 JSON 字面量 (含引号) 的字节串"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    try:
+        return _encode_basestring(value).encode('utf-8')
+    except UnicodeEncodeError:
+        return json.dumps(value).encode('ascii')
+
+
+class ChunkEncoder:
+    """单个补全的 chat.completion.chunk 编码器; n > 1 时每个 choice 一个编码器, index 为其序号"""
+
+    __slots__ = ('id', 'created', 'model', '_prefix', '_suffix')
+
+    def __init__(self, model, completion_id=None, created=None, include_usage=False, index=0):
+        self.id = completion_id or f"chatcmpl-{uuid.uuid4().hex}"
+        self.created = created or int(time.time())
+        self.model = model
+        chunk = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+            "choices": [{
+                "delta": {
+                    "content": _PLACEHOLDER
+                },
+                "index": index,
+                "finish_reason": None
+            }]
+        }
+        if include_usage:
+            # stream_options.include_usage: 其余的块带 "usage": null, 最后一块单独给出用量
+            chunk["usage"] = None
+        template = dumps(chunk)
+        prefix, suffix = template.split(dumps(_PLACEHOLDER), 1)
+        self._prefix = b"data: " + prefix
+        self._suffix = suffix + b"\n\n"
+
+    def encode(self, content):
+        """编码一个内容增量为完整的 SSE 帧"""
+        return self._prefix + encode_string(content) + self._suffix
+
+    def encode_usage(self, usage):
+        """stream_options.include_usage 的最后一块: choices 为空, 只带 usage"""
+        return b"data: " + dumps({
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [],
+            "usage": usage
+        }) + b"\n\n"
+
+
+class TokenCoalescer:
+    """按时间窗口/字节数合并相邻的内容增量, 减少下游帧数
+
+    第一个增量总是立即输出, 首 token 延迟不变; 之后的增量在窗口内累积,
+    达到 max_bytes 或距上次输出超过 interval 秒时合并输出。
+    """
+
+    __slots__ = ('max_bytes', 'interval', '_parts', '_size', '_last_emit')
+
+    def __init__(self, max_bytes=1024, interval=0.02):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._parts = []
+        self._size = 0
+        self._last_emit = None
+
+    def push(self, content, now=None):
+        """加入一个增量, 需要立即输出时返回合并后的内容, 否则返回 None"""
+        now = time.monotonic() if now is None else now
+        if self._last_emit is None:
+            self._last_emit = now
+            return content
+        self._parts.append(content)
+        self._size += len(content) if content.isascii() else len(content.encode('utf-8'))
+        if self._size >= self.max_bytes or now - self._last_emit >= self.interval:
+            self._last_emit = now
+            return self.flush()
+        return None
+
+    def flush(self):
+        """取出所有待输出内容"""
+        if not self._parts:
+            return None
+        content = self._parts[0] if len(self._parts) == 1 else "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        return content
+
+    def timeout(self, now=None):
+        """距离待输出内容必须发出的剩余秒数, 没有待输出内容时返回 None"""
+        if not self._parts:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.interval - (now - self._last_emit))
+
+    def expired(self, now=None):
+        """窗口到期时取出待输出内容"""
+        remaining = self.timeout(now)
+        if remaining is None or remaining > 0:
+            return None
+        self._last_emit = time.monotonic() if now is None else now
+        return self.flush()
+
+
+class FrameRewriter:
+    """透传模式: 原样转发上游的 data 帧, 上游的 model 与请求的模型名不同时替换为后者
+
+    第一个可解析的帧确定上游 model 键值对的原始字节串, 之后每帧最多一次 bytes.replace, 不做 JSON 往返;
+    个别帧的值与第一帧不同时原样转发。上游的 id 保存在 id 中, 代理自己输出的块 (用量) 沿用该 id,
+    不必改写每一帧。其余字段 (reasoning_content、finish_reason、role 等) 都保留。
+    """
+
+    __slots__ = ('id', 'model', '_pairs')
+
+    def __init__(self, model):
+        self.id = None
+        self.model = model
+        self._pairs = None
+
+    def _learn(self, payload):
+        try:
+            chunk = json.loads(payload)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return None
+        if not isinstance(chunk, dict):
+            return None
+        if isinstance(chunk.get("id"), str):
+            self.id = chunk["id"]
+        upstream = chunk.get("model")
+        if not isinstance(upstream, str) or self.model is None or upstream == self.model:
+            return ()
+        match = re.search(rb'"model"\s*:\s*' + re.escape(encode_string(upstream)), payload)
+        if match is None:
+            return ()
+        return ((match.group(0), b'"model":' + encode_string(self.model)),)
+
+    def frame(self, payload):
+        """一个上游事件 data 对应的完整 SSE 帧"""
+        pairs = self._pairs
+        if pairs is None:
+            # 不是 JSON 对象 (如上游的错误文本) 时等下一帧再确定
+            pairs = self._pairs = self._learn(payload)
+        if pairs:
+            for old, new in pairs:
+                payload = payload.replace(old, new, 1)
+        # 10 为 \n; 整数成员判断走 memchr, 比 b"\n" in payload 快
+        if 10 in payload:
+            # 多行 data 事件
+            payload = payload.replace(b"\n", b"\ndata: ")
+        return b"data: " + payload + b"\n\n"
@@ -0,0 +1,38 @@
+"""生产环境 gunicorn 配置 (容器内运行)
+
+启动: gunicorn -c gunicorn.conf.py app:app
+所有参数都可以通过环境变量调整。
+"""
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8805)}"
+
+# worker 进程数与每个进程的线程数; 流式响应较长时优先增加线程数
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 32))
+# gthread: 线程模型; 安装 gevent 后可设置为 gevent 使用协程
+worker_class = os.getenv('WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+
+# 预加载应用, worker fork 后通过 post_fork 重置进程内状态
+preload_app = os.getenv('PRELOAD_APP', '1') == '1'
+
+# SIGTERM 后停止接收新请求, 等待进行中的流完成
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 300))
+# gthread/gevent 下 worker 由心跳判断存活, 不会因为长时间流式响应被杀掉
+timeout = int(os.getenv('WORKER_TIMEOUT', 120))
+keepalive = int(os.getenv('KEEPALIVE', 5))
+
+# 处理一定数量请求后回收 worker, 加抖动避免同时重启
+max_requests = int(os.getenv('MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', 1000))
+
+accesslog = os.getenv('ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    import app
+    app.reset_after_fork()
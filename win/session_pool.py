@@ -0,0 +1,141 @@
+import threading
+import time
+import logging
+from collections import deque
+
+
+class _PooledSession:
+    """池中会话的元数据"""
+
+    __slots__ = ('session', 'created', 'last_used', 'uses', 'version', 'broken')
+
+    def __init__(self, session, version):
+        now = time.monotonic()
+        self.session = session
+        self.created = now
+        self.last_used = now
+        self.uses = 0
+        self.version = version
+        self.broken = False
+
+
+class SessionPool:
+    """线程安全的长连接会话池
+
+    - factory(): 创建一个新的会话 (耗时: 建立 scraper + 请求头)
+    - configure(session): 把共享状态 (Authorization / cookie) 应用到会话上
+    - 共享状态变化时调用 refresh(), 会话在下次取出时原地重新配置, 保留已建立的 keep-alive 连接
+    - 池满时临时创建溢出会话, 归还时直接关闭, 不会阻塞请求
+    """
+
+    def __init__(self, factory, configure=None, max_size=16, idle_timeout=300, max_age=1800, max_uses=1000):
+        self._factory = factory
+        self._configure = configure
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._in_use = {}
+        self._version = 0
+        self._stats = {"created": 0, "reused": 0, "reconfigured": 0, "evicted": 0, "overflow": 0}
+
+    def refresh(self):
+        """共享状态已变化, 标记所有会话需要重新配置"""
+        with self._lock:
+            self._version += 1
+
+    def acquire(self):
+        """取出一个可用会话"""
+        expired = []
+        entry = None
+        with self._lock:
+            self._evict_idle_locked(expired)
+            while self._idle:
+                candidate = self._idle.pop()
+                if self._is_healthy(candidate):
+                    entry = candidate
+                    break
+                expired.append(candidate)
+            version = self._version
+            pooled = entry is not None or len(self._in_use) < self.max_size
+        self._close_all(expired)
+
+        if entry is None:
+            entry = _PooledSession(self._factory(), -1)
+            with self._lock:
+                self._stats["created"] += 1
+                if not pooled:
+                    self._stats["overflow"] += 1
+        else:
+            with self._lock:
+                self._stats["reused"] += 1
+
+        if entry.version != version:
+            if self._configure:
+                self._configure(entry.session)
+            if entry.version != -1:
+                with self._lock:
+                    self._stats["reconfigured"] += 1
+            entry.version = version
+
+        entry.uses += 1
+        entry.last_used = time.monotonic()
+        if pooled:
+            with self._lock:
+                self._in_use[id(entry.session)] = entry
+        return entry.session
+
+    def release(self, session, discard=False):
+        """归还会话; discard=True 表示会话出错, 直接丢弃"""
+        with self._lock:
+            entry = self._in_use.pop(id(session), None)
+            if entry is not None:
+                entry.last_used = time.monotonic()
+                entry.broken = entry.broken or discard
+                if self._is_healthy(entry) and len(self._idle) < self.max_size:
+                    self._idle.append(entry)
+                    return
+        # 溢出会话或不健康会话直接关闭
+        self._close_all([entry] if entry is not None else [_PooledSession(session, -1)])
+
+    def stats(self):
+        """返回会话池状态"""
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), in_use=len(self._in_use), version=self._version)
+
+    def close(self):
+        """关闭所有空闲会话"""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        self._close_all(idle)
+
+    def _is_healthy(self, entry):
+        now = time.monotonic()
+        if entry.broken:
+            return False
+        if self.max_age and now - entry.created > self.max_age:
+            return False
+        if self.max_uses and entry.uses >= self.max_uses:
+            return False
+        if self.idle_timeout and now - entry.last_used > self.idle_timeout:
+            return False
+        return True
+
+    def _evict_idle_locked(self, expired):
+        # 空闲队列左侧是最久未使用的会话
+        now = time.monotonic()
+        while self._idle and self.idle_timeout and now - self._idle[0].last_used > self.idle_timeout:
+            expired.append(self._idle.popleft())
+
+    def _close_all(self, entries):
+        for entry in entries:
+            try:
+                entry.session.close()
+            except Exception as e:
+                logging.debug("关闭会话失败: %s", e)
+        if entries:
+            with self._lock:
+                self._stats["evicted"] += len(entries)
@@ -0,0 +1,192 @@
+"""用量统计
+
+- prompt_tokens 按裁剪后实际转发的消息估算, 复用上下文裁剪的逐条缓存, 多轮对话只需估算新增的消息
+- completion_tokens 在解析上游增量时累计字符数与字节数, 结束时估算一次, 与增量的切分方式无关
+  (缓存回放、合并输出得到相同的数字); 上游返回 usage 时以上游的数字为准
+- 按租户 (API key) 与模型累计请求数、token 数、生成耗时与费用, 写入 Prometheus 计数器,
+  多 worker 时经 METRICS_DIR 合并; API key 不出现在指标中, 未在 USAGE_TENANTS 中命名的 key 以哈希前缀表示,
+  超过 max_tenants 个之后新的 key 都计入 other; 模型名经 model_label 归一 (别名计入对应的模型, 未知模型为 other),
+  指标的标签数量有上限
+- 缓存命中的补全同样计入请求数、token 数与费用, 另外计入 cached 计数器, 便于区分计费; 没有生成耗时, 不影响输出速度
+linux 与 win 版本共用本模块 (win 版本只使用 UsageMeter)。
+"""
+import hashlib
+import threading
+import time
+
+from context import estimate_from_counts
+
+ANONYMOUS = "anonymous"
+# 超出上限的租户与未知模型
+OTHER = "other"
+
+
+class UsageMeter:
+    """单个补全的用量计量"""
+
+    __slots__ = ('prompt_tokens', 'chars', 'size', 'first', 'upstream')
+
+    def __init__(self, prompt_tokens=0):
+        self.prompt_tokens = prompt_tokens
+        self.chars = 0
+        self.size = 0
+        # 第一个增量到达的时间, 用于计算输出速度
+        self.first = None
+        # 上游返回的 usage
+        self.upstream = None
+
+    def add(self, content):
+        if self.first is None:
+            self.first = time.monotonic()
+        self.chars += len(content)
+        self.size += len(content) if content.isascii() else len(content.encode("utf-8", "surrogatepass"))
+
+    def usage(self):
+        """OpenAI 格式的 usage"""
+        upstream = self.upstream
+        if upstream is not None:
+            completion = upstream["completion_tokens"]
+            prompt = upstream.get("prompt_tokens")
+            if not isinstance(prompt, int):
+                prompt = self.prompt_tokens
+        else:
+            completion = estimate_from_counts(self.chars, self.size)
+            prompt = self.prompt_tokens
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion
+        }
+
+    def elapsed(self):
+        """第一个增量到现在的秒数"""
+        return time.monotonic() - self.first if self.first is not None else 0.0
+
+
+def merge_usage(usages):
+    """n > 1 时合并各 choice 的用量: 提示词只发送一次, 按第一路计; completion_tokens 相加"""
+    prompt = usages[0]["prompt_tokens"]
+    completion = sum(usage["completion_tokens"] for usage in usages)
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion
+    }
+
+
+def parse_price(value):
+    """"输入价格:输出价格" (每百万 token), 只给一个数时输入输出同价"""
+    prompt, _, completion = value.partition(":")
+    return float(prompt), float(completion or prompt)
+
+
+class UsageLedger:
+    """按租户与模型累计用量
+
+    prices 为 {模型: (输入价格, 输出价格)}, 单位为每百万 token; tenants 为 {API key: 租户名};
+    model_label(model) 返回指标中的模型名; max_tenants 为未命名 key 的租户数上限 (每个 worker)。
+    """
+
+    def __init__(self, registry, prices=None, tenants=None, model_label=None, max_tenants=1000):
+        self.registry = registry
+        self.prices = dict(prices or {})
+        self.tenants = dict(tenants or {})
+        self.model_label = model_label or (lambda model: model or "")
+        self.max_tenants = max_tenants
+        self._ids = {}
+        self._lock = threading.Lock()
+        labels = ('tenant', 'model')
+        self.requests_total = registry.counter(
+            'chutes_usage_requests_total', '按租户与模型统计的补全请求数', labels)
+        self.tokens_total = registry.counter(
+            'chutes_usage_tokens_total', '按租户与模型统计的 token 数', labels + ('type',))
+        self.generation_seconds_total = registry.counter(
+            'chutes_usage_generation_seconds_total', '首个增量到输出结束的累计耗时, 用于计算输出速度', labels)
+        self.cost_total = registry.counter(
+            'chutes_usage_cost_total', '按 USAGE_PRICES 计算的费用', labels)
+        self.cached_requests_total = registry.counter(
+            'chutes_usage_cached_requests_total', '由响应缓存返回的补全请求数 (同时计入 requests_total)', labels)
+        self.cached_tokens_total = registry.counter(
+            'chutes_usage_cached_tokens_total', '由响应缓存返回的 completion token 数 (同时计入 tokens_total)', labels)
+
+    def tenant(self, api_key):
+        """API key 对应的租户标识; 已记录的未命名 key 达到上限后, 新的 key 计入 other (已有的指标序列不会被删除)"""
+        if not api_key:
+            return ANONYMOUS
+        tenant = self.tenants.get(api_key)
+        if tenant is not None:
+            return tenant
+        with self._lock:
+            tenant = self._ids.get(api_key)
+            if tenant is None:
+                if len(self._ids) >= self.max_tenants:
+                    return OTHER
+                tenant = self._ids[api_key] = "key-" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+        return tenant
+
+    def cost(self, model, usage):
+        price = self.prices.get(model)
+        if price is None:
+            return 0.0
+        return (usage["prompt_tokens"] * price[0] + usage["completion_tokens"] * price[1]) / 1e6
+
+    def record(self, api_key, model, usage, seconds, cached=False):
+        """记录一次补全; cached 为 True 表示由响应缓存返回"""
+        model = self.model_label(model)
+        labels = (self.tenant(api_key), model)
+        self.requests_total.inc(labels)
+        self.tokens_total.inc(labels + ("prompt",), usage["prompt_tokens"])
+        self.tokens_total.inc(labels + ("completion",), usage["completion_tokens"])
+        if seconds > 0:
+            self.generation_seconds_total.inc(labels, seconds)
+        cost = self.cost(model, usage)
+        if cost:
+            self.cost_total.inc(labels, cost)
+        if cached:
+            self.cached_requests_total.inc(labels)
+            self.cached_tokens_total.inc(labels, usage["completion_tokens"])
+
+    def report(self):
+        """{租户: {"models": {模型: 用量}, 以及全部模型的合计}}, 包含所有 worker"""
+        rows = {}
+        names = {
+            self.requests_total.name: "requests",
+            self.generation_seconds_total.name: "generation_seconds",
+            self.cost_total.name: "cost",
+            self.cached_requests_total.name: "cached_requests",
+            self.cached_tokens_total.name: "cached_completion_tokens"
+        }
+        for (name, labels), value in self.registry.merged().items():
+            if name == self.tokens_total.name:
+                field = f"{labels[2]}_tokens"
+            elif name in names:
+                field = names[name]
+            else:
+                continue
+            row = rows.setdefault((labels[0], labels[1]), {
+                "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "generation_seconds": 0.0, "cost": 0.0,
+                "cached_requests": 0, "cached_completion_tokens": 0})
+            row[field] += value
+
+        report = {}
+        for (tenant, model), row in sorted(rows.items()):
+            entry = report.setdefault(tenant, {
+                "models": {}, "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "generation_seconds": 0.0, "cost": 0.0, "cached_requests": 0, "cached_completion_tokens": 0})
+            entry["models"][model] = _finish(dict(row))
+            for field, value in row.items():
+                entry[field] += value
+        for entry in report.values():
+            _finish(entry)
+        return report
+
+
+def _finish(row):
+    row["total_tokens"] = row["prompt_tokens"] + row["completion_tokens"]
+    seconds = row["generation_seconds"]
+    # 缓存命中没有生成耗时, 不计入输出速度
+    generated = row["completion_tokens"] - row["cached_completion_tokens"]
+    row["tokens_per_second"] = round(generated / seconds, 2) if seconds > 0 else None
+    row["generation_seconds"] = round(seconds, 3)
+    row["cost"] = round(row["cost"], 6)
+    return row